@@ -26,8 +26,9 @@ from ursina.sequence import Sequence, Func, Wait
 from ursina import curve
 from ursina.entity import Entity
 from ursina.collider import *
-from ursina.raycast import raycast
-from ursina.boxcast import boxcast
+from ursina.raycast import raycast, raycast_batch
+from ursina.spatial_query import overlap_sphere, overlap_box, nearest
+from ursina.boxcast import boxcast, boxcast_batch
 from ursina.audio import Audio
 from ursina.duplicate import duplicate
 from panda3d.core import Quat
@@ -62,7 +63,7 @@ from ursina.models.procedural.capsule import Capsule
 from ursina.models.procedural.grid import Grid
 from ursina.models.procedural.terrain import Terrain
 
-from ursina.terraincast import terraincast
+from ursina.terraincast import terraincast, terrain_heights
 from ursina.scripts.smooth_follow import SmoothFollow
 from ursina.scripts.grid_layout import grid_layout
 from ursina.scripts.scrollable import Scrollable
@@ -1,37 +1,112 @@
+import builtins
+from panda3d.core import CollisionTraverser, CollisionNode, CollisionHandlerQueue, CollisionBox, Point3
 from ursina.entity import Entity
 from ursina.scene import instance as scene
 from ursina.vec3 import Vec3
 from ursina import color
-from ursina.ursinastuff import invoke
+from ursina.ursinastuff import destroy
+from ursina.hit_info import HitInfo, hit_info_from_entries, batch_hit_info_from_entries
+from ursina.collider import get_collide_mask
 
 
-_boxcast_box = Entity(model='cube', origin_z=-.5, collider='box', color=color.white33, enabled=False, eternal=True, add_to_scene_entities=False)
+# the box goes from the origin to 1 unit forward. its node path gets moved, scaled and rotated to fit each cast,
+# so casting doesn't touch any entity, the collider or scene.collidables.
+_unit_box = CollisionBox(Point3(-.5,-.5,0), Point3(.5,.5,1))
 
-def boxcast(origin, direction=(0,0,1), distance=9999, thickness=(1,1), traverse_target=scene, ignore:list=None, debug=False): # similar to raycast, but with width and height
+def _new_box_node_path(name, parent):
+    node = CollisionNode(name)
+    node.set_into_collide_mask(0)
+    node.addSolid(_unit_box)
+    return parent.attach_new_node(node)
+
+
+def _place_box(node_path, origin, direction, distance, thickness):
+    node_path.setPos(origin[0], origin[1], origin[2])
+    node_path.setScale(abs(thickness[0]), abs(thickness[1]), max(abs(distance), 1e-4))
+    up = (0,0,1) if abs(direction[0]) < 1e-6 and abs(direction[2]) < 1e-6 else (0,1,0)  # straight up or down, so pick another up axis
+    node_path.lookAt(Point3(origin[0]+direction[0], origin[1]+direction[1], origin[2]+direction[2]), Vec3(*up))
+
+
+_boxcaster = Entity(add_to_scene_entities=False)
+_boxcaster._picker = CollisionTraverser()
+_boxcaster._pq = CollisionHandlerQueue()
+_boxcaster._boxNP = _new_box_node_path('_boxcaster', _boxcaster)
+_boxcaster._picker.addCollider(_boxcaster._boxNP, _boxcaster._pq)
+
+
+def boxcast(origin, direction=(0,0,1), distance=9999, thickness=(1,1), traverse_target=scene, ignore:list=None, debug=False, layers=None, first_hit_only=False, hit_info=None): # similar to raycast, but with width and height
     if not ignore:
-        ignore = []
+        ignore = ()
 
     if isinstance(thickness, (int, float, complex)):
         thickness = (thickness, thickness)
 
-    _boxcast_box.enabled = True
-    _boxcast_box.collision = True
-    _boxcast_box.position = origin
-    _boxcast_box.scale = Vec3(abs(thickness[0]), abs(thickness[1]), abs(distance))
-    _boxcast_box.always_on_top = debug
-    _boxcast_box.visible = debug
-
-    _boxcast_box.look_at(origin + direction)
-    hit_info = _boxcast_box.intersects(traverse_target=traverse_target, ignore=ignore)
+    _boxcaster._boxNP.node().set_from_collide_mask(get_collide_mask(layers))
+    _place_box(_boxcaster._boxNP, origin, direction, distance, thickness)
 
     if debug:
-        _boxcast_box.collision = False
-        invoke(setattr, _boxcast_box, 'enabled', False, delay=.2)
-    else:
-        _boxcast_box.enabled = False
+        temp = Entity(model='cube', origin_z=-.5, color=color.white33, always_on_top=True, add_to_scene_entities=False)
+        temp.setMat(_boxcaster._boxNP.getMat())
+        destroy(temp, .2)
+
+    _boxcaster._pq.clear_entries()
+    _boxcaster._picker.traverse(traverse_target)
 
-    return hit_info
+    if _boxcaster._pq.get_num_entries() == 0:
+        return hit_info.reset(hit=False) if hit_info is not None else HitInfo(hit=False)
 
+    _boxcaster._pq.sort_entries()
+    return hit_info_from_entries(_boxcaster._pq.getEntries(), _boxcaster._boxNP.getPos(builtins.render), ignore=ignore, first_hit_only=first_hit_only, hit_info=hit_info)
+
+
+_batch_boxcaster = Entity(add_to_scene_entities=False)
+_batch_boxcaster._picker = CollisionTraverser()
+_batch_boxcaster._pq = CollisionHandlerQueue()
+_batch_boxcaster._boxes = []     # NodePaths, reused between calls
+_batch_boxcaster._active_box_count = 0
+
+
+def _set_batch_box_count(n):
+    boxes = _batch_boxcaster._boxes
+    while len(boxes) < n:
+        node_path = _new_box_node_path(f'_batch_box_{len(boxes)}', _batch_boxcaster)
+        node_path.setPythonTag('batch_index', len(boxes))
+        boxes.append(node_path)
+
+    for i in range(_batch_boxcaster._active_box_count, n):
+        _batch_boxcaster._picker.addCollider(boxes[i], _batch_boxcaster._pq)
+    for i in range(n, _batch_boxcaster._active_box_count):
+        _batch_boxcaster._picker.removeCollider(boxes[i])
+    _batch_boxcaster._active_box_count = n
+
+
+def boxcast_batch(origins, directions=(0,0,1), distances=9999, thickness=(1,1), traverse_target:Entity=scene, ignore:list=None, layers=None):
+    ''' Casts many boxes with a single traversal of the scene. origins and directions are numpy arrays
+    (or lists) of shape (n,3), distances of shape (n,) and thickness of shape (n,2). Everything but origins
+    can also be a single value for all boxes. Returns a BatchHitInfo with one row per box.
+    '''
+    import numpy as np
+
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+    n = len(origins)
+    directions = np.broadcast_to(np.asarray(directions, dtype=np.float64).reshape(-1, 3), (n, 3))
+    distances = np.broadcast_to(np.asarray(distances, dtype=np.float64).ravel(), (n, ))
+    thickness = np.asarray(thickness, dtype=np.float64)
+    if thickness.size == 1:
+        thickness = np.repeat(thickness.ravel(), 2)
+    thickness = np.broadcast_to(thickness.reshape(-1, 2), (n, 2))
+
+    _set_batch_box_count(n)
+    mask = get_collide_mask(layers)
+    for node_path, origin, direction, distance, size in zip(_batch_boxcaster._boxes, origins.tolist(), directions.tolist(), distances.tolist(), thickness.tolist()):
+        node_path.node().set_from_collide_mask(mask)
+        _place_box(node_path, origin, direction, distance, size)
+
+    _batch_boxcaster._pq.clear_entries()
+    _batch_boxcaster._picker.traverse(traverse_target)
+
+    # the corners of the box reach a bit further than distance, so don't skip hits based on it
+    return batch_hit_info_from_entries(_batch_boxcaster._pq.getEntries(), origins, distances, ignore, limit_distance=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+from direct.task import Task
+from ursina import application
+from ursina.entity import Entity
+from ursina.raycast import raycast_batch
+
+
+class CCDSystem(Entity):
+    ''' Continuous collision detection for entities with ccd=True. Once per frame, casts a ray from where each of them was
+    last frame to where it is now, all in a single traversal, so fast moving entities can't skip past thin colliders between frames.
+    On a hit, the entity's ccd_hit gets set to the HitInfo of the earliest hit, ccd_time_of_impact to how far along the
+    movement it happened, from 0 to 1, and on_ccd_hit() gets called if the entity has it.
+    Only the center of the entity is swept, not its collider. Set ccd to True again after teleporting an entity, so it doesn't sweep the jump.
+    The sweep runs in its own task after the entities' update(), so it sees where they ended up this frame no matter when they were created.
+    '''
+    instance = None
+
+    def __init__(self, **kwargs):
+        super().__init__(eternal=True, **kwargs)
+        self.last_positions = dict()    # entity -> world position last frame
+        self._sweep_task = application.base.taskMgr.add(self._sweep_task_function, 'ccd_sweep', sort=1)     # ursina's update task has sort 0
+
+
+    @staticmethod
+    def get():
+        if not CCDSystem.instance or CCDSystem.instance.is_empty():
+            CCDSystem.instance = CCDSystem()
+        return CCDSystem.instance
+
+
+    def add(self, entity):   # starts sweeping from wherever the entity is at the next update, so it can still be moved into place first
+        self.last_positions[entity] = None
+
+
+    def remove(self, entity):
+        self.last_positions.pop(entity, None)
+
+
+    def _sweep_task_function(self, task):
+        if self.enabled and not (application.paused and self.ignore_paused is False):
+            self.sweep()
+        return Task.cont
+
+
+    def on_destroy(self):
+        application.base.taskMgr.remove(self._sweep_task)
+
+
+    def sweep(self):
+        import numpy as np
+
+        moved, starts, ends = [], [], []
+        for entity, last_position in list(self.last_positions.items()):
+            if entity.is_empty():   # destroyed
+                del self.last_positions[entity]
+                continue
+
+            position = entity.world_position
+            self.last_positions[entity] = position
+            if last_position is not None and entity.enabled and position != last_position:
+                moved.append(entity)
+                starts.append(last_position)
+                ends.append(position)
+
+        if not moved:
+            return
+
+        starts = np.array(starts, dtype=np.float64)
+        movements = np.array(ends, dtype=np.float64) - starts
+        lengths = np.linalg.norm(movements, axis=1)
+        hits = raycast_batch(starts, movements, lengths, ignore_per_ray=moved)
+
+        events = []
+        for i in np.flatnonzero(hits.hit).tolist():
+            entity = moved[i]
+            entity.ccd_hit = hits[i]
+            entity.ccd_time_of_impact = float(hits.distance[i] / lengths[i])
+            if hasattr(entity, 'on_ccd_hit'):
+                events.append(entity.on_ccd_hit)
+
+        for event in events:
+            event()
+
+
+
+if __name__ == '__main__':
+    from ursina import *
+    app = Ursina()
+
+    '''
+    Bullets moving further than the wall's thickness in a single frame would usually go right through it.
+    With ccd=True, they get stopped at the wall.
+    '''
+    wall = Entity(model='cube', collider='box', scale=(10,4,.05), z=10, color=color.azure)
+
+    class Bullet(Entity):
+        def __init__(self, **kwargs):
+            super().__init__(model='sphere', scale=.2, color=color.orange, ccd=True, **kwargs)
+
+        def update(self):
+            if self.ccd:
+                self.z += 300 * time.dt
+
+        def on_ccd_hit(self):
+            self.world_position = self.ccd_hit.world_point
+            self.color = color.red
+            self.ccd = False
+            destroy(self, delay=1)
+
+    def input(key):
+        if key == 'space':
+            Bullet(x=random.uniform(-4,4), y=random.uniform(-1.5,1.5))
+
+    EditorCamera()
+    app.run()
@@ -1,59 +1,187 @@
 from panda3d.core import CollisionNode, CollisionBox, CollisionSphere, CollisionCapsule, CollisionPolygon
-from panda3d.core import NodePath
+from panda3d.core import NodePath, BitMask32, Point3
 from panda3d.core import BoundingVolume
 from ursina.vec3 import Vec3
 from ursina.mesh import Mesh
 
 
+collision_layers = ['default', ]    # layer names in bit order. new names get added the first time they're used.
+
+def get_collide_mask(layers):
+    ''' Returns a BitMask32 from a layer name, a list of layer names or an int bit mask. None means all layers. '''
+    if layers is None:
+        return CollisionNode.get_default_collide_mask()
+    if isinstance(layers, BitMask32):
+        return layers
+    if isinstance(layers, int):
+        return BitMask32(layers)
+    if isinstance(layers, str):
+        layers = (layers, )
+
+    mask = BitMask32()
+    for name in layers:
+        if name not in collision_layers:
+            if len(collision_layers) >= 20:    # only the first 20 bits are in panda's default collide mask, so the mouse and other default colliders will still hit them
+                raise ValueError(f'Too many collision layers, max is 20: {collision_layers}')
+            collision_layers.append(name)
+        mask.set_bit(collision_layers.index(name))
+
+    return mask
+
+
+def _get_centroids(solids):
+    import numpy as np
+    return np.array([tuple(e.getCollisionOrigin()) for e in solids], dtype=np.float32).reshape(-1, 3)
+
+
 # Recursive.
-def build_bvh(entity, node_path, solids, axis=0, only_xz=False, max_depth=8, max_solids=None, flatten=False, current_depth=0):
-    if len(solids) == 1 or current_depth >= max_depth - 1:
-        if max_solids is not None:
-            if len(solids) <= max_solids:
-                for e in solids:
-                    node_path.node().addSolid(e)
-                return
-        else:
-            for e in solids:
-                node_path.node().addSolid(e)
+def build_bvh(entity, node_path, solids, axis=0, only_xz=False, max_depth=8, max_solids=None, flatten=False, current_depth=0, centroids=None):
+    ''' Splits solids in two halves at the median, alternating between the x, z and y axis, and puts them in a tree of CollisionNodes.
+    centroids is an optional numpy array of shape (n,3) with the center of each solid, so they don't have to be read one by one.
+    '''
+    import numpy as np
+    if centroids is None:
+        centroids = _get_centroids(solids)
+    _build_bvh(entity, node_path, solids, np.asarray(centroids), np.arange(len(solids)), axis, only_xz, max_depth, max_solids, flatten, current_depth)
+
+
+def _build_bvh(entity, node_path, solids, centroids, indices, axis, only_xz, max_depth, max_solids, flatten, current_depth):
+    import numpy as np
+
+    if len(indices) == 1 or current_depth >= max_depth - 1:
+        if max_solids is None or len(indices) <= max_solids:
+            node = node_path.node()
+            for i in indices.tolist():
+                node.addSolid(solids[i])
             return
-    solids_sorted = None
-    if axis == 0:
-        solids_sorted = sorted(solids, key=lambda s: s.getCollisionOrigin().getX())
-    elif axis == 1:
-        solids_sorted = sorted(solids, key=lambda s: s.getCollisionOrigin().getZ())
-    else:
-        solids_sorted = sorted(solids, key=lambda s: s.getCollisionOrigin().getY())
-    mid_point = len(solids_sorted) // 2
-    left_solids = solids_sorted[:mid_point]
-    right_solids = solids_sorted[mid_point:]
+
+    # argpartition finds the median in O(n), instead of sorting all the solids again at every level
+    column = (0, 2, 1)[axis]
+    mid_point = len(indices) // 2
+    order = np.argpartition(centroids[indices, column], mid_point)
+    left_indices = indices[order[:mid_point]]
+    right_indices = indices[order[mid_point:]]
+
     if only_xz:
         next_axis = (axis + 1) % 2
     else:
         next_axis = (axis + 1) % 3
     next_depth = current_depth + 1
-    left_collision_node = CollisionNode('CollisionNode')
-    left_collision_node.setBoundsType(BoundingVolume.BT_box)
-    left_node_path = node_path.attachNewNode(left_collision_node)
-    left_node_path.setPythonTag('Entity', entity)
-    right_collision_node = CollisionNode('CollisionNode')
-    right_collision_node.setBoundsType(BoundingVolume.BT_box)
-    right_node_path = node_path.attachNewNode(right_collision_node)
-    right_node_path.setPythonTag('Entity', entity)
-    build_bvh(entity, left_node_path, left_solids, axis=next_axis, only_xz=only_xz, max_depth=max_depth, max_solids=max_solids, current_depth=next_depth, flatten=flatten)
-    build_bvh(entity, right_node_path, right_solids, axis=next_axis, only_xz=only_xz, max_depth=max_depth, max_solids=max_solids, current_depth=next_depth, flatten=flatten)
+
+    child_node_paths = []
+    for child_indices in (left_indices, right_indices):
+        child_collision_node = CollisionNode('CollisionNode')
+        child_collision_node.setBoundsType(BoundingVolume.BT_box)
+        child_node_path = node_path.attachNewNode(child_collision_node)
+        if entity is not None:
+            child_node_path.setPythonTag('Entity', entity)
+        _build_bvh(entity, child_node_path, solids, centroids, child_indices, next_axis, only_xz, max_depth, max_solids, flatten, next_depth)
+        child_node_paths.append(child_node_path)
+
     if flatten and current_depth < max_depth - 2:
-        for child in left_node_path.getChildren():
-            child.reparentTo(node_path)
-        for child in right_node_path.getChildren():
-            child.reparentTo(node_path)
-        left_node_path.removeNode()
-        right_node_path.removeNode()
+        for child_node_path in child_node_paths:
+            for child in child_node_path.getChildren():
+                child.reparentTo(node_path)
+            child_node_path.removeNode()
         node_path.getBounds()
 
 
+def _read_vertices(vertex_data):
+    # read the vertex column straight from the buffer instead of one vertex at a time with GeomVertexReader
+    import numpy as np
+    from panda3d.core import InternalName, Geom, GeomVertexFormat
+
+    column = vertex_data.getFormat().getColumn(InternalName.getVertex())
+    if column is None:
+        return None
+    if column.getNumericType() != Geom.NT_float32 or column.getNumComponents() != 3:
+        vertex_data = vertex_data.convertTo(GeomVertexFormat.getV3())
+
+    vertex_format = vertex_data.getFormat()
+    array_index = vertex_format.getArrayWith(InternalName.getVertex())
+    start = vertex_format.getColumn(InternalName.getVertex()).getStart()
+    stride = vertex_format.getArray(array_index).getStride()
+    data = np.frombuffer(memoryview(vertex_data.getArray(array_index)).cast('B'), dtype=np.uint8).reshape(-1, stride)
+    return np.ascontiguousarray(data[:, start:start+12]).view(np.float32).reshape(-1, 3)
+
+
+def _is_hidden_lod(node_path, model):
+    # skip all but the closest level of detail, see ursina.scripts.lod
+    from panda3d.core import LODNode
+    while node_path != model and node_path.hasParent():
+        parent = node_path.getParent()
+        if isinstance(parent.node(), LODNode) and node_path != parent.getChild(0):
+            return True
+        node_path = parent
+    return False
+
+
+def get_triangles(model):
+    ''' Returns the triangles of a Mesh or loaded model as a numpy array of shape (n,3,3), relative to the model.
+    Reads the vertex and index buffers of every Geom directly, so it's fast even for large models.
+    '''
+    import numpy as np
+    from panda3d.core import GeomNode, GeomPrimitive, Geom
+
+    index_types = {Geom.NT_uint8: np.uint8, Geom.NT_uint16: np.uint16, Geom.NT_uint32: np.uint32}
+    geom_node_paths = list(model.findAllMatches('**/+GeomNode'))
+    if isinstance(model.node(), GeomNode):
+        geom_node_paths.insert(0, model)
+
+    triangles = []
+    for geom_node_path in geom_node_paths:
+        if _is_hidden_lod(geom_node_path, model):
+            continue
+        mat = geom_node_path.getMat(model)
+        matrix = np.array([[mat.getCell(row, column) for column in range(4)] for row in range(4)], dtype=np.float32)
+
+        for geom in geom_node_path.node().getGeoms():
+            vertices = _read_vertices(geom.getVertexData())
+            if vertices is None:
+                continue
+            vertices = vertices @ matrix[:3,:3] + matrix[3,:3]
+
+            for primitive in geom.getPrimitives():
+                if primitive.getPrimitiveType() != GeomPrimitive.PT_polygons:
+                    continue
+                primitive = primitive.decompose()   # triangle strips and fans to triangles
+                if primitive.isIndexed():
+                    indices = np.frombuffer(memoryview(primitive.getVertices()).cast('B'), dtype=index_types[primitive.getIndexType()])
+                else:
+                    indices = np.arange(primitive.getFirstVertex(), primitive.getFirstVertex() + primitive.getNumVertices())
+                indices = indices[:len(indices) - (len(indices) % 3)]
+                triangles.append(vertices[indices].reshape(-1, 3, 3))
+
+    if not triangles:
+        return np.zeros((0, 3, 3), dtype=np.float32)
+    return np.concatenate(triangles)
+
+
+def _set_collide_mask(node_path, mask):
+    stack = [node_path]
+    while len(stack) > 0:
+        node_path = stack.pop()
+        node_path.node().set_into_collide_mask(mask)
+        for child in node_path.getChildren():
+            stack.append(child)
+
+
+_shared_mesh_colliders = dict()     # (mesh content hash and bvh settings, layers) -> [CollisionNode tree that gets instanced to each entity, number of colliders using it]
+
+def clear_collider_cache():     # free the colliders shared between entities. entities that already use them keep working.
+    _shared_mesh_colliders.clear()
+
+def _release_shared_mesh_collider(key):    # forget the shared tree once the last collider using it is gone, so edited meshes don't pile up
+    entry = _shared_mesh_colliders.get(key)
+    if entry is None:
+        return
+    entry[1] -= 1
+    if entry[1] <= 0:
+        del _shared_mesh_colliders[key]
+
+
 class Collider(NodePath):
-    def __init__(self, entity, shape, bvh=False, bvh_max_depth=8, bvh_max_shapes=None, bvh_only_xz=False, bvh_flatten=False):
+    def __init__(self, entity, shape, bvh=False, bvh_max_depth=8, bvh_max_shapes=None, bvh_only_xz=False, bvh_flatten=False, centroids=None):
         super().__init__('collider')
         self.collision_node = CollisionNode('CollisionNode')
 
@@ -64,13 +192,24 @@ class Collider(NodePath):
         if isinstance(shape, (list, tuple)):
             if bvh:
                 self.node_path.node().setBoundsType(BoundingVolume.BT_box)
-                build_bvh(entity, self.node_path, shape, max_depth=bvh_max_depth, max_solids=bvh_max_shapes, only_xz=bvh_only_xz, flatten=bvh_flatten)
+                build_bvh(entity, self.node_path, shape, max_depth=bvh_max_depth, max_solids=bvh_max_shapes, only_xz=bvh_only_xz, flatten=bvh_flatten, centroids=centroids)
             else:
                 for e in shape:
                     self.node_path.node().addSolid(e)
         else:
             self.node_path.node().addSolid(self.shape)
 
+        self.layers = getattr(entity, 'layers', 'default')
+
+    @property
+    def layers(self):
+        return self._layers
+
+    @layers.setter
+    def layers(self, value):    # the collision layers this collider can be hit in. see get_collide_mask().
+        self._layers = value
+        _set_collide_mask(self.node_path, get_collide_mask(value))
+
     def show_bounds(self, only_leaves=True):
         stack = [self.node_path]
         while len(stack) > 0:
@@ -152,7 +291,13 @@ class CapsuleCollider(Collider):
 
 
 class MeshCollider(Collider):
-    def __init__(self, entity, mesh=None, center=(0,0,0), bvh=False, bvh_max_depth=8, bvh_max_shapes=None, bvh_only_xz=False, bvh_flatten=False):
+    def __init__(self, entity, mesh=None, center=(0,0,0), bvh=False, bvh_max_depth=8, bvh_max_shapes=None, bvh_only_xz=False, bvh_flatten=False, cache=False, shared=True):
+        ''' If shared is True, entities with the same mesh, bvh settings and layers use the same collider through instancing,
+        so it only gets built once. Set cache to True to also save it as a .bam file in application.compressed_models_folder
+        and load that instead of building it the next time the same mesh is used.
+        '''
+        import numpy as np
+        NodePath.__init__(self, 'collider')
         self.center = center
         center = Vec3(center)
         if mesh is None and entity.model:
@@ -160,71 +305,119 @@ class MeshCollider(Collider):
             # print('''auto generating mesh collider from entity's mesh''')
 
         self.collision_polygons = []
-
-        if isinstance(mesh, Mesh):
-            if mesh.mode == 'triangle':
-                for i in range(0, len(mesh.generated_vertices), 3):
-                    poly = CollisionPolygon(
-                        Vec3(*mesh.generated_vertices[i+2]),
-                        Vec3(*mesh.generated_vertices[i+1]),
-                        Vec3(*mesh.generated_vertices[i]),
-                        )
-                    self.collision_polygons.append(poly)
-
-            elif mesh.mode == 'ngon':
-                # NOTE: does not support vertices len < 3. Is already being intercepted by pandas3D.
-                for i in range(2, len(mesh.vertices)):
-                    poly = CollisionPolygon(
-                        Vec3(*mesh.vertices[i]),
-                        Vec3(*mesh.vertices[i - 1]),
-                        Vec3(*mesh.vertices[0]),
-                    )
-                    self.collision_polygons.append(poly)
+        self.shape = self.collision_polygons
+        self.shared = shared
+
+        if isinstance(mesh, Mesh) and mesh.mode in ('line', 'point'):
+            print('error: mesh collider does not support', mesh.mode, 'mode')
+            return None
+
+        triangles = get_triangles(mesh)
+        # skip degenerate triangles, since panda can't make polygons out of those
+        normals = np.cross(triangles[:,1] - triangles[:,0], triangles[:,2] - triangles[:,0])
+        triangles = triangles[np.einsum('ij,ij->i', normals, normals) > 1e-12]
+
+        self._layers = getattr(entity, 'layers', 'default')
+        cache_name = self._get_cache_name(mesh, triangles, bvh, bvh_max_depth, bvh_max_shapes, bvh_only_xz, bvh_flatten)
+        key = (cache_name, str(self._layers))
+
+        entry = _shared_mesh_colliders.get(key) if shared else None
+        collision_tree = entry[0] if entry else None
+        if collision_tree is None:
+            from ursina import application
+            file_path = application.compressed_models_folder / f'{cache_name}.bam'
+            if cache and file_path.exists():
+                collision_tree = self._load(file_path)
             else:
-                print('error: mesh collider does not support', mesh.mode, 'mode')
-                return None
-
-
-        elif isinstance(mesh, NodePath):
-            from panda3d.core import GeomVertexReader
-            verts = []
-            children = mesh.getChildren()
-            for child in children:
-                child_transform = child.getTransform()
-                child_mat = child_transform.getMat()
-                geomNodeCollection = child.findAllMatches('**/+GeomNode')
-                for nodePath in geomNodeCollection:
-                    geomNode = nodePath.node()
-                    for i in range(geomNode.getNumGeoms()):
-                        geom = geomNode.getGeom(i)
-                        vdata = geom.getVertexData()
-                        for i in range(geom.getNumPrimitives()):
-                            prim = geom.getPrimitive(i)
-                            vertex_reader = GeomVertexReader(vdata, 'vertex')
-                            prim = prim.decompose()
-
-                            for p in range(prim.getNumPrimitives()):
-                                s = prim.getPrimitiveStart(p)
-                                e = prim.getPrimitiveEnd(p)
-                                for i in range(s, e):
-                                    vi = prim.getVertex(i)
-                                    vertex_reader.setRow(vi)
-                                    verts.append(child_mat.xformPointGeneral(vertex_reader.getData3()))
-
-            for i in range(0, len(verts)-3, 3):
-                p = CollisionPolygon(Vec3(verts[i+2]), Vec3(verts[i+1]), Vec3(verts[i]))
-                self.collision_polygons.append(p)
-
-        super().__init__(entity, self.collision_polygons, bvh=bvh, bvh_max_depth=bvh_max_depth, bvh_max_shapes=bvh_max_shapes, bvh_only_xz=bvh_only_xz, bvh_flatten=bvh_flatten)
+                collision_tree = self._build(triangles, bvh, bvh_max_depth, bvh_max_shapes, bvh_only_xz, bvh_flatten)
+                if cache:
+                    application.compressed_models_folder.mkdir(parents=True, exist_ok=True)
+                    collision_tree.writeBamFile(str(file_path))
+
+            _set_collide_mask(collision_tree, get_collide_mask(self._layers))
+            if shared:
+                entry = _shared_mesh_colliders[key] = [collision_tree, 0]
+
+        self._shared_key = None
+        if shared:
+            entry[1] += 1
+            self._shared_key = key
+            # the nodes are shared, so they can't have the Entity python tag. raycasts find the entity above them instead.
+            self.node_path = collision_tree.instanceTo(entity)
+        else:
+            self.node_path = collision_tree
+            self.node_path.reparentTo(entity)
+            stack = [self.node_path]
+            while len(stack) > 0:
+                node_path = stack.pop()
+                node_path.setPythonTag('Entity', entity)
+                for child in node_path.getChildren():
+                    stack.append(child)
+
+        self.collision_node = self.node_path.node()
+
+
+    def _build(self, triangles, bvh, bvh_max_depth, bvh_max_shapes, bvh_only_xz, bvh_flatten):
+        import numpy as np
+        # reverse the winding order, like the rest of ursina expects. one flat list per triangle is the fastest to convert.
+        self.collision_polygons.extend([CollisionPolygon(Point3(t[0], t[1], t[2]), Point3(t[3], t[4], t[5]), Point3(t[6], t[7], t[8]))
+            for t in triangles[:, ::-1].astype(np.float64).reshape(-1, 9).tolist()])
+
+        collision_tree = NodePath(CollisionNode('CollisionNode'))
+        if bvh:
+            collision_tree.node().setBoundsType(BoundingVolume.BT_box)
+            build_bvh(None, collision_tree, self.collision_polygons, max_depth=bvh_max_depth, max_solids=bvh_max_shapes, only_xz=bvh_only_xz, flatten=bvh_flatten,
+                centroids=triangles.mean(axis=1))
+        else:
+            for e in self.collision_polygons:
+                collision_tree.node().addSolid(e)
+
+        return collision_tree
+
+
+    @staticmethod
+    def _get_cache_name(mesh, triangles, *bvh_settings):
+        import hashlib
+        name = str(mesh.name).replace('.', '_') if mesh.name else 'mesh'
+        content_hash = hashlib.md5(triangles.tobytes() + str(bvh_settings).encode()).hexdigest()[:12]
+        return f'{name}_collider_{content_hash}'
+
+
+    def _load(self, file_path):
+        import builtins
+        loaded = builtins.loader.loadModel(str(file_path), noCache=True)
+        collision_tree = loaded if isinstance(loaded.node(), CollisionNode) else loaded.getChild(0)
+        collision_tree.detachNode()
+        return collision_tree
+
+
+    @property
+    def layers(self):
+        return self._layers
+
+    @layers.setter
+    def layers(self, value):
+        if self.shared and value != self._layers:   # the nodes are shared with other entities, so change the layers of a copy instead
+            node_path = self.node_path.copyTo(self.node_path.getParent())
+            self.node_path.removeNode()
+            self.node_path = node_path
+            self.collision_node = node_path.node()
+            self.shared = False
+            _release_shared_mesh_collider(self._shared_key)
+            self._shared_key = None
+        Collider.layers.fset(self, value)
 
 
     def remove(self):
-        self.node_path.node().clearSolids()
-        self.collision_polygons.clear()
+        if self.shared:
+            _release_shared_mesh_collider(self._shared_key)
+            self._shared_key = None
+        else:
+            self.node_path.node().clearSolids()
+            self.collision_polygons.clear()
         self.node_path.removeNode()
 
 
-
 if __name__ == '__main__':
     from ursina import *
     from ursina import Ursina, Entity, Pipe, Circle, Button, scene, EditorCamera, color
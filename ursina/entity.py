@@ -15,7 +15,8 @@ from panda3d.core import TextureStage
 from panda3d.core import CullFaceAttrib
 
 from ursina import application
-from ursina.collider import Collider, BoxCollider, SphereCollider, MeshCollider, CapsuleCollider
+from ursina.collider import Collider, BoxCollider, SphereCollider, MeshCollider, CapsuleCollider, get_collide_mask
+from ursina.spatial_query import spatial_grid
 from ursina.mesh import Mesh
 from ursina.sequence import Sequence, Func, Wait
 from ursina.ursinamath import lerp
@@ -102,7 +103,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
 
 
         # make sure things get set in the correct order. both colliders and texture need the model to be set first.
-        for key in ('model', 'origin', 'origin_x', 'origin_y', 'origin_z', 'collider', 'shader', 'texture', 'texture_scale', 'texture_offset'):
+        for key in ('model', 'origin', 'origin_x', 'origin_y', 'origin_z', 'layers', 'collider', 'shader', 'texture', 'texture_scale', 'texture_offset'):
             if key in kwargs:
                 setattr(self, key, kwargs[key])
                 del kwargs[key]
@@ -215,6 +216,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
                 print_warning(f"missing model: '{value}'")
                 return
 
+        self._shared_model = isinstance(value, str)     # models loaded by name share their nodes with the other entities using the same model
         if self._model:
             self._model.reparentTo(self)
             self._model.setTransparency(TransparencyAttrib.M_dual)
@@ -224,6 +226,43 @@ class Entity(NodePath, metaclass=PostInitCaller):
             if isinstance(value, Mesh):
                 if hasattr(value, 'on_assign'):
                     value.on_assign(assigned_to=self)
+            if getattr(self, '_lods_setting', None):
+                self.lods = self._lods_setting    # reapply lods to the new model
+
+
+    def lods_getter(self):
+        return getattr(self, '_lods', [])
+
+    def lods_setter(self, value):   # list of lower detail models, or the number of levels to generate from the model. see lod_distances.
+        from ursina.scripts.lod import generate_lods, apply_lods
+        if value and self.model and getattr(self, '_shared_model', False):    # apply_lods() changes the model's nodes, so give this entity its own copy first
+            from copy import deepcopy
+            self._lods_setting = None   # so the model setter doesn't apply them to the copy as well
+            model = deepcopy(self.model)
+            model.name = self.model.name
+            self.model = model
+
+        self._lods_setting = value
+        if not value:
+            value = []
+        elif isinstance(value, int):
+            value = generate_lods(self.model, levels=value) if self.model else []
+        else:
+            value = [load_model(e) if isinstance(e, str) else e for e in value]
+
+        self._lods = value
+        if self.model:
+            apply_lods(self.model, value, self.lod_distances)
+
+
+    def lod_distances_getter(self):
+        return getattr(self, '_lod_distances', [20 * 2**i for i in range(len(self.lods))])
+
+    def lod_distances_setter(self, value):  # distance from the camera where each lod starts being used.
+        self._lod_distances = list(value)
+        if self.model and self.lods and len(self._lod_distances) == len(self.lods):
+            from ursina.scripts.lod import apply_lods
+            apply_lods(self.model, self.lods, self._lod_distances)
 
 
     def color_getter(self):
@@ -281,6 +320,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
         #     value = scene
         self.reparent_to(value)
         self.enabled = self.enabled   # parenting will undo the .stash() done when setting .enabled to False, so reapply it here
+        spatial_grid.mark_dirty(self)
 
 
     def loose_parent_getter(self):
@@ -310,6 +350,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
         self.wrtReparentTo(value)
         self.enabled = self._enabled   # parenting will undo the .stash() done when setting .enabled to False, so reapply it here
         self._parent = value
+        spatial_grid.mark_dirty(self)
 
 
     @property
@@ -395,6 +436,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
 
 
         self.collision = bool(self.collider)
+        spatial_grid.mark_dirty(self)
         return
 
     def collision_getter(self):
@@ -402,6 +444,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
 
     def collision_setter(self, value):  # toggle collision without changing collider.
         self._collision = value
+        spatial_grid.mark_dirty(self)
         if not hasattr(self, 'collider') or not self.collider:
             if self in scene.collidables:
                 scene.collidables.remove(self)
@@ -416,6 +459,30 @@ class Entity(NodePath, metaclass=PostInitCaller):
                 scene.collidables.remove(self)
 
 
+    def layers_getter(self):
+        return getattr(self, '_layers', 'default')
+
+    def layers_setter(self, value):  # collision layer name or list of names. raycast(), boxcast() and intersects() with layers= only hit entities in those layers.
+        self._layers = value
+        if self.collider:
+            self.collider.layers = value
+        spatial_grid.mark_dirty(self)
+
+
+    def ccd_getter(self):
+        return getattr(self, '_ccd', False)
+
+    def ccd_setter(self, value):    # continuous collision detection. sweeps the movement since last frame, so fast entities don't go through thin colliders. see ccd.py
+        from ursina.ccd import CCDSystem
+        self._ccd = value
+        if value:
+            self.ccd_hit = None
+            self.ccd_time_of_impact = None
+            CCDSystem.get().add(self)
+        elif CCDSystem.instance:
+            CCDSystem.instance.remove(self)
+
+
     def on_click_getter(self):
         return getattr(self, '_on_click', None)
 
@@ -465,6 +532,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
             value = Vec3(*value, self.z)
 
         self.setPos(scene, Vec3(value[0], value[1], value[2]))
+        spatial_grid.mark_dirty(self)
 
     def world_x_getter(self):
         return self.getX(scene)
@@ -475,10 +543,13 @@ class Entity(NodePath, metaclass=PostInitCaller):
 
     def world_x_setter(self, value):
         self.setX(scene, value)
+        spatial_grid.mark_dirty(self)
     def world_y_setter(self, value):
         self.setY(scene, value)
+        spatial_grid.mark_dirty(self)
     def world_z_setter(self, value):
         self.setZ(scene, value)
+        spatial_grid.mark_dirty(self)
 
     def position_getter(self):
         return Vec3(*self.getPos())
@@ -490,21 +561,25 @@ class Entity(NodePath, metaclass=PostInitCaller):
             value = Vec3(*value, self.z)
 
         self.setPos(value[0], value[1], value[2])
+        spatial_grid.mark_dirty(self)
 
     def x_getter(self):
         return self.getX()
     def x_setter(self, value):
         self.setX(value)
+        spatial_grid.mark_dirty(self)
 
     def y_getter(self):
         return self.getY()
     def y_setter(self, value):
         self.setY(value)
+        spatial_grid.mark_dirty(self)
 
     def z_getter(self):
         return self.getZ()
     def z_setter(self, value):
         self.setZ(value)
+        spatial_grid.mark_dirty(self)
 
     @property
     def X(self):    # shortcut for int(entity.x)
@@ -522,6 +597,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
 
     def world_rotation_setter(self, value):
         self.setHpr(scene, Vec3(value[1], value[0], value[2]) * Entity.rotation_directions)
+        spatial_grid.mark_dirty(self)
 
     def world_rotation_x_getter(self):
         return self.world_rotation[0]
@@ -552,6 +628,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
             value = Vec3(*value, self.rotation_z)
 
         self.setHpr(Vec3(value[1], value[0], value[2]) * Entity.rotation_directions)
+        spatial_grid.mark_dirty(self)
 
     def rotation_x_getter(self):
         return self.rotation.x
@@ -572,6 +649,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
         return self.get_quat()
     def quaternion_setter(self, value):
         self.set_quat(value)
+        spatial_grid.mark_dirty(self)
 
     def world_scale_getter(self):
         return Vec3(*self.getScale(scene))
@@ -582,21 +660,25 @@ class Entity(NodePath, metaclass=PostInitCaller):
             value = Vec3(*value, self.scale_z)
 
         self.setScale(scene, value)
+        spatial_grid.mark_dirty(self)
 
     def world_scale_x_getter(self):
         return self.getScale(scene)[0]
     def world_scale_x_setter(self, value):
         self.setScale(scene, Vec3(value, self.world_scale_y, self.world_scale_z))
+        spatial_grid.mark_dirty(self)
 
     def world_scale_y_getter(self):
         return self.getScale(scene)[1]
     def world_scale_y_setter(self, value):
         self.setScale(scene, Vec3(self.world_scale_x, value, self.world_scale_z))
+        spatial_grid.mark_dirty(self)
 
     def world_scale_z_getter(self):
         return self.getScale(scene)[2]
     def world_scale_z_setter(self, value):
         self.setScale(scene, Vec3(self.world_scale_x, self.world_scale_y, value))
+        spatial_grid.mark_dirty(self)
 
     def scale_getter(self):
         scale = self.getScale()
@@ -610,21 +692,25 @@ class Entity(NodePath, metaclass=PostInitCaller):
 
         value = [e if e!=0 else .001 for e in value]
         self.setScale(value[0], value[1], value[2])
+        spatial_grid.mark_dirty(self)
 
     def scale_x_getter(self):
         return self.scale[0]
     def scale_x_setter(self, value):
         self.setScale(value, self.scale_y, self.scale_z)
+        spatial_grid.mark_dirty(self)
 
     def scale_y_getter(self):
         return self.scale[1]
     def scale_y_setter(self, value):
         self.setScale(self.scale_x, value, self.scale_z)
+        spatial_grid.mark_dirty(self)
 
     def scale_z_getter(self):
         return self.scale[2]
     def scale_z_setter(self, value):
         self.setScale(self.scale_x, self.scale_y, value)
+        spatial_grid.mark_dirty(self)
 
     def transform_getter(self): # get/set position, rotation and scale
         return (self.position, self.rotation, self.scale)
@@ -893,6 +979,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
 
     def set_position(self, value, relative_to=scene): # set position relative to on other Entity. In most cases, use .position instead.
         self.setPos(relative_to, Vec3(value[0], value[1], value[2]))
+        spatial_grid.mark_dirty(self)
 
 
     def rotate(self, value, relative_to=None):  # rotate around local axis.
@@ -900,6 +987,7 @@ class Entity(NodePath, metaclass=PostInitCaller):
             relative_to = self
 
         self.setHpr(relative_to, Vec3(value[1], value[0], value[2]) * Entity.rotation_directions)
+        spatial_grid.mark_dirty(self)
 
 
     def add_script(self, class_instance):
@@ -913,10 +1001,10 @@ class Entity(NodePath, metaclass=PostInitCaller):
             return class_instance
 
 
-    def combine(self, analyze=False, auto_destroy=True, ignore=[]):
+    def combine(self, analyze=False, auto_destroy=True, ignore=[], include_normals=True):
         from ursina.scripts.combine import combine
 
-        self.model = combine(self, analyze, auto_destroy, ignore)
+        self.model = combine(self, analyze, auto_destroy, ignore, include_normals=include_normals)
         return self.model
 
 
@@ -1183,21 +1271,20 @@ class Entity(NodePath, metaclass=PostInitCaller):
 
 
 
-    def intersects(self, traverse_target=scene, ignore:list=None, debug=False):
+    def intersects(self, traverse_target=scene, ignore:list=None, debug=False, layers=None, first_hit_only=False, hit_info=None):
         if not ignore:
             ignore = []
-        ignore = list(ignore)
+        ignore = set(ignore)
 
         if isinstance(self.collider, MeshCollider):
             raise Exception('''error: mesh colliders can't intersect other shapes, only primitive shapes can. Mesh colliders can "receive" collisions though.''')
 
-        from ursina.hit_info import HitInfo
+        from ursina.hit_info import HitInfo, hit_info_from_entries
 
         if not self.collision or not self.collider:
-            self.hit = HitInfo(hit=False)
+            self.hit = hit_info.reset(hit=False) if hit_info is not None else HitInfo(hit=False)
             return self.hit
 
-        from ursina import distance
         if not hasattr(self, '_picker'):
             from panda3d.core import CollisionTraverser, CollisionNode, CollisionHandlerQueue
 
@@ -1215,42 +1302,17 @@ class Entity(NodePath, metaclass=PostInitCaller):
         else:
             self._pickerNP.hide()
 
+        # entities in other layers and entities with collision off (their collider gets stashed) are skipped during the traversal
+        self._pickerNode.set_from_collide_mask(get_collide_mask(layers))
         self._picker.traverse(traverse_target)
 
         if self._pq.get_num_entries() == 0:
-            self.hit = HitInfo(hit=False)
+            self.hit = hit_info.reset(hit=False) if hit_info is not None else HitInfo(hit=False)
             return self.hit
 
-        ignore.append(self)
-        ignore.extend((e for e in scene.entities if not e.collision))
-
+        ignore.add(self)
         self._pq.sort_entries()
-        entries = self._pq.getEntries()
-        entities = [e.get_into_node_path().parent.getPythonTag('Entity') for e in entries]
-
-        entries = [        # filter out ignored entities
-            e for i, e in enumerate(entries)
-            if entities[i] in scene.collidables
-            and entities[i] not in ignore
-            ]
-
-        if len(entries) == 0:
-            return HitInfo(hit=False)
-
-        hit_info = HitInfo(hit=True)
-        hit_info.entities = [e.get_into_node_path().parent.getPythonTag('Entity') for e in entries]
-        hit_info.entity = hit_info.entities[0]
-
-        collision = entries[0]
-        # nP = collision.get_into_node_path().parent
-        hit_info.point = Vec3(*collision.get_surface_point(hit_info.entity))
-        hit_info.world_point = Vec3(*collision.get_surface_point(scene))
-        hit_info.distance = distance(self.world_position, hit_info.world_point)
-        hit_info.normal = Vec3(*collision.get_surface_normal(collision.get_into_node_path().parent).normalized())
-        hit_info.world_normal = Vec3(*collision.get_surface_normal(scene).normalized())
-
-        return hit_info
-
+        return hit_info_from_entries(self._pq.getEntries(), self.getPos(builtins.render), ignore=ignore, first_hit_only=first_hit_only, hit_info=hit_info)
 
 
 if __name__ == '__main__':
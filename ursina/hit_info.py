@@ -1,22 +1,247 @@
 class HitInfo:
-    __slots__ = ['hit', 'entity', 'point', 'world_point', 'distance', 'normal', 'world_normal', 'hits', 'entities']
+    ''' hit and distance are set right away. point, world_point, normal, world_normal and entities
+    get computed from the collision entry the first time they're accessed.
+    '''
+    __slots__ = ['hit', 'entity', 'distance', 'hits', '_point', '_world_point', '_normal', '_world_normal', '_entities', '_entry', '_get_entities']
 
 
     def __init__(self, **kwargs):
+        self.hits = []
+        self.reset(**kwargs)
+
 
+    def reset(self, **kwargs):  # clear all the fields, so the same HitInfo can be reused instead of making a new one every time. returns itself.
         self.hit = None
         self.entity = None
-        self.point = None
-        self.world_point = None
         self.distance = 9999
-        self.normal = None
-        self.world_normal = None
-        self.hits = []
-        self.entities = []
+        self._point = None
+        self._world_point = None
+        self._normal = None
+        self._world_normal = None
+        self._entities = None
+        self._entry = None          # the CollisionEntry to compute the points and normals from
+        self._get_entities = None   # function to compute the entities list from
 
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+        return self
+
+
+    @property
+    def _local_space(self):
+        return self.entity if self.entity is not None else self._entry.get_into_node_path().parent
+
+
+    @property
+    def point(self):
+        if self._point is None and self._entry is not None:
+            from ursina.vec3 import Vec3
+            self._point = Vec3(*self._entry.get_surface_point(self._local_space))
+        return self._point
+
+    @point.setter
+    def point(self, value):
+        self._point = value
+
+
+    @property
+    def world_point(self):
+        if self._world_point is None and self._entry is not None:
+            import builtins
+            from ursina.vec3 import Vec3
+            self._world_point = Vec3(*self._entry.get_surface_point(builtins.render))
+        return self._world_point
+
+    @world_point.setter
+    def world_point(self, value):
+        self._world_point = value
+
+
+    @property
+    def normal(self):
+        if self._normal is None and self._entry is not None:
+            from ursina.vec3 import Vec3
+            self._normal = Vec3(*self._entry.get_surface_normal(self._local_space).normalized())
+        return self._normal
+
+    @normal.setter
+    def normal(self, value):
+        self._normal = value
+
+
+    @property
+    def world_normal(self):
+        if self._world_normal is None and self._entry is not None:
+            import builtins
+            from ursina.vec3 import Vec3
+            self._world_normal = Vec3(*self._entry.get_surface_normal(builtins.render).normalized())
+        return self._world_normal
+
+    @world_normal.setter
+    def world_normal(self, value):
+        self._world_normal = value
+
+
+    @property
+    def entities(self): # all the entities hit, sorted by distance
+        if self._entities is None:
+            if self._get_entities is not None:
+                self._entities = self._get_entities()
+                self._get_entities = None
+            elif self.entity is not None:
+                self._entities = [self.entity, ]
+            else:
+                self._entities = []
+        return self._entities
+
+    @entities.setter
+    def entities(self, value):
+        self._entities = value
+
 
     def __bool__(self):
         return self.hit
+
+
+def hit_info_from_entries(entries, origin, max_distance=9999, ignore=(), first_hit_only=False, hit_info=None):
+    ''' Fills hit_info (or a new HitInfo) with the closest entry that isn't ignored. entries must be sorted by distance
+    and origin in world space. The entity lookup of the rest of the entries is only done if .entities gets used,
+    or not at all with first_hit_only.
+    '''
+    import builtins
+    from ursina.scene import instance as scene
+
+    if hit_info is None:
+        hit_info = HitInfo()
+
+    def get_entity(entry):
+        entity = entry.get_into_node_path().getNetPythonTag('Entity')
+        if entity not in scene.collidables or entity in ignore:
+            return None
+        return entity
+
+    for i, entry in enumerate(entries):
+        entity = get_entity(entry)
+        if entity is None:
+            continue
+
+        distance = (entry.get_surface_point(builtins.render) - origin).length()
+        if distance > max_distance:     # the entries are sorted, so the rest are too far away as well
+            break
+
+        hit_info.reset(hit=True, entity=entity, distance=distance, _entry=entry)
+        if not first_hit_only:
+            def get_entities(entity=entity, rest=entries[i+1:]):
+                entities = [entity, ]
+                for entry in rest:
+                    e = get_entity(entry)
+                    if e is not None and (entry.get_surface_point(builtins.render) - origin).length() <= max_distance:
+                        entities.append(e)
+                return entities
+
+            hit_info._get_entities = get_entities
+        return hit_info
+
+    return hit_info.reset(hit=False, distance=max_distance)
+
+
+class BatchHitInfo:
+    ''' Results of raycast_batch() as one numpy array per field, with one row per ray.
+    entity_index is -1 for rays that didn't hit anything, otherwise an index into entities.
+    '''
+    __slots__ = ['hit', 'distance', 'world_point', 'world_normal', 'entity_index', 'entities']
+
+
+    def __init__(self, **kwargs):
+
+        self.hit = None
+        self.distance = None
+        self.world_point = None
+        self.world_normal = None
+        self.entity_index = None
+        self.entities = []
+
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+    def __len__(self):
+        return len(self.hit)
+
+
+    def __getitem__(self, i): # get the result of a single ray as a HitInfo
+        from ursina.vec3 import Vec3
+        if not self.hit[i]:
+            return HitInfo(hit=False, distance=float(self.distance[i]))
+
+        entity = self.entities[self.entity_index[i]]
+        return HitInfo(hit=True, entity=entity, entities=[entity, ], distance=float(self.distance[i]),
+            world_point=Vec3(*self.world_point[i]), world_normal=Vec3(*self.world_normal[i]))
+
+
+def batch_hit_info_from_entries(entries, origins, distances, ignore=(), limit_distance=True, ignore_per_cast=None):
+    ''' Makes a BatchHitInfo with the closest entry for each of the casts. The from node paths of the entries must have
+    their index in origins as the 'batch_index' python tag. origins is a numpy array of shape (n,3) in world space and
+    distances of shape (n,), which entries further away than get skipped if limit_distance is True.
+    ignore_per_cast is an optional list with an entity (or None) for each cast, which only that cast will ignore.
+    '''
+    import builtins
+    import numpy as np
+    from ursina.scene import instance as scene
+
+    n = len(origins)
+    distances = np.array(distances, dtype=np.float64)
+    ignore = set(ignore) if ignore else set()
+    entities = []
+    entity_indices = dict()
+    cast_indices, points, normals, hit_entity_indices = [], [], [], []
+
+    for entry in entries:
+        entity = entry.get_into_node_path().getNetPythonTag('Entity')
+        if entity not in scene.collidables or entity in ignore:
+            continue
+
+        cast_index = entry.get_from_node_path().getPythonTag('batch_index')
+        if ignore_per_cast is not None and ignore_per_cast[cast_index] is entity:
+            continue
+
+        if entity not in entity_indices:
+            entity_indices[entity] = len(entities)
+            entities.append(entity)
+
+        cast_indices.append(cast_index)
+        points.append(entry.get_surface_point(builtins.render))
+        normals.append(entry.get_surface_normal(builtins.render))
+        hit_entity_indices.append(entity_indices[entity])
+
+    hit = np.zeros(n, dtype=bool)
+    world_point = np.zeros((n, 3))
+    world_normal = np.zeros((n, 3))
+    entity_index = np.full(n, -1, dtype=np.int64)
+
+    if cast_indices:
+        cast_indices = np.asarray(cast_indices, dtype=np.int64)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+        hit_entity_indices = np.asarray(hit_entity_indices, dtype=np.int64)
+        entry_distances = np.linalg.norm(points - origins[cast_indices], axis=1)
+        if limit_distance:
+            in_range = entry_distances <= distances[cast_indices]
+            cast_indices, points, normals, entry_distances = cast_indices[in_range], points[in_range], normals[in_range], entry_distances[in_range]
+            hit_entity_indices = hit_entity_indices[in_range]
+
+        # sort the entries by cast, then by distance, and keep the closest one for each cast
+        order = np.lexsort((entry_distances, cast_indices))
+        closest = order[np.unique(cast_indices[order], return_index=True)[1]]
+        casts = cast_indices[closest]
+
+        hit[casts] = True
+        distances[casts] = entry_distances[closest]
+        world_point[casts] = points[closest]
+        normal_lengths = np.linalg.norm(normals[closest], axis=1, keepdims=True)
+        normal_lengths[normal_lengths == 0] = 1
+        world_normal[casts] = normals[closest] / normal_lengths
+        entity_index[casts] = hit_entity_indices[closest]
+
+    return BatchHitInfo(hit=hit, distance=distances, world_point=world_point, world_normal=world_normal, entity_index=entity_index, entities=entities)
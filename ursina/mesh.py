@@ -380,8 +380,8 @@ class Mesh(p3d.NodePath):
     def thickness(self, value):
         self.setRenderModeThickness(value)
 
-    def generate_normals(self, smooth=True, regenerate=True):
-        self.normals = list(generate_normals(self.vertices, self.triangles, smooth))
+    def generate_normals(self, smooth=True, regenerate=True, smooth_angle=None, weighting=None):
+        self.normals = generate_normals(self.vertices, self.indices, smooth, smooth_angle=smooth_angle, weighting=weighting).tolist()
         if regenerate:
             self.generate()
         return self.normals
@@ -20,12 +20,11 @@ import inspect
 
 import socket
 import ssl
-import select
-import errno
 
 import struct
 
 import time
+import random
 
 import atexit
 import signal
@@ -37,33 +36,46 @@ import asyncio
 # It can be hashed and compared so that it may be used as a dictionary key.
 # This is useful for mapping from a connection to player data.
 class Connection:
-    def __init__(self, peer, socket, address, connection_timeout):
+    def __init__(self, peer, transport, address, connection_timeout):
         self.peer = peer
-        self.socket = socket
+        self.transport = transport
+        self.socket = transport.get_extra_info("socket")
         self.address = address
 
         self.connection_timeout = connection_timeout
+        self.last_receive_time = None
+        self.timeout_handle = None
+
+        # Messages sent since the networking thread last woke up, as (length prefix, data), written together in one go.
+        # If more than high_water_mark bytes pile up, because the socket can't keep up, drop_policy decides what happens.
+        self.high_water_mark = peer.high_water_mark
+        self.drop_policy = peer.drop_policy
+        self.pending_messages = deque()
+        self.pending_byte_count = 0
+        self.dropped_message_count = 0
+        self.writing_paused = False
 
         self.connected = True
         self.timed_out = False
 
-        self.state = "l"
-        self.length_byte_count = 2
-        self.expected_byte_count = self.length_byte_count
-        self.bytes_received = bytearray()
+        # Received bytes that haven't been split into messages yet are in receive_buffer[receive_start:receive_end].
+        self.receive_buffer = bytearray(peer.receive_buffer_size)
+        self.receive_start = 0
+        self.receive_end = 0
+        self.expected_frame_size = 0    # size of the message that's only been partly received
 
         self.uid = str(uuid.uuid4())
 
-        self.async_task = None
-
     def __hash__(self):
         return hash(self.uid)
 
     def __eq__(self, other):
         return self.uid == other.uid
 
-    def send(self, data):
-        self.peer.send(self, data)
+    def send(self, data, channel=None, stream=0):
+        if channel is None:
+            channel = Channel.RELIABLE_ORDERED
+        self.peer.send(self, data, channel, stream)
 
     def disconnect(self):
         self.peer.disconnect(self)
@@ -75,6 +87,14 @@ class Connection:
         return self.connected
 
 
+_u16_struct = struct.Struct(">H")
+_u32_struct = struct.Struct(">I")
+_i16_struct = struct.Struct(">h")
+_i32_struct = struct.Struct(">i")
+_blob_length_struct = struct.Struct("<H")        # panda3d writes these two lengths little endian
+_string32_length_struct = struct.Struct("<I")
+
+
 # Used internally by Peer.
 class PeerEvent(Enum):
     ERROR = auto()
@@ -91,6 +111,301 @@ class PeerInput(Enum):
     DISCONNECT_ALL = auto()
 
 
+# Used internally by Peer.
+# One per connection, asyncio calls it when the connection is made, when data arrives and when it's lost,
+# so nothing has to poll the sockets. Data gets received straight into the connection's receive buffer.
+class PeerProtocol(asyncio.BufferedProtocol):
+    def __init__(self, peer):
+        self.peer = peer
+        self.connection = None
+
+    def connection_made(self, transport):
+        self.connection = self.peer._add_connection(transport, transport.get_extra_info("peername"))
+
+    def get_buffer(self, sizehint):
+        return self.peer._get_receive_buffer(self.connection)
+
+    def buffer_updated(self, nbytes):
+        self.peer._receive(self.connection, nbytes)
+
+    def connection_lost(self, exc):
+        self.peer._remove_connection(self.connection, exc)
+
+    def pause_writing(self):
+        self.connection.writing_paused = True
+
+    def resume_writing(self):
+        self.peer._resume_writing(self.connection)
+
+
+# Which guarantees a message sent over UDP gets. Over TCP everything is reliable and ordered.
+class Channel(Enum):
+    RELIABLE_ORDERED = 0        # always arrives, in the order it was sent, like with TCP.
+    UNRELIABLE_SEQUENCED = 1    # might get lost, and gets dropped if a newer message on the same stream already arrived. Good for state updates.
+    UNRELIABLE = 2              # might get lost or arrive out of order.
+
+
+# Used internally by the UDP transport.
+class UDPPacketType(Enum):
+    CONNECT = 0
+    ACCEPT = 1
+    DATA = 2
+    DISCONNECT = 3
+
+
+UDP_PROTOCOL_ID = 0x5552
+_udp_header_struct = struct.Struct(">HB")               # protocol id, packet type
+_udp_nonce_struct = struct.Struct(">I")
+_udp_data_header_struct = struct.Struct(">HBHI")        # packet sequence, has ack, ack, ack bits
+_udp_message_header_struct = struct.Struct(">BBHBH")    # channel, stream, sequence, flags, length
+_udp_packet_header_size = _udp_header_struct.size + _udp_data_header_struct.size
+_udp_fragment_flag = 1
+
+
+def _sequence_greater_than(a, b): # compares 16 bit sequence numbers that wrap around
+    return ((a > b) and (a - b <= 32768)) or ((a < b) and (b - a > 32768))
+
+
+# Used internally by Peer.
+class UDPPeerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, peer):
+        self.peer = peer
+
+    def datagram_received(self, data, address):
+        self.peer._udp_datagram_received(data, address)
+
+    def error_received(self, exc):
+        pass    # for example when the other side isn't listening (yet). the handshake and timeouts take care of that.
+
+
+# Used internally by Peer.
+# Stands in for the asyncio transport of a TCP connection when using UDP, so Peer can treat both the same way.
+# Messages get packed into packets of at most mtu bytes. Every packet has a sequence number and acknowledges the
+# last 33 packets received from the other side. Reliable messages get sent again until a packet carrying them gets
+# acknowledged, and are split into fragments if they don't fit in a single packet.
+class UDPConnectionTransport:
+    def __init__(self, peer, address, send_address):
+        self.peer = peer
+        self.address = address
+        self.send_address = send_address    # None for a client, since its socket is connected to the host already
+        self.connection = None
+        self.connect_nonce = None
+        self.closed = False
+
+        self.next_packet_sequence = 0
+        self.remote_sequence = None     # latest packet received
+        self.received_bits = 0          # which of the 32 packets before it were received
+        self.ack_pending = False
+        self.sent_packets = dict()      # packet sequence -> (time sent, reliable sequences in it)
+
+        self.next_reliable_sequence = 0
+        self.unacked_messages = dict()  # reliable sequence -> [encoded message, time last sent]
+        self.new_messages = deque()     # (encoded message, reliable sequence or None)
+        self.next_stream_sequences = dict()
+
+        self.expected_reliable_sequence = 0
+        self.early_reliable_messages = dict()   # reliable sequence -> (flags, payload), for messages that arrived before the ones before them
+        self.fragments = bytearray()
+        self.last_stream_sequences = dict()
+
+        self.round_trip_time = 0.1
+        self.last_send_time = 0
+        self.flush_handle = None
+        self.flush_time = None
+        self.keepalive_handle = None
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self.address
+        return self.peer.udp_endpoint.get_extra_info(name, default)
+
+    def write_messages(self, messages):
+        max_payload_size = self.peer.udp_mtu - _udp_packet_header_size - _udp_message_header_struct.size
+        for _, data, channel, stream in messages:
+            if channel == Channel.RELIABLE_ORDERED:
+                chunks = [data[i:i+max_payload_size] for i in range(0, len(data), max_payload_size)] or [data]
+                for i, chunk in enumerate(chunks):
+                    sequence = self.next_reliable_sequence
+                    self.next_reliable_sequence = (sequence + 1) & 0xFFFF
+                    flags = _udp_fragment_flag if i < len(chunks) - 1 else 0
+                    self.new_messages.append((_udp_message_header_struct.pack(channel.value, 0, sequence, flags, len(chunk)) + chunk, sequence))
+            elif channel == Channel.UNRELIABLE_SEQUENCED:
+                sequence = self.next_stream_sequences.get(stream, 0)
+                self.next_stream_sequences[stream] = (sequence + 1) & 0xFFFF
+                self.new_messages.append((_udp_message_header_struct.pack(channel.value, stream, sequence, 0, len(data)) + data, None))
+            else:
+                self.new_messages.append((_udp_message_header_struct.pack(channel.value, stream, 0, 0, len(data)) + data, None))
+        self.flush()
+
+    def flush(self):
+        if self.closed:
+            return
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        now = self.peer.async_loop.time()
+        resend_time = max(self.peer.udp_min_resend_time, 2 * self.round_trip_time)
+
+        messages = [(item[0], sequence) for sequence, item in self.unacked_messages.items() if now - item[1] >= resend_time]
+        waiting = deque()
+        for message in self.new_messages:
+            if message[1] is not None and len(self.unacked_messages) >= self.peer.udp_max_reliable_in_flight:
+                waiting.append(message)
+                continue
+            messages.append(message)
+            if message[1] is not None:
+                self.unacked_messages[message[1]] = [message[0], now]
+        self.new_messages = waiting
+
+        if messages or self.ack_pending:
+            packet, reliable_sequences = [], []
+            size = _udp_packet_header_size
+            for encoded, sequence in messages:
+                if packet and size + len(encoded) > self.peer.udp_mtu:
+                    self._send_packet(packet, reliable_sequences, now)
+                    packet, reliable_sequences = [], []
+                    size = _udp_packet_header_size
+                packet.append(encoded)
+                size += len(encoded)
+                if sequence is not None:
+                    reliable_sequences.append(sequence)
+                    self.unacked_messages[sequence][1] = now
+            self._send_packet(packet, reliable_sequences, now)
+
+        if self.unacked_messages or self.new_messages:
+            self._schedule_flush(resend_time)
+
+    def _send_packet(self, messages, reliable_sequences, now):
+        sequence = self.next_packet_sequence
+        self.next_packet_sequence = (sequence + 1) & 0xFFFF
+        self.sent_packets.pop((sequence - 64) & 0xFFFF, None)  # too old to get acknowledged anymore
+        self.sent_packets[sequence] = (now, reliable_sequences)
+
+        has_ack = self.remote_sequence is not None
+        header = _udp_header_struct.pack(UDP_PROTOCOL_ID, UDPPacketType.DATA.value) + _udp_data_header_struct.pack(
+            sequence, has_ack, self.remote_sequence if has_ack else 0, self.received_bits)
+        self.peer._udp_send(b"".join((header, *messages)), self.send_address)
+        self.ack_pending = False
+        self.last_send_time = now
+
+    def _schedule_flush(self, delay):
+        when = self.peer.async_loop.time() + delay
+        if self.flush_handle is not None:
+            if self.flush_time <= when:
+                return
+            self.flush_handle.cancel()
+        self.flush_time = when
+        self.flush_handle = self.peer.async_loop.call_later(delay, self.flush)
+
+    def start_keepalive(self):
+        if self.closed:
+            return
+        if self.peer.async_loop.time() - self.last_send_time >= self.peer.udp_keepalive_interval:
+            self.ack_pending = True     # sends an empty packet, so the other side knows we're still here
+            self.flush()
+        self.keepalive_handle = self.peer.async_loop.call_later(self.peer.udp_keepalive_interval, self.start_keepalive)
+
+    def receive(self, data):
+        if len(data) < _udp_packet_header_size:
+            return
+        now = self.peer.async_loop.time()
+        if self.connection.connection_timeout is not None:
+            self.connection.last_receive_time = now
+        sequence, has_ack, ack, ack_bits = _udp_data_header_struct.unpack_from(data, _udp_header_struct.size)
+
+        if self.remote_sequence is None:
+            self.remote_sequence = sequence
+        elif _sequence_greater_than(sequence, self.remote_sequence):
+            shift = (sequence - self.remote_sequence) & 0xFFFF
+            self.received_bits = ((self.received_bits << shift) | (1 << (shift - 1))) & 0xFFFFFFFF if shift <= 32 else 0
+            self.remote_sequence = sequence
+        else:
+            difference = (self.remote_sequence - sequence) & 0xFFFF
+            if 1 <= difference <= 32:
+                self.received_bits |= 1 << (difference - 1)
+
+        if has_ack:
+            self._acknowledge(ack, now)
+            for i in range(32):
+                if ack_bits & (1 << i):
+                    self._acknowledge((ack - 1 - i) & 0xFFFF, now)
+
+        received = []
+        position = _udp_packet_header_size
+        view = memoryview(data)
+        while position + _udp_message_header_struct.size <= len(data):
+            channel, stream, message_sequence, flags, length = _udp_message_header_struct.unpack_from(data, position)
+            position += _udp_message_header_struct.size
+            payload = view[position:position+length]
+            position += length
+
+            if channel == Channel.RELIABLE_ORDERED.value:
+                if message_sequence == self.expected_reliable_sequence:
+                    if not self._receive_reliable(flags, payload, received):
+                        return
+                    self.expected_reliable_sequence = (self.expected_reliable_sequence + 1) & 0xFFFF
+                    while self.expected_reliable_sequence in self.early_reliable_messages:
+                        if not self._receive_reliable(*self.early_reliable_messages.pop(self.expected_reliable_sequence), received):
+                            return
+                        self.expected_reliable_sequence = (self.expected_reliable_sequence + 1) & 0xFFFF
+                elif _sequence_greater_than(message_sequence, self.expected_reliable_sequence) and ((message_sequence - self.expected_reliable_sequence) & 0xFFFF) < 2 * self.peer.udp_max_reliable_in_flight:
+                    self.early_reliable_messages[message_sequence] = (flags, bytes(payload))
+            elif channel == Channel.UNRELIABLE_SEQUENCED.value:
+                last_sequence = self.last_stream_sequences.get(stream)
+                if last_sequence is None or _sequence_greater_than(message_sequence, last_sequence):
+                    self.last_stream_sequences[stream] = message_sequence
+                    received.append(bytes(payload))
+            else:
+                received.append(bytes(payload))
+
+        if position > _udp_packet_header_size:  # only acknowledge packets with messages, so acks don't get acknowledged forever
+            self.ack_pending = True
+            self._schedule_flush(self.peer.udp_ack_delay)
+
+        if received:
+            self.peer._queue_received(self.connection, received, time.time())
+
+    def _receive_reliable(self, flags, payload, received):
+        if flags & _udp_fragment_flag or self.fragments:
+            self.fragments += payload
+            if len(self.fragments) > self.peer.max_message_size:
+                print("WARNING: Received a message larger than max_message_size, disconnecting...")
+                self.close()
+                return False
+            if not flags & _udp_fragment_flag:
+                received.append(bytes(self.fragments))
+                self.fragments.clear()
+            return True
+
+        received.append(bytes(payload))
+        return True
+
+    def _acknowledge(self, sequence, now):
+        sent_packet = self.sent_packets.pop(sequence, None)
+        if sent_packet is None:
+            return
+        self.round_trip_time = self.round_trip_time * .9 + (now - sent_packet[0]) * .1
+        for reliable_sequence in sent_packet[1]:
+            self.unacked_messages.pop(reliable_sequence, None)
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        for i in range(3):  # it might get lost, the other side will time out then
+            self.peer._udp_send(_udp_header_struct.pack(UDP_PROTOCOL_ID, UDPPacketType.DISCONNECT.value), self.send_address)
+        self.abort()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        for handle in (self.flush_handle, self.keepalive_handle):
+            if handle is not None:
+                handle.cancel()
+        self.peer._udp_session_closed(self)
+
+
 # -- Description --
 # The main driving class of the networking module.
 # This is either a server or a client depending on if it's hosting or not.
@@ -105,19 +420,49 @@ class PeerInput(Enum):
 # The client can make use of a given path to a certificate authority bundle for testing / development / self signed.
 # -- Address family --
 # The socket address family can be either "INET" (ipv4) or "INET6" (ipv6).
+# -- Write buffers --
+# Messages sent during a frame get written to the socket together, with a single write per connection.
+# If a connection can't keep up, its messages wait in its buffer. high_water_mark limits how many bytes can wait
+# (None for no limit) and drop_policy decides what happens past it: "disconnect" the connection, "drop_oldest"
+# or "drop_newest" messages. Both can also be changed per connection.
+# multicast() sends the same data to many connections, sharing one copy of the message between their buffers.
+# -- Message length --
+# Each message starts with its length, as a 16 bit integer by default, which limits messages to 65535 bytes.
+# Set length_prefix to "u32" or "varint" for larger messages. Both sides have to use the same one.
+# max_message_size is the largest message that will be accepted before disconnecting.
+# -- UDP --
+# Set use_udp=True to send over UDP instead of TCP, so a lost packet doesn't hold up every message after it.
+# send() then takes a channel: Channel.RELIABLE_ORDERED (the default, works like TCP), Channel.UNRELIABLE_SEQUENCED
+# or Channel.UNRELIABLE. Sequenced messages only get compared to messages on the same stream (0-255).
+# Unreliable messages have to fit in a single packet of udp_mtu bytes. Both sides have to use UDP, and TLS isn't supported with it.
+# Without connection_timeout, UDP connections time out after 10 seconds without hearing from the other side.
+# simulated_packet_loss (0-1), simulated_latency and simulated_jitter (seconds) make outgoing packets get lost
+# and delayed on purpose, for testing over localhost.
+# -- Update --
+# update() calls the callbacks for up to max_events events (None for no limit). With time_budget (in seconds),
+# it stops once that much time has passed and leaves the rest for the next update, but always handles at least one event.
+# data_decoder can be set to a function (connection, data) that gets called on the networking thread for each message,
+# and whatever it returns gets passed to on_raw_data and on_data instead of the data. It must not raise exceptions.
 # -- Notes --
 # Keep in mind that the networking in running on its own thread and you must therefore check if it's running (is_running).
+# The networking thread runs an asyncio event loop that only wakes up when a socket has data
+# or when send, disconnect or stop get called, instead of polling.
 class Peer:
     def __init__(self, on_connect=None, on_disconnect=None, on_data=None, on_raw_data=None,
                  connection_timeout=None,
                  use_tls=False,
                  path_to_certchain=None, path_to_private_key=None,
                  path_to_cabundle=None,
-                 socket_address_family="INET"):
+                 socket_address_family="INET",
+                 high_water_mark=None, drop_policy="disconnect",
+                 length_prefix="u16", max_message_size=2**24,
+                 use_udp=False, udp_mtu=1200,
+                 simulated_packet_loss=0, simulated_latency=0, simulated_jitter=0):
         self.on_connect = on_connect
         self.on_disconnect = on_disconnect
         self.on_data = on_data
         self.on_raw_data = on_raw_data
+        self.data_decoder = None
         self.connection_timeout = connection_timeout
         self.use_tls = use_tls
         self.path_to_certchain = path_to_certchain
@@ -129,6 +474,33 @@ class Peer:
             self.socket_address_family = socket.AF_INET6
         else:
             raise Exception("Invalid/unsupported socket address family '{socket_address_family}'.")
+        if drop_policy not in ("disconnect", "drop_oldest", "drop_newest"):
+            raise Exception(f"Invalid drop policy '{drop_policy}', expected 'disconnect', 'drop_oldest' or 'drop_newest'.")
+        self.high_water_mark = high_water_mark
+        self.drop_policy = drop_policy
+        if length_prefix not in ("u16", "u32", "varint"):
+            raise Exception(f"Invalid length prefix '{length_prefix}', expected 'u16', 'u32' or 'varint'.")
+        self.length_prefix = length_prefix
+        self.max_message_size = max_message_size
+        self.receive_buffer_size = 65536
+        self.min_receive_size = 4096
+
+        self.use_udp = use_udp
+        if use_udp and use_tls:
+            raise Exception("TLS isn't supported over UDP.")
+        self.udp_mtu = udp_mtu
+        self.simulated_packet_loss = simulated_packet_loss
+        self.simulated_latency = simulated_latency
+        self.simulated_jitter = simulated_jitter
+        self.udp_default_timeout = 10
+        self.udp_connect_timeout = 5
+        self.udp_keepalive_interval = 1
+        self.udp_ack_delay = 0.01
+        self.udp_min_resend_time = 0.03
+        self.udp_max_reliable_in_flight = 512
+        self.udp_endpoint = None
+        self.udp_sessions = dict()  # address -> UDPConnectionTransport. the client's only one is under None.
+        self.udp_connected = None
 
         self.ssl_context = None
 
@@ -137,6 +509,7 @@ class Peer:
         self.input_event_queue = deque()
 
         self.socket = None
+        self.server = None
         self.host_name = None
         self.tls_host_name = None
         self.port = None
@@ -149,12 +522,11 @@ class Peer:
         self.running_lock = threading.Lock()
         self.output_event_lock = threading.Lock()
         self.input_event_lock = threading.Lock()
-        self.listen_task = None
 
-        self.main_thread_sleep_time = 0.001
-        self.ssl_handshake_sleep_time = 0.0001
-        self.recv_ssl_sleep_time = 0.0001
-        self.recv_unavailable_sleep_time = 0.0001
+        self.async_loop = None
+        self.stop_event = None
+        self.input_wakeup_pending = False
+        self.connections_to_flush = set()
 
         def on_application_exit():
             if self.running:
@@ -209,7 +581,10 @@ class Peer:
         self.is_host = is_host
 
         self.output_event_queue.clear()
-        self.input_event_queue.clear()
+        with self.input_event_lock:
+            self.input_event_queue.clear()
+            self.input_wakeup_pending = False
+            self.connections_to_flush.clear()
 
         self.main_thread = threading.Thread(target=self._start, daemon=True)
         self.main_thread.start()
@@ -221,45 +596,66 @@ class Peer:
         with self.running_lock:
             self.running = False
 
+        self._call_in_loop(self.stop_event.set)
         self.main_thread.join()
 
-    def update(self, max_events=100):
+    def update(self, max_events=100, time_budget=None):
+        # the lock is only held while taking the events, so the networking thread doesn't have to wait for the callbacks
         with self.output_event_lock:
-            for i in range(max_events):
-                if len(self.output_event_queue) == 0:
-                    break
-                next_event = self.output_event_queue.popleft()
-                event_type = next_event[0]
-                conn = next_event[1]
-                d = next_event[2]
-                t = next_event[3]
-                if event_type == PeerEvent.CONNECT:
-                    if self.on_connect is not None:
-                        self.on_connect(conn, t)
-                elif event_type == PeerEvent.DISCONNECT:
-                    if self.on_disconnect is not None:
-                        self.on_disconnect(conn, t)
-                elif event_type == PeerEvent.DATA:
-                    if self.on_raw_data is not None:
-                        d = self.on_raw_data(conn, d, t)
-                    if self.on_data is not None:
-                        self.on_data(next_event[1], d, t)
-
-    def send(self, connection, data):
-        b = bytearray()
-        b += struct.pack(">H", len(data))
-        b += data
+            event_count = len(self.output_event_queue)
+            if max_events is not None:
+                event_count = min(event_count, max_events)
+            events = [self.output_event_queue.popleft() for i in range(event_count)]
+
+        end_time = time.perf_counter() + time_budget if time_budget is not None else None
+        for i, next_event in enumerate(events):
+            if end_time is not None and i > 0 and time.perf_counter() > end_time:
+                with self.output_event_lock:
+                    self.output_event_queue.extendleft(reversed(events[i:]))  # put the rest back first in line for the next update
+                break
 
+            event_type = next_event[0]
+            conn = next_event[1]
+            d = next_event[2]
+            t = next_event[3]
+            if event_type == PeerEvent.CONNECT:
+                if self.on_connect is not None:
+                    self.on_connect(conn, t)
+            elif event_type == PeerEvent.DISCONNECT:
+                if self.on_disconnect is not None:
+                    self.on_disconnect(conn, t)
+            elif event_type == PeerEvent.DATA:
+                if self.on_raw_data is not None:
+                    d = self.on_raw_data(conn, d, t)
+                if self.on_data is not None:
+                    self.on_data(next_event[1], d, t)
+
+    def send(self, connection, data, channel=Channel.RELIABLE_ORDERED, stream=0):
+        message = self._make_message(data, channel, stream)
         with self.input_event_lock:
-            self.input_event_queue.append((PeerInput.SEND, connection, b))
+            if not connection.connected or not self._buffer_message(connection, message):
+                return
+            self.connections_to_flush.add(connection)
+            wake_up = self._needs_wakeup()
+        if wake_up:
+            self._call_in_loop(self._process_input)
+
+    # Sends the same data to each of the connections. The message is only made once and shared by all their write buffers.
+    def multicast(self, connections, data, channel=Channel.RELIABLE_ORDERED, stream=0):
+        message = self._make_message(data, channel, stream)
+        with self.input_event_lock:
+            for connection in list(connections):
+                if connection.connected and self._buffer_message(connection, message):
+                    self.connections_to_flush.add(connection)
+            wake_up = self.connections_to_flush and self._needs_wakeup()
+        if wake_up:
+            self._call_in_loop(self._process_input)
 
     def disconnect(self, connection):
-        with self.input_event_lock:
-            self.input_event_queue.append((PeerInput.DISCONNECT, connection, None))
+        self._queue_input((PeerInput.DISCONNECT, connection, None))
 
     def disconnect_all(self):
-        with self.input_event_lock:
-            self.input_event_queue.append((PeerInput.DISCONNECT_ALL, None, None))
+        self._queue_input((PeerInput.DISCONNECT_ALL, None, None))
 
     def is_running(self):
         return self.running
@@ -270,221 +666,399 @@ class Peer:
     def connection_count(self):
         return len(self.connections)
 
+    # The largest message that can be sent on the unreliable channels, since those have to fit in one packet.
+    def max_unreliable_message_size(self):
+        return self.udp_mtu - _udp_packet_header_size - _udp_message_header_struct.size
+
     def get_connections(self):
         return self.connections
 
     def _start(self):
         asyncio.run(self._run())
 
-    def _add_connection(self, socket, address, async_loop):
-        connection = Connection(self, socket, address, self.connection_timeout)
-        connection_task = async_loop.create_task(self._receive(connection, async_loop))
-        connection.async_task = connection_task
+    def _call_in_loop(self, func, *args):
+        loop = self.async_loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:    # the loop already closed
+            pass
+
+    # Called from the game thread. Only wakes up the event loop once for all the inputs queued before it gets to them.
+    def _queue_input(self, event):
+        with self.input_event_lock:
+            self.input_event_queue.append(event)
+            wake_up = self._needs_wakeup()
+        if wake_up:
+            self._call_in_loop(self._process_input)
+
+    # Call with input_event_lock held.
+    def _needs_wakeup(self):
+        if self.input_wakeup_pending or self.async_loop is None:
+            return False
+        self.input_wakeup_pending = True
+        return True
+
+    def _make_message(self, data, channel, stream):
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if self.use_udp:
+            if channel != Channel.RELIABLE_ORDERED and len(data) > self.max_unreliable_message_size():
+                raise Exception(f"Unreliable message of {len(data)} bytes doesn't fit in a single packet, use Channel.RELIABLE_ORDERED or increase udp_mtu.")
+            return (b"", data, channel, stream)
+        return (self._pack_length(len(data)), data, channel, stream)    # kept apart and written together later, instead of copying them into one buffer
+
+    # Call with input_event_lock held. Returns False if the message got dropped.
+    def _buffer_message(self, connection, message):
+        size = len(message[0]) + len(message[1])
+        if connection.high_water_mark is not None and connection.pending_byte_count + size > connection.high_water_mark:
+            if connection.drop_policy == "disconnect":
+                connection.dropped_message_count += len(connection.pending_messages) + 1
+                connection.pending_messages.clear()
+                connection.pending_byte_count = 0
+                self.input_event_queue.append((PeerInput.DISCONNECT, connection, None))
+                return False
+            if connection.drop_policy == "drop_newest" or size > connection.high_water_mark:
+                connection.dropped_message_count += 1
+                return False
+            while connection.pending_byte_count + size > connection.high_water_mark:
+                oldest = connection.pending_messages.popleft()
+                connection.pending_byte_count -= len(oldest[0]) + len(oldest[1])
+                connection.dropped_message_count += 1
+
+        connection.pending_messages.append(message)
+        connection.pending_byte_count += size
+        return True
+
+    def _process_input(self):
+        writes = []
+        with self.input_event_lock:
+            events = list(self.input_event_queue)
+            self.input_event_queue.clear()
+            self.input_wakeup_pending = False
+            for connection in self.connections_to_flush:
+                if connection.connected and not connection.writing_paused and connection.pending_messages:
+                    writes.append((connection, connection.pending_messages))
+                    connection.pending_messages = deque()
+                    connection.pending_byte_count = 0
+            self.connections_to_flush.clear()   # paused connections get flushed again when they resume
+
+        for connection, messages in writes:
+            if self.use_udp:
+                connection.transport.write_messages(messages)
+            else:
+                connection.transport.writelines([part for header, data, _, _ in messages for part in (header, data)])
+
+        for event, connection, data in events:
+            if event == PeerInput.DISCONNECT:
+                connection.transport.close()
+            elif event == PeerInput.DISCONNECT_ALL:
+                for connection in self.connections:
+                    connection.transport.close()
+
+    def _resume_writing(self, connection):
+        connection.writing_paused = False
+        with self.input_event_lock:
+            self.connections_to_flush.add(connection)
+        self._process_input()
+
+    def _add_connection(self, transport, address):
+        connection_timeout = self.connection_timeout
+        if self.use_udp:
+            if connection_timeout is None:
+                connection_timeout = self.udp_default_timeout
+        else:
+            try:
+                transport.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except Exception:
+                pass
+        connection = Connection(self, transport, address, connection_timeout)
+        if connection.connection_timeout is not None:
+            connection.last_receive_time = self.async_loop.time()
+            connection.timeout_handle = self.async_loop.call_later(connection.connection_timeout, self._check_timeout, connection)
         self.connections.append(connection)
         with self.output_event_lock:
             self.output_event_queue.append((PeerEvent.CONNECT, connection, None, time.time()))
+        return connection
+
+    def _check_timeout(self, connection):
+        time_left = connection.last_receive_time + connection.connection_timeout - self.async_loop.time()
+        if time_left > 0:
+            connection.timeout_handle = self.async_loop.call_later(time_left, self._check_timeout, connection)
+            return
+        connection.timed_out = True
+        connection.transport.abort()
+
+    def _remove_connection(self, connection, exc):
+        if connection.timeout_handle is not None:
+            connection.timeout_handle.cancel()
+        if exc is not None and not connection.timed_out:
+            print(exc)
+        with self.input_event_lock:
+            connection.connected = False
+            connection.pending_messages.clear()
+            connection.pending_byte_count = 0
+        connection.receive_start = connection.receive_end = connection.expected_frame_size = 0
+        self.connections.remove(connection)
+        with self.output_event_lock:
+            self.output_event_queue.append((PeerEvent.DISCONNECT, connection, None, None))
+        if not self.is_host:
+            self.running = False
+            self.stop_event.set()
 
     async def _run(self):
-        async_loop = asyncio.get_event_loop()
+        self.async_loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
 
-        if self.is_host:
+        if self.use_udp:
+            if not await self._start_udp():
+                self.running = False
+                self.async_loop = None
+                return
+        elif self.is_host:
             try:
-                self.socket = socket.socket(self.socket_address_family, socket.SOCK_STREAM, 0)
-                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self.socket.bind((self.host_name, self.port))
-                self.socket.listen(self.backlog)
-                self.socket.setblocking(False)
+                self.server = await self.async_loop.create_server(
+                    lambda: PeerProtocol(self), self.host_name, self.port,
+                    family=self.socket_address_family, backlog=self.backlog, reuse_address=True, ssl=self.ssl_context
+                    )
+                self.socket = self.server.sockets[0]
             except Exception as e:
                 print(e)
                 self.running = False
+                self.async_loop = None
                 raise
-
-            self.listen_task = asyncio.create_task(self._listen(async_loop))
         else:
-            client_socket = None
-            if self.use_tls:
-                try:
-                    self.socket = socket.socket(self.socket_address_family, socket.SOCK_STREAM, 0)
-                    client_socket = self.ssl_context.wrap_socket(self.socket, server_hostname=self.tls_host_name)
-                    client_socket.connect((self.host_name, self.port))
-                except Exception as e:
-                    print(e)
-                    self.running = False
-                    return
-            else:
-                try:
-                    client_socket = socket.create_connection((self.host_name, self.port))
-                except Exception as e:
-                    print(e)
-                    self.running = False
-                    return
             try:
-                client_socket.setblocking(False)
-                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                self._add_connection(client_socket, (self.host_name, self.port), async_loop)
+                await self.async_loop.create_connection(
+                    lambda: PeerProtocol(self), self.host_name, self.port,
+                    family=self.socket_address_family, ssl=self.ssl_context, server_hostname=self.tls_host_name if self.use_tls else None
+                    )
             except Exception as e:
                 print(e)
                 self.running = False
+                self.async_loop = None
                 return
 
         with self.running_lock:
-            self.running = True
-
-        while self.running:
-            to_be_removed = []
-            with self.input_event_lock:
-                while len(self.input_event_queue) > 0:
-                    next_event = self.input_event_queue.popleft()
-                    event = next_event[0]
-                    connection = next_event[1]
-                    data = next_event[2]
-                    if event == PeerInput.SEND:
-                        try:
-                            connection.socket.sendall(data)
-                        except:
-                            to_be_removed.append(connection)
-                    elif event == PeerInput.DISCONNECT:
-                        to_be_removed.append(connection)
-                    elif event == PeerInput.DISCONNECT_ALL:
-                        for connection in self.connections:
-                            to_be_removed.append(connection)
-            for connection in to_be_removed:
-                connection.async_task.cancel()
-                try:
-                    await connection.async_task
-                except:
-                    pass
-            await asyncio.sleep(self.main_thread_sleep_time)
+            if not self.stop_event.is_set():    # a client that got disconnected right away shouldn't show up as running
+                self.running = True
 
-        for connection in self.connections:
-            connection.async_task.cancel()
-            try:
-                await connection.async_task
-            except:
-                pass
+        self._process_input()    # anything queued before the loop was ready
+        await self.stop_event.wait()
+
+        for connection in list(self.connections):
+            connection.transport.close()
+
+        if self.use_udp:
+            await asyncio.sleep(0)
+            self.udp_endpoint.close()
+        elif self.is_host:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        await asyncio.sleep(0)  # let the closed connections call connection_lost
 
+        self.async_loop = None
+
+    async def _start_udp(self):
+        self.udp_sessions.clear()
         if self.is_host:
-            self.listen_task.cancel()
             try:
-                await self.listen_task
-            except:
-                pass
+                self.udp_endpoint, _ = await self.async_loop.create_datagram_endpoint(
+                    lambda: UDPPeerProtocol(self), local_addr=(self.host_name, self.port), family=self.socket_address_family)
+                self.socket = self.udp_endpoint.get_extra_info("socket")
+            except Exception as e:
+                print(e)
+                raise
+            return True
 
-    async def _listen(self, async_loop):
         try:
-            while True:
-                client_socket, client_address = await async_loop.sock_accept(self.socket)
-                if self.use_tls:
-                    socket_wrap_failed = True
-                    try:
-                        client_socket = self.ssl_context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
-                        socket_wrap_failed = False
-                    except Exception as e:
-                        pass
-                    if socket_wrap_failed:
-                        try:
-                            client_socket.close()
-                        except:
-                            pass
-                        continue
-                    handshake_failed = True
-                    while True:
-                        try:
-                            client_socket.do_handshake()
-                            handshake_failed = False
-                            break
-                        except ssl.SSLWantReadError as e:
-                            await asyncio.sleep(self.ssl_handshake_sleep_time)
-                        except ssl.SSLWantWriteError as e:
-                            await asyncio.sleep(self.ssl_handshake_sleep_time)
-                        except Exception as e:
-                            break
-                    if handshake_failed:
-                        try:
-                            client_socket.close()
-                        except:
-                            pass
-                        continue
-                client_socket.setblocking(False)
-                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                self._add_connection(client_socket, client_address, async_loop)
-        except asyncio.CancelledError:
-            pass
-        finally:
+            self.udp_endpoint, _ = await self.async_loop.create_datagram_endpoint(
+                lambda: UDPPeerProtocol(self), remote_addr=(self.host_name, self.port), family=self.socket_address_family)
+        except Exception as e:
+            print(e)
+            return False
+
+        session = UDPConnectionTransport(self, self.udp_endpoint.get_extra_info("peername"), None)
+        session.connect_nonce = random.getrandbits(32)
+        self.udp_sessions[None] = session
+        self.udp_connected = asyncio.Event()
+        connect_packet = _udp_header_struct.pack(UDP_PROTOCOL_ID, UDPPacketType.CONNECT.value) + _udp_nonce_struct.pack(session.connect_nonce)
+        deadline = self.async_loop.time() + self.udp_connect_timeout
+        while self.async_loop.time() < deadline:
+            self._udp_send(connect_packet, None)
             try:
-                self.socket.close()
-            except:
+                await asyncio.wait_for(self.udp_connected.wait(), timeout=0.25)
+                return True
+            except asyncio.TimeoutError:
                 pass
 
-    async def _recv(self, connection, async_loop):
-        data = None
-        while True:
-            try:
-                data = connection.socket.recv(connection.expected_byte_count)
-                break
-            except ssl.SSLWantReadError:
-                await asyncio.sleep(self.recv_ssl_sleep_time)
-            except ssl.SSLWantWriteError:
-                await asyncio.sleep(self.recv_ssl_sleep_time)
-            except BlockingIOError:
-                await asyncio.sleep(self.recv_unavailable_sleep_time)
-            except Exception as e:
-                raise
-        return data
+        print(f"Failed to connect to {self.host_name}:{self.port}, the host didn't answer.")
+        self.udp_endpoint.close()
+        return False
 
-    async def _receive(self, connection, async_loop):
-        try:
-            while True:
-                data = None
+    def _udp_send(self, data, address):
+        if self.simulated_packet_loss and random.random() < self.simulated_packet_loss:
+            return
+        delay = self.simulated_latency
+        if self.simulated_jitter:
+            delay += random.uniform(0, self.simulated_jitter)
+        if delay > 0:
+            self.async_loop.call_later(delay, self._udp_sendto, data, address)
+        else:
+            self._udp_sendto(data, address)
+
+    def _udp_sendto(self, data, address):
+        if not self.udp_endpoint.is_closing():
+            self.udp_endpoint.sendto(data, address)
+
+    def _udp_datagram_received(self, data, address):
+        if len(data) < _udp_header_struct.size:
+            return
+        protocol_id, packet_type = _udp_header_struct.unpack_from(data)
+        if protocol_id != UDP_PROTOCOL_ID:
+            return
+        session = self.udp_sessions.get(address if self.is_host else None)
+
+        if packet_type == UDPPacketType.DATA.value:
+            if session is not None and session.connection is not None:
+                session.receive(data)
+
+        elif packet_type == UDPPacketType.CONNECT.value:
+            if not self.is_host or len(data) < _udp_header_struct.size + _udp_nonce_struct.size:
+                return
+            nonce = _udp_nonce_struct.unpack_from(data, _udp_header_struct.size)[0]
+            if session is not None and session.connect_nonce != nonce:  # the same address connecting again, so the old one is gone
+                session.abort()
+                session = None
+            if session is None:
+                session = UDPConnectionTransport(self, address, address)
+                session.connect_nonce = nonce
+                self.udp_sessions[address] = session
+                session.connection = self._add_connection(session, address)
+                session.start_keepalive()
+            self._udp_send(_udp_header_struct.pack(UDP_PROTOCOL_ID, UDPPacketType.ACCEPT.value) + _udp_nonce_struct.pack(nonce), address)
+
+        elif packet_type == UDPPacketType.ACCEPT.value:
+            if self.is_host or session is None or session.connection is not None or len(data) < _udp_header_struct.size + _udp_nonce_struct.size:
+                return
+            if _udp_nonce_struct.unpack_from(data, _udp_header_struct.size)[0] == session.connect_nonce:
+                session.connection = self._add_connection(session, session.address)
+                session.start_keepalive()
+                self.udp_connected.set()
+
+        elif packet_type == UDPPacketType.DISCONNECT.value:
+            if session is not None:
+                session.abort()
+
+    def _udp_session_closed(self, session):
+        key = session.send_address if self.is_host else None
+        if self.udp_sessions.get(key) is session:
+            del self.udp_sessions[key]
+        if session.connection is not None:
+            self.async_loop.call_soon(self._remove_connection, session.connection, None)   # later, like asyncio's connection_lost, since this can happen while going through self.connections
+
+    def _pack_length(self, length):
+        if self.length_prefix == "u16":
+            if length > 0xFFFF:
+                raise Exception(f"Message of {length} bytes is too large for the 'u16' length prefix, use length_prefix='u32' or 'varint' instead.")
+            return _u16_struct.pack(length)
+        elif self.length_prefix == "u32":
+            return _u32_struct.pack(length)
+
+        b = bytearray()
+        while length > 0x7F:
+            b.append((length & 0x7F) | 0x80)
+            length >>= 7
+        b.append(length)
+        return bytes(b)
+
+    # Returns (message length, length prefix size), or None if the whole length prefix hasn't arrived yet.
+    def _unpack_length(self, view, position, end):
+        if self.length_prefix == "u16":
+            if end - position < 2:
+                return None
+            return (view[position] << 8) | view[position+1], 2
+        elif self.length_prefix == "u32":
+            if end - position < 4:
+                return None
+            return _u32_struct.unpack_from(view, position)[0], 4
+
+        length = 0
+        for i in range(5):
+            if position + i >= end:
+                return None
+            b = view[position+i]
+            length |= (b & 0x7F) << (7 * i)
+            if b < 0x80:
+                return length, i + 1
+        raise Exception("Received an invalid varint message length.")
+
+    def _get_receive_buffer(self, connection):
+        buffer = connection.receive_buffer
+        unread = connection.receive_end - connection.receive_start
+        needed = max(connection.expected_frame_size - unread, self.min_receive_size)
+        if len(buffer) - connection.receive_end < needed:
+            if unread + needed > len(buffer):   # make room for the whole message
+                new_buffer = bytearray(max(len(buffer) * 2, unread + needed))
+                new_buffer[:unread] = buffer[connection.receive_start:connection.receive_end]
+                connection.receive_buffer = buffer = new_buffer
+            else:   # move what's left of the last message to the start
+                buffer[:unread] = buffer[connection.receive_start:connection.receive_end]
+            connection.receive_start = 0
+            connection.receive_end = unread
+
+        return memoryview(buffer)[connection.receive_end:]
+
+    # Splits all the complete messages out of the receive buffer and queues them all at once.
+    def _receive(self, connection, byte_count):
+        if connection.connection_timeout is not None:
+            connection.last_receive_time = self.async_loop.time()
+
+        connection.receive_end += byte_count
+        position, end = connection.receive_start, connection.receive_end
+        messages = []
+        time_received = time.time()
+        connection.expected_frame_size = 0
+
+        with memoryview(connection.receive_buffer) as view:
+            while position < end:
                 try:
-                    if connection.connection_timeout is None:
-                        data = await self._recv(connection, async_loop)
-                    else:
-                        data = await asyncio.wait_for(self._recv(connection, async_loop), timeout=connection.connection_timeout)
-                except asyncio.exceptions.TimeoutError:
-                    connection.timed_out = True
-                    raise
+                    header = self._unpack_length(view, position, end)
                 except Exception as e:
-                    print(e)
-                    raise
-                if data is None:
+                    print(f"WARNING: {e} Disconnecting...")
+                    connection.transport.abort()
+                    return
+                if header is None:
                     break
-                if len(data) == 0:
+                length, header_size = header
+                if length > self.max_message_size:
+                    print(f"WARNING: Received a message of {length} bytes, which is larger than max_message_size, disconnecting...")
+                    connection.transport.abort()
+                    return
+
+                frame_end = position + header_size + length
+                if frame_end > end:
+                    connection.expected_frame_size = header_size + length
                     break
-                connection.bytes_received += data
-                connection.expected_byte_count -= len(data)
-
-                if connection.expected_byte_count == 0:
-                    if connection.state == "l":
-                        l = struct.unpack(">H", connection.bytes_received)[0]
-                        connection.state = "c"
-                        connection.expected_byte_count = l
-                        connection.bytes_received.clear()
-                    elif connection.state == "c":
-                        d = bytes(connection.bytes_received.copy())
-                        with self.output_event_lock:
-                            self.output_event_queue.append((PeerEvent.DATA, connection, d, time.time()))
-                        connection.state = "l"
-                        connection.expected_byte_count = connection.length_byte_count
-                        connection.bytes_received.clear()
-        except asyncio.CancelledError:
-            pass
-        except:
-            pass
-        finally:
-            try:
-                connection.socket.close()
-            except:
-                pass
-            connection.state = "l"
-            connection.bytes_received.clear()
-            connection.expected_byte_count = connection.length_byte_count
-            connection.connected = False
-            self.connections.remove(connection)
-            with self.output_event_lock:
-                self.output_event_queue.append((PeerEvent.DISCONNECT, connection, None, None))
-            if not self.is_host:
-                self.running = False
+                messages.append(bytes(view[position+header_size:frame_end]))
+                position = frame_end
+
+        if position == end:
+            connection.receive_start = connection.receive_end = 0
+        else:
+            connection.receive_start = position
+
+        if messages:
+            self._queue_received(connection, messages, time_received)
+
+    # Called from the networking thread with the messages received from a connection.
+    def _queue_received(self, connection, messages, time_received):
+        if self.data_decoder is not None:
+            messages = [self.data_decoder(connection, data) for data in messages]
+        with self.output_event_lock:
+            self.output_event_queue.extend((PeerEvent.DATA, connection, data, time_received) for data in messages)
 
 
 # -- Description --
@@ -685,24 +1259,371 @@ def procedure_hash(name):
     return int.from_bytes(h[:4], byteorder="big") >> 1
 
 
+_narrow_formats = {"i8": "b", "u8": "B", "i16": "h", "u16": "H", "i32": "i", "u32": "I", "i64": "q", "u64": "Q", "float32": "f", "float64": "d"}
+_vector_sizes = {Vec2: 2, Vec3: 3, Vec4: 4}
+
+
+# Used internally by ProcedureCodec. Splits Annotated[int, "u16"] into (int, "u16"), and other types into (type, None).
+def _split_annotated(arg_type):
+    if typing.get_origin(arg_type) is not typing.Annotated:
+        return arg_type, None
+    arg_type, *metadata = typing.get_args(arg_type)
+    narrow = None
+    for m in metadata:
+        if isinstance(m, str):
+            if m not in _narrow_formats:
+                raise Exception(f"Unknown narrow type '{m}', expected one of: {', '.join(_narrow_formats)}.")
+            narrow = m
+    if narrow is None:
+        return arg_type, None
+    if arg_type is int and narrow.startswith("float") or arg_type in (float, Vec2, Vec3, Vec4) and not narrow.startswith("float"):
+        raise Exception(f"Narrow type '{narrow}' can't be used for {arg_type.__name__}.")
+    if arg_type not in (int, float, Vec2, Vec3, Vec4):
+        raise Exception(f"Narrow types are only supported for int, float, Vec2, Vec3 and Vec4, not {arg_type}.")
+    return arg_type, narrow
+
+
+# Used internally by ProcedureCodec. Returns (struct format, flatten, build) for types with a fixed size, or None.
+# flatten(value, values) adds the values to pack to the list, build(values, i) returns (value, index after it).
+# Both are None for types that are a single value.
+def _compile_fixed(arg_type, custom_types):
+    arg_type, narrow = _split_annotated(arg_type)
+    if arg_type in custom_types:
+        return None
+    if arg_type is bool:
+        return "?", None, None
+    if arg_type is int:
+        return _narrow_formats[narrow or "i64"], None, None
+    if arg_type is float:
+        return _narrow_formats[narrow or "float64"], None, None
+    if arg_type in _vector_sizes:
+        size = _vector_sizes[arg_type]
+        vector_type = arg_type
+
+        def flatten_vector(value, values):
+            values.extend(value)
+
+        def build_vector(values, i):
+            return vector_type(*values[i:i+size]), i + size
+
+        return _narrow_formats[narrow or "float64"] * size, flatten_vector, build_vector
+    if typing.get_origin(arg_type) is tuple:
+        items = [_compile_fixed(t, custom_types) for t in typing.get_args(arg_type)]
+        if not items or None in items:
+            return None
+
+        def flatten_tuple(value, values):
+            for (_, flatten, _), v in zip(items, value, strict=True):
+                if flatten is None:
+                    values.append(v)
+                else:
+                    flatten(v, values)
+
+        def build_tuple(values, i):
+            result = []
+            for _, _, build in items:
+                if build is None:
+                    result.append(values[i])
+                    i += 1
+                else:
+                    v, i = build(values, i)
+                    result.append(v)
+            return tuple(result), i
+
+        return "".join(item[0] for item in items), flatten_tuple, build_tuple
+    return None
+
+
+# Used internally by ProcedureCodec. Returns (encode, decode) for a single value of any supported type,
+# with encode(value, buffer) adding it to the bytearray and decode(data, position, max_list_length) returning (value, position after it).
+def _compile_value(arg_type, writer, reader):
+    fixed = _compile_fixed(arg_type, writer.type_functions)
+    if fixed is not None:
+        fixed_format, flatten, build = fixed
+        fixed_struct = struct.Struct(">" + fixed_format)
+
+        def encode_fixed(value, buffer):
+            if flatten is None:
+                buffer += fixed_struct.pack(value)
+            else:
+                values = []
+                flatten(value, values)
+                buffer += fixed_struct.pack(*values)
+
+        def decode_fixed(data, position, max_list_length):
+            values = fixed_struct.unpack_from(data, position)
+            position += fixed_struct.size
+            if build is None:
+                return values[0], position
+            return build(values, 0)[0], position
+
+        return encode_fixed, decode_fixed
+
+    arg_type, _ = _split_annotated(arg_type)
+    write_func = writer.type_functions.get(arg_type)
+    if write_func is not None:
+        read_func = reader.read_functions.get(arg_type)
+        if read_func is None:
+            raise Exception(f"No read function registered for {arg_type.__name__}.")
+        custom_writer = DatagramWriter()
+        custom_writer.type_functions = writer.type_functions
+        custom_reader = DatagramReader()
+        custom_reader.read_functions = reader.read_functions
+
+        def encode_custom(value, buffer):
+            custom_writer.clear()
+            write_func(custom_writer, value)
+            buffer += custom_writer.get_datagram().getMessage()
+
+        def decode_custom(data, position, max_list_length):
+            custom_reader.set_datagram(p3d.Datagram(bytes(data[position:])))
+            value = read_func(custom_reader)
+            return value, position + custom_reader.iter.getCurrentIndex()
+
+        return encode_custom, decode_custom
+
+    if arg_type is str:
+        def encode_string(value, buffer):
+            value = value.encode("utf-8")
+            buffer += _string32_length_struct.pack(len(value))
+            buffer += value
+
+        def decode_string(data, position, max_list_length):
+            length = _string32_length_struct.unpack_from(data, position)[0]
+            position += _string32_length_struct.size
+            if position + length > len(data):
+                raise Exception("String is longer than the remaining data.")
+            return str(data[position:position+length], "utf-8"), position + length
+
+        return encode_string, decode_string
+
+    if arg_type is bytes:
+        def encode_blob(value, buffer):
+            buffer += _blob_length_struct.pack(len(value))
+            buffer += value
+
+        def decode_blob(data, position, max_list_length):
+            length = _blob_length_struct.unpack_from(data, position)[0]
+            position += _blob_length_struct.size
+            if position + length > len(data):
+                raise Exception("Blob is longer than the remaining data.")
+            return bytes(data[position:position+length]), position + length
+
+        return encode_blob, decode_blob
+
+    origin_type = typing.get_origin(arg_type)
+    if origin_type is list:
+        item_type = typing.get_args(arg_type)[0]
+        if typing.get_origin(item_type) is list:
+            raise Exception("Lists of lists are not supported.")
+        return _compile_list(item_type, writer, reader)
+
+    if origin_type is tuple:
+        items = [_compile_value(t, writer, reader) for t in typing.get_args(arg_type)]
+
+        def encode_tuple(value, buffer):
+            for (encode, _), v in zip(items, value, strict=True):
+                encode(v, buffer)
+
+        def decode_tuple(data, position, max_list_length):
+            result = []
+            for _, decode in items:
+                v, position = decode(data, position, max_list_length)
+                result.append(v)
+            return tuple(result), position
+
+        return encode_tuple, decode_tuple
+
+    raise Exception(f"Unsupported type for remote procedure arguments: {arg_type}")
+
+
+# Used internally by ProcedureCodec. Lists of fixed size items get packed and unpacked all at once.
+def _compile_list(item_type, writer, reader):
+    def decode_length(data, position, max_list_length):
+        length = _i16_struct.unpack_from(data, position)[0]
+        if length < 0:
+            raise Exception("Received a list with a negative length.")
+        if length > max_list_length:
+            raise ExceedsListLimitException("Received list that exceeds the max list length allowed.")
+        return length, position + _i16_struct.size
+
+    fixed = _compile_fixed(item_type, writer.type_functions)
+    if fixed is not None:
+        item_format, flatten, build = fixed
+        item_struct = struct.Struct(">" + item_format)
+
+        def encode_fixed_list(value, buffer):
+            buffer += _i16_struct.pack(len(value))
+            if flatten is None:
+                buffer += struct.pack(f">{len(value)}{item_format}", *value)
+            else:
+                values = []
+                for v in value:
+                    flatten(v, values)
+                buffer += struct.pack(">" + item_format * len(value), *values)
+
+        def decode_fixed_list(data, position, max_list_length):
+            length, position = decode_length(data, position, max_list_length)
+            end = position + length * item_struct.size
+            if end > len(data):
+                raise Exception("List is longer than the remaining data.")
+            if flatten is None:
+                return list(struct.unpack_from(f">{length}{item_format}", data, position)), end
+            return [build(values, 0)[0] for values in item_struct.iter_unpack(memoryview(data)[position:end])], end
+
+        return encode_fixed_list, decode_fixed_list
+
+    encode_item, decode_item = _compile_value(item_type, writer, reader)
+
+    def encode_list(value, buffer):
+        buffer += _i16_struct.pack(len(value))
+        for v in value:
+            encode_item(v, buffer)
+
+    def decode_list(data, position, max_list_length):
+        length, position = decode_length(data, position, max_list_length)
+        values = []
+        for i in range(length):
+            v, position = decode_item(data, position, max_list_length)
+            values.append(v)
+        return values, position
+
+    return encode_list, decode_list
+
+
+# -- Description --
+# Used internally by RPCPeer. Turns the argument type annotations of a procedure into an encoder and a decoder,
+# the first time it's called, so there's no type checking per argument for every call.
+# Arguments next to each other that have a fixed size get packed with a single struct.Struct, together with the procedure name hash,
+# so most procedures are encoded and decoded with one pack() and one unpack_from().
+# Lists of fixed size items are packed all at once as well. The data is the same as DatagramWriter would write,
+# except for narrow types, which have to be annotated the same way on both sides:
+# Annotated[int, "u8"] ("i8", "u16", "i16", "u32", "i32", "u64", "i64") and Annotated[float, "float32"] (also for Vec2, Vec3 and Vec4).
+class ProcedureCodec:
+    def __init__(self, arg_types, writer, reader):
+        self.arg_types = arg_types
+        self.writer = writer
+        self.reader = reader
+        self.compiled = None    # (parts, single_struct), set in a single assignment, so the networking thread never sees one without the other
+
+    def precompile(self):
+        # Compiles on the game thread ahead of time. If a type isn't registered yet, it gets compiled on first use instead, which raises the error then.
+        try:
+            self.compile()
+        except Exception:
+            self.compiled = None
+
+    def compile(self):
+        # Each part is either (struct, flatteners, builders), for consecutive fixed size arguments, or (None, encode, decode) for one other argument.
+        parts = []
+        fixed_format, flatteners, builders = "i", [], []
+        for arg_type in self.arg_types:
+            fixed = _compile_fixed(arg_type, self.writer.type_functions)
+            if fixed is not None:
+                fixed_format += fixed[0]
+                flatteners.append(fixed[1])
+                builders.append(fixed[2])
+                continue
+            if fixed_format:
+                parts.append((struct.Struct(">" + fixed_format), flatteners, builders))
+                fixed_format, flatteners, builders = "", [], []
+            parts.append((None, *_compile_value(arg_type, self.writer, self.reader)))
+        if fixed_format:
+            parts.append((struct.Struct(">" + fixed_format), flatteners, builders))
+
+        # when there's only one part and no argument needs flattening, the arguments can be passed to pack() as they are.
+        single_struct = parts[0][0] if len(parts) == 1 and not any(parts[0][1]) else None
+        self.compiled = (parts, single_struct)
+        return self.compiled
+
+    def encode(self, procedure_name_hash, args):
+        if len(args) != len(self.arg_types):
+            raise Exception(f"Expected {len(self.arg_types)} arguments, got {len(args)}.")
+        parts, single_struct = self.compiled or self.compile()
+        if single_struct is not None:
+            return single_struct.pack(procedure_name_hash, *args)
+
+        buffer = bytearray()
+        i = 0
+        for part in parts:
+            if part[0] is None:
+                part[1](args[i], buffer)
+                i += 1
+                continue
+
+            part_struct, flatteners, _ = part
+            values = [procedure_name_hash] if i == 0 else []
+            for flatten in flatteners:
+                if flatten is None:
+                    values.append(args[i])
+                else:
+                    flatten(args[i], values)
+                i += 1
+            buffer += part_struct.pack(*values)
+
+        return bytes(buffer)
+
+    # Returns the argument values from a message. The procedure name hash at the start gets skipped, so it is not one of them.
+    def decode(self, data, max_list_length):
+        parts, _ = self.compiled or self.compile()
+
+        args = []
+        position = 0
+        for part in parts:
+            if part[0] is None:
+                value, position = part[2](data, position, max_list_length)
+                args.append(value)
+                continue
+
+            part_struct, _, builders = part
+            values = part_struct.unpack_from(data, position)
+            j = 1 if position == 0 else 0
+            position += part_struct.size
+            for build in builders:
+                if build is None:
+                    args.append(values[j])
+                    j += 1
+                else:
+                    value, j = build(values, j)
+                    args.append(value)
+
+        return args
+
+
 # -- Description --
 # Main remote procedure call class used by the networking module.
 # This class is likely the one you are looking for.
 # -- max list length --
 # Lists are supported for remote procedure calls, but to prevent attacks involving giant lists,
 # there is an upper limit on the length, this can be configured, the default is small on purpose.
+# -- decode on network thread --
+# With decode_on_network_thread=True, the arguments get decoded and checked on the networking thread as soon as they arrive,
+# so update() only has to call the procedures. Functions registered with register_type will then be called on the networking thread too.
+# on_raw_data then gets the decoded (procedure, arguments) instead of the data.
+# update() also takes a time_budget in seconds, to spread a burst of calls over several frames, see Peer.
 # -- kwargs --
 # The remaining keyword arguments are passed to Peer, see the Peer class for more information.
 # -- Notes --
 # The first two arguments passed to a remote procedure call are connection, and time_received.
 # You can disable the printing of messages on connect and disconnect via the
 # print_connect, and print_disconnect booleans.
+# With use_udp=True, procedures can be registered with a channel, see the rpc function below.
+# Each procedure gets its own stream for Channel.UNRELIABLE_SEQUENCED, picked from its name.
+# Arguments get encoded based on their type annotations, which can use narrow types to save bandwidth,
+# like Annotated[int, "u16"] or Annotated[Vec3, "float32"], see ProcedureCodec.
+# -- Broadcast --
+# broadcast("proc_name", *args) calls a procedure on every connection, or only on those in a group with group=.
+# Connections can be put in any number of groups with add_to_group(), for example one per room or team.
+# The arguments only get encoded once, no matter how many connections it goes to.
 # See the networking samples on how to use this class.
 class RPCPeer:
-    def __init__(self, max_list_length=16, **kwargs):
+    def __init__(self, max_list_length=16, decode_on_network_thread=False, **kwargs):
         self.peer = Peer(**kwargs)
 
         self.max_list_length = max_list_length
+        self.decode_on_network_thread = decode_on_network_thread
+        if decode_on_network_thread:
+            self.peer.data_decoder = lambda connection, data: self.decode_call(data)
 
         self.print_connect = True
         self.print_disconnect = True
@@ -724,6 +1645,7 @@ class RPCPeer:
                             on_connect[2](connection, time_connected)
 
         def default_on_disconnect(connection, time_disconnected):
+            self.remove_from_all_groups(connection)
             if self.print_disconnect:
                 print("Disconnected:", connection.address)
             on_disconnects = self.procedures.get(procedure_hash("on_disconnect"))
@@ -747,6 +1669,8 @@ class RPCPeer:
             self.peer.on_disconnect = default_on_disconnect
         self.peer.on_data = on_data
 
+        self.groups = dict()    # group -> set of connections, see add_to_group()
+
         self.procedures = dict()
         self.procedures[procedure_hash("on_connect")] = []
         self.procedures[procedure_hash("on_disconnect")] = []
@@ -763,8 +1687,8 @@ class RPCPeer:
     def stop(self):
         self.peer.stop()
 
-    def update(self, max_events=100):
-        self.peer.update(max_events=max_events)
+    def update(self, max_events=100, time_budget=None):
+        self.peer.update(max_events=max_events, time_budget=time_budget)
 
     def is_running(self):
         return self.peer.is_running()
@@ -784,8 +1708,11 @@ class RPCPeer:
     def register_type(self, the_type, write_func, read_func):
         self.writer.register_type(the_type, write_func)
         self.reader.register_type(the_type, read_func)
+        for proc in self.procedures.values():
+            if type(proc) is tuple:
+                proc[6].precompile()    # compile again, in case the procedure uses the new type
 
-    def register_procedure(self, proc, host_only=False, client_only=False, prefix=None):
+    def register_procedure(self, proc, host_only=False, client_only=False, prefix=None, channel=None):
         func_spec = inspect.getfullargspec(proc)
         if not len(func_spec.args) >= 2:
             raise Exception(f"{proc.__name__} must have at least two arguments, connection and time_received.")
@@ -797,86 +1724,126 @@ class RPCPeer:
             func_arg_type = func_spec.annotations.get(func_arg)
             if not func_arg_type is not None:
                 raise Exception(f"Failed to register the '{proc.__name__}' procedure, it's missing a type annotation for the '{func_arg}' argument.")
-            if type(func_arg_type) is types.GenericAlias:
-                arg_types.append((typing.get_origin(func_arg_type), typing.get_args(func_arg_type)))
-            else:
-                arg_types.append(func_arg_type)
+            arg_types.append(func_arg_type)
         proc_name = proc.__name__
         if prefix is not None:
             proc_name = prefix + "_" + proc_name
         procedure_name_hash = procedure_hash(proc_name)
+        codec = ProcedureCodec(arg_types, self.writer, self.reader)
+        codec.precompile()
         if proc.__name__ in ("on_connect", "on_disconnect"):
             p = self.procedures.get(procedure_name_hash)
-            p.append((proc_name, arg_types, proc, host_only, client_only))
+            p.append((proc_name, arg_types, proc, host_only, client_only, channel, codec))
         else:
             if not procedure_name_hash not in self.procedures:
                 raise Exception(f"{proc_name} was already registered before.")
-            self.procedures[procedure_name_hash] = (proc_name, arg_types, proc, host_only, client_only)
+            self.procedures[procedure_name_hash] = (proc_name, arg_types, proc, host_only, client_only, channel, codec)
+
+    def add_to_group(self, group, connection):
+        self.groups.setdefault(group, set()).add(connection)
+
+    def remove_from_group(self, group, connection):
+        connections = self.groups.get(group)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self.groups[group]
+
+    def remove_from_all_groups(self, connection):
+        for group in list(self.groups):
+            self.remove_from_group(group, connection)
+
+    def get_group(self, group):
+        return self.groups.get(group, set())
+
+    # Calls the procedure on each of the connections, except the ones in exclude, which can also be a single connection.
+    def multicast(self, connections, proc_name, *args, exclude=None):
+        data, channel, stream = self._encode_call(procedure_hash(proc_name), args)
+        if exclude is not None:
+            if isinstance(exclude, Connection):
+                exclude = (exclude, )
+            connections = [c for c in connections if c not in exclude]
+        self.peer.multicast(connections, data, channel, stream)
+
+    # Calls the procedure on every connection, or every connection in group.
+    def broadcast(self, proc_name, *args, exclude=None, group=None):
+        if group is None:
+            connections = self.get_connections()
+        else:
+            connections = self.groups.get(group, ())
+            for connection in [c for c in connections if not c.connected]:  # in case on_disconnect was replaced and didn't remove them
+                self.remove_from_group(group, connection)
+        self.multicast(connections, proc_name, *args, exclude=exclude)
+
+    # Returns (data, channel, stream) for a call to the procedure, ready to send.
+    def _encode_call(self, procedure_name_hash, args):
+        stream = procedure_name_hash & 0xFF
+        proc = self.procedures.get(procedure_name_hash)
+        if type(proc) is tuple:
+            return proc[6].encode(procedure_name_hash, args), proc[5] or Channel.RELIABLE_ORDERED, stream
+
+        # not registered on this side, so there's no codec for it
+        self.writer.clear()
+        self.writer.write_int32(procedure_name_hash)
+        for arg in args:
+            self.writer.write(arg)
+        return self.writer.get_datagram().getMessage(), Channel.RELIABLE_ORDERED, stream
 
     def __getattr__(self, name):
+        procedure_name_hash = procedure_hash(name)
+
         def remote_procedure(*args):
             if not len(args) >= 1:
                 raise Exception(f"Remote procedure call '{name}' must have at least one argument, the connection.")
-            if not isinstance(args[0], Connection):
-                raise Exception(f"First argument to the RPC '{name}' must be a 'Connection' type.")
-            procedure_name_hash = procedure_hash(name)
-            self.writer.clear()
-            self.writer.write_int32(procedure_name_hash)
             connection = args[0]
-            for arg in args[1:]:
-                self.writer.write(arg)
-            connection.send(self.writer.get_datagram().getMessage())
+            if not isinstance(connection, Connection):
+                raise Exception(f"First argument to the RPC '{name}' must be a 'Connection' type.")
+            connection.send(*self._encode_call(procedure_name_hash, args[1:]))
 
+        if not name.startswith("__"):
+            self.__dict__[name] = remote_procedure  # so the next call doesn't go through __getattr__ again
         return remote_procedure
 
-    def rpc_on_data(self, connection, data, time_received):
-        self.reader.set_datagram(p3d.Datagram(data))
-
-        proc_name = None
-        proc_func = None
-        proc_arg_values = None
-        proc_arg_types = None
-        host_only = False
-        client_only = False
-
+    # Returns (procedure, argument values), or (None, error message) if the data isn't a valid call.
+    # Can be called from the networking thread, see decode_on_network_thread.
+    def decode_call(self, data):
         try:
-            procedure_name_hash = self.reader.read_int32()
+            if len(data) < _i32_struct.size:
+                return None, "Received a message too short to be a remote procedure call."
+            procedure_name_hash = _i32_struct.unpack_from(data)[0]
             proc = self.procedures.get(procedure_name_hash)
-            if proc is None:
-                raise Exception("Remote attempted to call a RPC that does not exist (maybe a name typo in the source code?).")
-            proc_name = proc[0]
-            proc_arg_types = proc[1]
-            proc_func = proc[2]
-            host_only = proc[3]
-            client_only = proc[4]
-            proc_arg_values = []
-            arg_type = None
+            if type(proc) is not tuple:
+                return None, "Remote attempted to call a RPC that does not exist (maybe a name typo in the source code?)."
             try:
-                for t in proc_arg_types:
-                    arg_type = t
-                    v = self.reader.read(t, max_list_length=self.max_list_length)
-                    proc_arg_values.append(v)
+                return proc, proc[6].decode(data, self.max_list_length)
             except ExceedsListLimitException:
-                raise Exception(f"Argument with type '{arg_type}' exceeds max list size limit for procedure '{proc_name}'.")
+                return None, f"An argument exceeds max list size limit for procedure '{proc[0]}'."
             except Exception as e:
-                raise Exception(f"Received invalid or missing argument or list/tuple exceeding max length allowed for procedure '{proc_name}', expected a '{arg_type}'.\n    {str(e)}")
+                return None, f"Received invalid or missing argument or list/tuple exceeding max length allowed for procedure '{proc[0]}', expected {proc[1]}.\n    {str(e)}"
         except Exception as e:
+            return None, str(e)
+
+    def rpc_on_data(self, connection, data, time_received):
+        if self.decode_on_network_thread:
+            proc, proc_arg_values = data
+        else:
+            proc, proc_arg_values = self.decode_call(data)
+
+        if proc is None:
             print("WARNING: Received invalid remote procedure call, disconnecting...")
-            print(e)
+            print(proc_arg_values)
             connection.disconnect()
+            return
 
-        if proc_func is not None and proc_arg_types is not None and proc_arg_values is not None:
-            if len(proc_arg_values) != len(proc_arg_types):
-                print("WARNING: Received invalid remote procedure call, disconnecting...")
-                print("Received an invalid number of arguments for procedure '{proc_name}'.")
-                connection.disconnect()
-            else:
-                if self.peer.is_hosting():
-                    if not client_only:
-                        proc_func(connection, time_received, *proc_arg_values)
-                else:
-                    if not host_only:
-                        proc_func(connection, time_received, *proc_arg_values)
+        host_only = proc[3]
+        client_only = proc[4]
+        if self.peer.is_hosting():
+            if not client_only:
+                proc[2](connection, time_received, *proc_arg_values)
+        else:
+            if not host_only:
+                proc[2](connection, time_received, *proc_arg_values)
 
 
 # Convenience attribute applied to functions to register them as remote procedure calls.
@@ -884,9 +1851,12 @@ class RPCPeer:
 # @rpc(my_rpc_peer_object)
 # def foo(connection, time_received, x: int):
 #     print(x)
-def rpc(peer, host_only=False, client_only=False):
+#
+# With UDP, channel sets how calls to it get sent, for example:
+# @rpc(my_rpc_peer_object, channel=Channel.UNRELIABLE_SEQUENCED)
+def rpc(peer, host_only=False, client_only=False, channel=None):
     def wrapper(f):
-        peer.register_procedure(f, host_only=host_only, client_only=client_only)
+        peer.register_procedure(f, host_only=host_only, client_only=client_only, channel=channel)
     return wrapper
 
 
@@ -0,0 +1,315 @@
+'''
+Load test for the networking module. Starts a host and simulated clients on localhost and reports throughput, latency,
+host cpu time per message and host memory per connection. The clients run in their own processes, so they don't count towards the host's numbers.
+
+python -m ursina.networking_benchmark --clients=50 --duration=10 --mix=position=8,blob=1,echo=1 --json=results.json
+'''
+import sys
+import time
+import json
+import random
+import queue
+import tracemalloc
+import multiprocessing
+from textwrap import dedent
+
+from ursina.vec3 import Vec3
+from ursina.networking import RPCPeer
+
+
+default_settings = dict(
+    clients = 10,
+    processes = 2,          # client processes to spread the clients over
+    duration = 5,
+    rate = 30,              # messages per second from each client
+    mix = 'position=1',     # weights of the messages the clients send: position, blob and echo
+    blob_size = 4096,
+    broadcast_rate = 0,     # broadcasts per second from the host to every client
+    port = 24680,
+    use_udp = False,
+    decode_on_network_thread = False,   # for the host
+    json = None,            # path to write the results to, or '-' to print them as json
+)
+
+
+class _BenchmarkPeer(RPCPeer):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.print_connect = False
+        self.print_disconnect = False
+        self.message_count = 0
+        self.byte_count = 0
+        self.latencies = dict()     # procedure -> list of latencies in seconds
+        self.measuring = False
+
+        if self.decode_on_network_thread:   # the data only gets to rpc_on_data decoded, so count the bytes before that
+            decode = self.peer.data_decoder
+
+            def counting_decoder(connection, data):
+                if self.measuring:
+                    self.byte_count += len(data)
+                return decode(connection, data)
+
+            self.peer.data_decoder = counting_decoder
+
+        # registered as functions instead of methods, so self.bench_position() etc. call them on the other side
+        def bench_position(connection, time_received, sent_time: float, position: Vec3):
+            self.record('position', sent_time)
+
+        def bench_blob(connection, time_received, sent_time: float, data: bytes):
+            self.record('blob', sent_time)
+
+        def bench_echo(connection, time_received, sent_time: float):
+            self.bench_echo_reply(connection, sent_time)
+
+        def bench_echo_reply(connection, time_received, sent_time: float):
+            self.record('echo', sent_time)
+
+        def bench_broadcast(connection, time_received, sent_time: float, position: Vec3):
+            self.record('broadcast', sent_time)
+
+        self.register_procedure(bench_position, host_only=True)
+        self.register_procedure(bench_blob, host_only=True)
+        self.register_procedure(bench_echo, host_only=True)
+        self.register_procedure(bench_echo_reply, client_only=True)
+        self.register_procedure(bench_broadcast, client_only=True)
+
+    def rpc_on_data(self, connection, data, time_received):
+        if self.measuring:
+            self.message_count += 1
+            if not self.decode_on_network_thread:
+                self.byte_count += len(data)
+        super().rpc_on_data(connection, data, time_received)
+
+    def record(self, name, sent_time):
+        if self.measuring:
+            self.latencies.setdefault(name, []).append(time.time() - sent_time)
+
+
+def parse_mix(mix):
+    weights = dict()
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('position', 'blob', 'echo'):
+            raise ValueError(f'unknown message type in mix: {name}, expected position, blob or echo')
+        weights[name] = float(weight) if weight else 1
+    return weights
+
+
+def get_latency_stats(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return dict(
+        count = len(latencies),
+        mean_ms = sum(latencies) / len(latencies) * 1000,
+        p50_ms = latencies[len(latencies) // 2] * 1000,
+        p99_ms = latencies[min(int(len(latencies) * .99), len(latencies)-1)] * 1000,
+        max_ms = latencies[-1] * 1000,
+        )
+
+
+def _client_process(settings, client_count, ready_queue, start_event, result_queue):
+    clients = [_BenchmarkPeer(use_udp=settings['use_udp']) for i in range(client_count)]
+    for client in clients:
+        client.start('localhost', settings['port'])
+
+    timeout = time.time() + 10
+    while time.time() < timeout and not all(c.connection_count() for c in clients):
+        for client in clients:
+            client.update(max_events=1000)
+        time.sleep(.01)
+    ready_queue.put(sum(1 for c in clients if c.connection_count()))
+
+    start_event.wait()
+    weights = parse_mix(settings['mix'])
+    names, weights = list(weights), list(weights.values())
+    blob = random.randbytes(settings['blob_size'])
+    position = Vec3(1.5, 2.5, 3.5)
+    sent = 0
+
+    for client in clients:
+        client.measuring = True
+    start_time = time.time()
+    next_send = start_time
+    while time.time() - start_time < settings['duration']:
+        if time.time() >= next_send:
+            next_send += 1 / settings['rate']
+            for client, name in zip(clients, random.choices(names, weights, k=len(clients))):
+                if not client.connection_count():
+                    continue
+                connection = client.get_connections()[0]
+                if name == 'position':
+                    client.bench_position(connection, time.time(), position)
+                elif name == 'blob':
+                    client.bench_blob(connection, time.time(), blob)
+                else:
+                    client.bench_echo(connection, time.time())
+                sent += 1
+
+        for client in clients:
+            client.update(max_events=1000)
+        time.sleep(max(min(next_send - time.time(), .002), 0))
+
+    end_time = time.time() + .5    # let the last replies arrive
+    while time.time() < end_time:
+        for client in clients:
+            client.update(max_events=1000)
+        time.sleep(.005)
+
+    latencies = dict()
+    for client in clients:
+        for name, values in client.latencies.items():
+            latencies.setdefault(name, []).extend(values)
+    result_queue.put(dict(sent=sent, received=sum(c.message_count for c in clients), latencies=latencies))
+    for client in clients:
+        client.stop()
+
+
+def run_benchmark(**settings):
+    ''' Runs the benchmark and returns the results as a dict. Takes the same settings as default_settings. '''
+    settings = {**default_settings, **settings}
+    host = _BenchmarkPeer(use_udp=settings['use_udp'], decode_on_network_thread=settings['decode_on_network_thread'])
+    host.start('localhost', settings['port'], is_host=True, backlog=max(settings['clients'], 100))
+    time.sleep(.2)
+
+    context = multiprocessing.get_context('spawn')
+    ready_queue, result_queue, start_event = context.Queue(), context.Queue(), context.Event()
+    process_count = max(min(settings['processes'], settings['clients']), 1)
+    processes = []
+    for i in range(process_count):
+        client_count = settings['clients'] // process_count + (1 if i < settings['clients'] % process_count else 0)
+        processes.append(context.Process(target=_client_process, args=(settings, client_count, ready_queue, start_event, result_queue), daemon=True))
+
+    # everything the host allocates while the clients connect, divided by the number of connections
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    for process in processes:
+        process.start()
+
+    ready = 0
+    for process in processes:
+        while True:
+            host.update(max_events=1000)
+            try:
+                ready += ready_queue.get(timeout=.01)
+                break
+            except queue.Empty:
+                pass
+
+    timeout = time.time() + 5
+    while host.connection_count() < ready and time.time() < timeout:
+        host.update(max_events=1000)
+        time.sleep(.01)
+    connection_count = host.connection_count()
+    memory_per_connection = (tracemalloc.get_traced_memory()[0] - memory_before) / max(connection_count, 1)
+    tracemalloc.stop()
+
+    host.measuring = True
+    start_event.set()
+    start_time = time.time()
+    cpu_start = time.process_time()
+    broadcast_count = 0
+    next_broadcast = start_time
+    position = Vec3(1.5, 2.5, 3.5)
+    while time.time() - start_time < settings['duration'] + .5:
+        host.update(max_events=10000)
+        if settings['broadcast_rate'] and time.time() >= next_broadcast and time.time() - start_time < settings['duration']:
+            next_broadcast += 1 / settings['broadcast_rate']
+            host.broadcast('bench_broadcast', time.time(), position)
+            broadcast_count += 1
+        time.sleep(.001)
+    cpu_time = time.process_time() - cpu_start
+
+    client_results = [result_queue.get(timeout=30) for process in processes]
+    for process in processes:
+        process.join(timeout=5)
+    host.stop()
+
+    client_latencies = dict()
+    for result in client_results:
+        for name, values in result['latencies'].items():
+            client_latencies.setdefault(name, []).extend(values)
+
+    duration = settings['duration']
+    host_messages = host.message_count
+    handled_messages = host_messages + broadcast_count * connection_count + len(client_latencies.get('echo', ()))
+    return dict(
+        settings = settings,
+        connections = connection_count,
+        client_messages_sent = sum(r['sent'] for r in client_results),
+        host_messages_received = host_messages,
+        host_messages_per_second = host_messages / duration,
+        host_bytes_per_second = host.byte_count / duration,
+        broadcasts_sent = broadcast_count,
+        broadcast_messages_received = len(client_latencies.get('broadcast', ())),
+        latency = dict(
+            position = get_latency_stats(host.latencies.get('position')),
+            blob = get_latency_stats(host.latencies.get('blob')),
+            echo_round_trip = get_latency_stats(client_latencies.get('echo')),
+            broadcast = get_latency_stats(client_latencies.get('broadcast')),
+            ),
+        host_cpu_seconds = cpu_time,
+        host_cpu_us_per_message = cpu_time / max(handled_messages, 1) * 1_000_000,
+        host_memory_per_connection_bytes = memory_per_connection,
+        )
+
+
+def print_results(results):
+    print(f"connections:                {results['connections']}")
+    print(f"host messages received:     {results['host_messages_received']} ({results['host_messages_per_second']:.0f}/s, {results['host_bytes_per_second'] / 1024:.1f} KB/s)")
+    if results['broadcasts_sent']:
+        print(f"broadcasts:                 {results['broadcasts_sent']} sent, {results['broadcast_messages_received']} received")
+    for name, stats in results['latency'].items():
+        if stats:
+            print(f"{name + ' latency:':<28}p50 {stats['p50_ms']:.2f} ms, p99 {stats['p99_ms']:.2f} ms, max {stats['max_ms']:.2f} ms ({stats['count']} messages)")
+    print(f"host cpu per message:       {results['host_cpu_us_per_message']:.1f} us")
+    print(f"host memory per connection: {results['host_memory_per_connection_bytes'] / 1024:.1f} KB")
+
+
+
+if __name__ == '__main__':
+    settings = dict(default_settings)
+    for arg in sys.argv[1:]:
+        if arg == '--help':
+            print(dedent(f'''
+                Load test for the networking module. Starts a host and simulated clients on localhost.
+
+                --clients=*         # number of clients, default: {default_settings['clients']}
+                --processes=*       # number of processes to run the clients in, default: {default_settings['processes']}
+                --duration=*        # seconds to measure for, default: {default_settings['duration']}
+                --rate=*            # messages per second from each client, default: {default_settings['rate']}
+                --mix=*             # weights of the messages the clients send, for example: --mix=position=8,blob=1,echo=1
+                --blob_size=*       # size of the blob messages in bytes, default: {default_settings['blob_size']}
+                --broadcast_rate=*  # broadcasts per second from the host to all clients, default: {default_settings['broadcast_rate']}
+                --port=*            # default: {default_settings['port']}
+                --udp               # use UDP instead of TCP
+                --decode_on_network_thread  # decode the host's RPCs on the networking thread
+                --json=*            # write the results to this file, or use --json=- to print them as json
+                '''))
+            sys.exit()
+
+        elif arg == '--udp':
+            settings['use_udp'] = True
+        elif arg == '--decode_on_network_thread':
+            settings['decode_on_network_thread'] = True
+
+        elif arg.startswith('--') and '=' in arg:
+            key, value = arg[2:].split('=', 1)
+            if key not in settings:
+                print('unknown argument:', arg)
+                sys.exit(1)
+            if key in ('clients', 'processes', 'blob_size', 'port'):
+                value = int(value)
+            elif key in ('duration', 'rate', 'broadcast_rate'):
+                value = float(value)
+            settings[key] = value
+
+    results = run_benchmark(**settings)
+    if settings['json'] == '-':
+        print(json.dumps(results, indent=4))
+    else:
+        print_results(results)
+        if settings['json']:
+            with open(settings['json'], 'w') as f:
+                json.dump(results, f, indent=4)
@@ -5,9 +5,10 @@ from ursina.scene import instance as scene
 from panda3d.core import CollisionTraverser, CollisionNode, CollisionHandlerQueue, CollisionRay
 from ursina.vec3 import Vec3
 from copy import copy
-from ursina.hit_info import HitInfo
-from ursina import ursinamath, color
+from ursina.hit_info import HitInfo, hit_info_from_entries, batch_hit_info_from_entries
+from ursina import color
 from ursina.ursinastuff import destroy
+from ursina.collider import get_collide_mask
 
 
 
@@ -26,10 +27,12 @@ _ray.setDirection(Vec3(0,0,1))
 _raycaster._pickerNode.addSolid(_ray)
 
 
-def raycast(origin, direction:Vec3=(0,0,1), distance=9999, traverse_target:Entity=scene, ignore:list=None, debug=False, color=color.white):
+def raycast(origin, direction:Vec3=(0,0,1), distance=9999, traverse_target:Entity=scene, ignore:list=None, debug=False, color=color.white, layers=None, first_hit_only=False, hit_info=None):
     if not ignore:
         ignore = []
 
+    _raycaster._pickerNode.set_from_collide_mask(get_collide_mask(layers))
+
     _raycaster.position = origin
     _raycaster.look_at(_raycaster.position + direction)
 
@@ -41,41 +44,66 @@ def raycast(origin, direction:Vec3=(0,0,1), distance=9999, traverse_target:Entit
     _raycaster._picker.traverse(traverse_target)      #HALF!
 
     if _raycaster._pq.get_num_entries() == 0:
-        _raycaster.hit = HitInfo(hit=False, distance=distance)
-        return _raycaster.hit
-
+        if hit_info is not None:
+            return hit_info.reset(hit=False, distance=distance)
+        return HitInfo(hit=False, distance=distance)
 
     _raycaster._pq.sort_entries()
-    entries = _raycaster._pq.getEntries()
-    entities = [e.get_into_node_path().parent.getPythonTag('Entity') for e in entries]
-
-    entries = [        # filter out ignored entities
-        e for i, e in enumerate(entries)
-        if entities[i] in scene.collidables
-        and entities[i] not in ignore
-        and ursinamath.distance(_raycaster.world_position, e.get_surface_point(builtins.render)) <= distance
-        ]
-
-    if len(entries) == 0:
-        return HitInfo(hit=False)
-
-    _raycaster.collision = entries[0]
-    nP = _raycaster.collision.get_into_node_path().parent
-    point = Vec3(*_raycaster.collision.get_surface_point(nP))
-    world_point = Vec3(*_raycaster.collision.get_surface_point(builtins.render))
+    return hit_info_from_entries(_raycaster._pq.getEntries(), _raycaster.getPos(builtins.render), distance, ignore, first_hit_only, hit_info)
+
+
+_batch_raycaster = Entity(add_to_scene_entities=False)
+_batch_raycaster._picker = CollisionTraverser()
+_batch_raycaster._pq = CollisionHandlerQueue()
+_batch_raycaster._rays = []     # (NodePath, CollisionRay), reused between calls
+_batch_raycaster._active_ray_count = 0
+
+
+def _set_batch_ray_count(n):
+    rays = _batch_raycaster._rays
+    while len(rays) < n:
+        node = CollisionNode(f'_batch_ray_{len(rays)}')
+        node.set_into_collide_mask(0)
+        ray = CollisionRay()
+        node.addSolid(ray)
+        node_path = _batch_raycaster.attach_new_node(node)
+        node_path.setPythonTag('batch_index', len(rays))
+        rays.append((node_path, ray))
+
+    for i in range(_batch_raycaster._active_ray_count, n):
+        _batch_raycaster._picker.addCollider(rays[i][0], _batch_raycaster._pq)
+    for i in range(n, _batch_raycaster._active_ray_count):
+        _batch_raycaster._picker.removeCollider(rays[i][0])
+    _batch_raycaster._active_ray_count = n
+
+
+def raycast_batch(origins, directions=(0,0,1), distances=9999, traverse_target:Entity=scene, ignore:list=None, layers=None, ignore_per_ray:list=None):
+    ''' Casts many rays with a single traversal of the scene. origins and directions are numpy arrays
+    (or lists) of shape (n,3), distances of shape (n,). directions and distances can also be a single value for all rays.
+    ignore_per_ray is an optional list with one entity (or None) per ray, that only that ray ignores.
+    Returns a BatchHitInfo with one row per ray.
+    '''
+    import numpy as np
 
-    hit_info = HitInfo(hit=True)
-    hit_info.entities = [e.get_into_node_path().parent.getPythonTag('Entity') for e in entries]
-    hit_info.entity = hit_info.entities[0]
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+    n = len(origins)
+    directions = np.broadcast_to(np.asarray(directions, dtype=np.float64).reshape(-1, 3), (n, 3))
+    lengths = np.linalg.norm(directions, axis=1)
+    lengths[lengths == 0] = 1
+    directions = directions / lengths[:,None]
+    distances = np.broadcast_to(np.asarray(distances, dtype=np.float64).ravel(), (n, ))
 
-    hit_info.point = point
-    hit_info.world_point = world_point
-    hit_info.distance = ursinamath.distance(_raycaster.world_position, hit_info.world_point)
+    _set_batch_ray_count(n)
+    mask = get_collide_mask(layers)
+    for (node_path, ray), origin, direction in zip(_batch_raycaster._rays, origins.tolist(), directions.tolist()):
+        node_path.node().set_from_collide_mask(mask)
+        ray.setOrigin(*origin)
+        ray.setDirection(*direction)
 
-    hit_info.normal = Vec3(*_raycaster.collision.get_surface_normal(_raycaster.collision.get_into_node_path().parent).normalized())
-    hit_info.world_normal = Vec3(*_raycaster.collision.get_surface_normal(builtins.render).normalized())
+    _batch_raycaster._pq.clear_entries()
+    _batch_raycaster._picker.traverse(traverse_target)
 
-    return hit_info
+    return batch_hit_info_from_entries(_batch_raycaster._pq.getEntries(), origins, distances, ignore, ignore_per_cast=ignore_per_ray)
 
 
 if __name__ == '__main__':
@@ -89,6 +117,8 @@ if __name__ == '__main__':
 
     Use optional *traverse_target* to only be able to hit a specific entity and its children/descendants.
     Use optional *ignore* list to ignore certain entities.
+    Use optional *layers* to only hit entities in those collision layers, for example layers=('ground', 'enemy').
+    Set first_hit_only to True if you don't need hit_info.entities, and give it a HitInfo as hit_info to reuse that instead of making a new one.
     Setting debug to True will draw the line on screen.
 
     Example where we only move if a wall is not hit:
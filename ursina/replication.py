@@ -0,0 +1,702 @@
+from typing import Annotated
+from ursina.entity import Entity
+from ursina.vec2 import Vec2
+from ursina.vec3 import Vec3
+from ursina.color import Color
+from ursina.networking import Channel, procedure_hash
+from math import floor, ceil
+import time
+
+
+class ReplicatedField:
+    ''' A field of a replicated entity, like position or rotation. Values get quantized to integers on the host,
+    so only changes bigger than precision get sent.
+    kind is 'vec3', 'vec2', 'float', 'angle3' (like rotation), 'angle', 'int', 'bool' or 'color'.
+    Angles always use 16 bits per axis, so precision is ignored for them.
+    '''
+    kinds = {'vec3': 3, 'vec2': 2, 'float': 1, 'angle3': 3, 'angle': 1, 'int': 1, 'bool': 1, 'color': 4}
+
+    def __init__(self, name, kind='float', precision=.01):
+        if kind not in ReplicatedField.kinds:
+            raise ValueError(f'unknown replicated field kind: {kind}, expected one of: {", ".join(ReplicatedField.kinds)}')
+        self.name = name
+        self.kind = kind
+        self.precision = precision
+        self.size = ReplicatedField.kinds[kind]
+        self.wrap = 65536 if kind in ('angle3', 'angle') else None  # angles wrap around, so deltas between them can be kept small
+
+
+    def quantize(self, value):
+        if self.kind in ('vec3', 'vec2'):
+            return tuple(round(value[i] / self.precision) for i in range(self.size))
+        if self.kind == 'float':
+            return (round(value / self.precision), )
+        if self.kind == 'angle3':
+            return tuple(round(value[i] % 360 / 360 * 65536) % 65536 for i in range(3))
+        if self.kind == 'angle':
+            return (round(value % 360 / 360 * 65536) % 65536, )
+        if self.kind == 'color':
+            return tuple(round(value[i] * 255) for i in range(4))
+        return (int(value), )
+
+
+    def dequantize(self, values):
+        if self.kind == 'vec3':
+            return Vec3(*values) * self.precision
+        if self.kind == 'vec2':
+            return Vec2(*values) * self.precision
+        if self.kind == 'float':
+            return values[0] * self.precision
+        if self.kind == 'angle3':
+            return Vec3(*values) * (360 / 65536)
+        if self.kind == 'angle':
+            return values[0] * (360 / 65536)
+        if self.kind == 'color':
+            return Color(*(v / 255 for v in values))
+        if self.kind == 'bool':
+            return bool(values[0])
+        return values[0]
+
+
+    def interpolate(self, a, b, t):    # a and b are quantized
+        if self.kind in ('int', 'bool'):
+            return self.dequantize(a)
+        if self.wrap:   # take the shortest way around
+            values = [x + ((y - x + 32768) % 65536 - 32768) * t for x, y in zip(a, b)]
+        else:
+            values = [x + (y - x) * t for x, y in zip(a, b)]
+        return self.dequantize(values)
+
+
+
+def _write_varint(buffer, value):
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+        if shift > 63:
+            raise ValueError('varint too long')
+
+
+def _write_signed(buffer, value):   # zigzag, so small negative numbers stay small too
+    _write_varint(buffer, value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def _read_signed(data, position):
+    value, position = _read_varint(data, position)
+    return (value >> 1) ^ -(value & 1), position
+
+
+
+class Replication(Entity):
+    ''' Keeps entities on the host in sync with the clients of an RPCPeer, by sending snapshots of their replicated fields tick_rate times per second.
+    Each client only gets what changed since the last snapshot it acknowledged, with the fields quantized, so entities that
+    don't move cost nothing and moving ones only a few bytes. Clients interpolate between snapshots, interpolation_delay seconds behind the host.
+
+    Register the same classes on both sides, before starting the peer. On the host, call add(entity) to replicate an entity.
+    Clients spawn their own copy with spawn(), which is the class itself by default, and destroy it when the host stops replicating it.
+    Snapshots bigger than max_snapshot_part_size get split over several reliable messages, which the clients put back together before applying.
+    With use_udp=True, snapshots that fit in a single packet go over Channel.UNRELIABLE_SEQUENCED.
+
+    Set filter to a function taking a connection and returning the set of entities it should get, or None for all of them,
+    or use an InterestManager to only send what's near each connection.
+    '''
+    history_size = 32
+    max_snapshot_part_size = 60000  # bytes, so each message stays below the 64 KiB limit of bytes arguments and of the default length_prefix
+
+    def __init__(self, rpc_peer, tick_rate=20, interpolation_delay=.1, **kwargs):
+        super().__init__(eternal=True)
+        self.rpc_peer = rpc_peer
+        self.tick_rate = tick_rate
+        self.interpolation_delay = interpolation_delay
+        self.filter = None
+
+        self.classes = dict()       # class hash -> (class, fields, spawn)
+        self.class_hashes = dict()  # class -> class hash
+
+        # host
+        self.entities = dict()      # net id -> entity
+        self.net_ids = dict()       # entity -> net id
+        self.next_net_id = 1
+        self.tick = 0
+        self.tick_timer = 0
+        self.snapshots = dict()     # tick -> {net id: (class hash, quantized values per field)}
+        self.connection_states = dict()     # connection -> (last acknowledged tick, {tick: ids sent or None for all})
+
+        # client
+        self.received_snapshots = dict()    # same as snapshots, but the ones received from the host
+        self.latest_received_tick = 0
+        self.partial_snapshots = dict()     # tick -> list of the parts received so far, None for the missing ones
+        self.clock_offset = None    # local time - host time
+        self.replicated_entities = dict()   # net id -> entity spawned on this side
+
+        rpc_peer.register_procedure(self.replication_snapshot, client_only=True, channel=Channel.UNRELIABLE_SEQUENCED)
+        rpc_peer.register_procedure(self.replication_snapshot_reliable, client_only=True)
+        rpc_peer.register_procedure(self.replication_ack, host_only=True, channel=Channel.UNRELIABLE_SEQUENCED)
+
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+    def register_class(self, cls, fields=None, spawn=None):
+        ''' fields is a list of ReplicatedFields or a dict of field name -> kind. If it's not given, the class' replicated_fields get used
+        if it has them, else position and rotation.
+        '''
+        if fields is None:
+            fields = getattr(cls, 'replicated_fields', {'position': 'vec3', 'rotation': 'angle3'})
+        if isinstance(fields, dict):
+            fields = [ReplicatedField(name, kind) for name, kind in fields.items()]
+        if sum(field.size for field in fields) > 62:
+            raise ValueError('replicated classes can have at most 62 values, counting each axis of a vector')
+
+        class_hash = procedure_hash(cls.__name__) & 0xFFFF
+        if class_hash in self.classes and self.classes[class_hash][0] is not cls:
+            raise Exception(f'{cls.__name__} has the same hash as {self.classes[class_hash][0].__name__}, rename one of them.')
+        self.classes[class_hash] = (cls, fields, spawn or cls)
+        self.class_hashes[cls] = class_hash
+
+
+    def add(self, entity):
+        if entity in self.net_ids:
+            return self.net_ids[entity]
+        if not any(c in self.class_hashes for c in type(entity).__mro__):
+            raise Exception(f'register_class({type(entity).__name__}) before replicating it.')
+
+        net_id = self.next_net_id   # ids are never reused, so old snapshots can't mix up two entities
+        self.next_net_id += 1
+        self.entities[net_id] = entity
+        self.net_ids[entity] = net_id
+        entity.net_id = net_id
+        return net_id
+
+
+    def remove(self, entity):
+        net_id = self.net_ids.pop(entity, None)
+        if net_id is not None:
+            del self.entities[net_id]
+
+
+    def update(self):
+        if not self.rpc_peer.is_running():
+            if self.replicated_entities or self.received_snapshots:
+                self.clear()
+            return
+
+        if self.rpc_peer.is_hosting():
+            self.tick_timer += time.dt
+            if self.tick_timer >= 1 / self.tick_rate:
+                self.tick_timer = min(self.tick_timer - 1 / self.tick_rate, 1 / self.tick_rate)
+                self.send_snapshot()
+        else:
+            self.apply_snapshots()
+
+
+    def clear(self):
+        from ursina import destroy
+        for entity in self.replicated_entities.values():
+            destroy(entity)
+        self.replicated_entities.clear()
+        self.received_snapshots.clear()
+        self.partial_snapshots.clear()
+        self.latest_received_tick = 0
+        self.clock_offset = None
+        self.connection_states.clear()
+
+
+    def take_snapshot(self):
+        snapshot = dict()
+        for net_id, entity in list(self.entities.items()):
+            if entity.is_empty():   # destroyed
+                self.remove(entity)
+                continue
+            class_hash = next(self.class_hashes[c] for c in type(entity).__mro__ if c in self.class_hashes)
+            fields = self.classes[class_hash][1]
+            snapshot[net_id] = (class_hash, tuple(field.quantize(getattr(entity, field.name)) for field in fields))
+        return snapshot
+
+
+    def send_snapshot(self):
+        self.tick += 1
+        snapshot = self.take_snapshot()
+        self.snapshots[self.tick] = snapshot
+        self.snapshots.pop(self.tick - Replication.history_size, None)
+
+        connections = self.rpc_peer.get_connections()
+        for connection in [c for c in self.connection_states if c not in connections]:
+            del self.connection_states[connection]
+
+        recipients = dict()     # (baseline tick, id of the ids sent) -> (ids sent, connections), so clients in the same situation share the message
+        for connection in connections:
+            if connection not in self.connection_states:
+                self.connection_states[connection] = [0, dict()]
+            state = self.connection_states[connection]
+
+            ids = None
+            if self.filter is not None:
+                visible = self.filter(connection)
+                if visible is not None:
+                    ids = frozenset(self.net_ids[e] for e in visible if e in self.net_ids and self.net_ids[e] in snapshot)
+
+            baseline = state[0] if state[0] in self.snapshots and state[0] in state[1] else 0
+            state[1][self.tick] = ids
+            state[1].pop(self.tick - Replication.history_size, None)
+
+            key = (baseline, id(ids) if ids is not None else None, id(state[1][baseline]) if baseline and state[1][baseline] is not None else None)
+            recipients.setdefault(key, (ids, baseline, []))[2].append(connection)
+
+        for ids, baseline, group in recipients.values():
+            parts = self.encode_delta(baseline, ids, self.connection_states[group[0]][1].get(baseline))
+            if len(parts) == 1 and self.rpc_peer.peer.use_udp and len(parts[0]) + 32 <= self.rpc_peer.peer.max_unreliable_message_size():
+                self.rpc_peer.multicast(group, 'replication_snapshot', self.tick, baseline, 0, 1, parts[0])
+                continue
+            for i, data in enumerate(parts):
+                self.rpc_peer.multicast(group, 'replication_snapshot_reliable', self.tick, baseline, i, len(parts), data)
+
+
+    def encode_delta(self, baseline, ids, baseline_ids):
+        ''' Encodes the current snapshot against the baseline tick (0 for none), only including the net ids in ids, or all of them if it's None.
+        Format: removed count and ids, then changed count and for each: id, mask (bit 0 for new, then one bit per changed value, counting each axis),
+        class hash and all values if new, else the difference of each changed value. All numbers are varints and ids are sorted and delta coded.
+        Returns a list of parts of at most max_snapshot_part_size bytes each, that get decoded one after the other on top of the baseline.
+        '''
+        snapshot = self.snapshots[self.tick]
+        base = self.snapshots[baseline] if baseline else dict()
+        if baseline_ids is not None:
+            base = {net_id: base[net_id] for net_id in baseline_ids if net_id in base}
+        current_ids = snapshot.keys() if ids is None else ids
+
+        parts = []  # [removed, removed count, changes, change count, previous id], the ids get delta coded from the start of each part
+
+        def get_part(size):     # size is the most the next entry can take, counting its id
+            if not parts or len(parts[-1][0]) + len(parts[-1][2]) + size + 20 > self.max_snapshot_part_size:    # 20 for the two counts
+                parts.append([bytearray(), 0, bytearray(), 0, 0])
+            return parts[-1]
+
+        get_part(0)
+        for net_id in sorted(net_id for net_id in base if net_id not in snapshot or (ids is not None and net_id not in ids)):
+            part = get_part(10)
+            _write_varint(part[0], net_id - part[4])
+            part[1] += 1
+            part[4] = net_id
+
+        for part in parts:
+            part[4] = 0
+        for net_id in sorted(current_ids):
+            class_hash, values = snapshot[net_id]
+            old = base.get(net_id)
+            if old is not None and old[1] == values:
+                continue
+
+            change = bytearray()
+            fields = self.classes[class_hash][1]
+            if old is None:
+                _write_varint(change, 1)
+                _write_varint(change, class_hash)
+                for field_values in values:
+                    for v in field_values:
+                        _write_signed(change, v)
+            else:
+                mask = 0
+                bit = 2
+                differences = []
+                for field, field_values, old_field_values in zip(fields, values, old[1]):
+                    if field_values == old_field_values:
+                        bit <<= field.size
+                        continue
+                    for v, old_v in zip(field_values, old_field_values):
+                        if v != old_v:
+                            difference = v - old_v
+                            if field.wrap:
+                                difference = (difference + field.wrap // 2) % field.wrap - field.wrap // 2
+                            differences.append(difference)
+                            mask |= bit
+                        bit <<= 1
+                _write_varint(change, mask)
+                for difference in differences:
+                    _write_signed(change, difference)
+
+            part = get_part(len(change) + 10)
+            _write_varint(part[2], net_id - part[4])
+            part[2] += change
+            part[3] += 1
+            part[4] = net_id
+
+        encoded_parts = []
+        for removed, removed_count, changes, change_count, _ in parts:
+            buffer = bytearray()
+            _write_varint(buffer, removed_count)
+            buffer += removed
+            _write_varint(buffer, change_count)
+            buffer += changes
+            encoded_parts.append(bytes(buffer))
+        return encoded_parts
+
+
+    def decode_delta(self, data, base):
+        snapshot = dict(base)
+        position = 0
+        count, position = _read_varint(data, position)
+        net_id = 0
+        for i in range(count):
+            difference, position = _read_varint(data, position)
+            net_id += difference
+            snapshot.pop(net_id, None)
+
+        count, position = _read_varint(data, position)
+        net_id = 0
+        for i in range(count):
+            difference, position = _read_varint(data, position)
+            net_id += difference
+            mask, position = _read_varint(data, position)
+            if mask & 1:
+                class_hash, position = _read_varint(data, position)
+                fields = self.classes[class_hash][1]
+                values = []
+                for field in fields:
+                    field_values = []
+                    for j in range(field.size):
+                        v, position = _read_signed(data, position)
+                        field_values.append(v)
+                    values.append(tuple(field_values))
+                snapshot[net_id] = (class_hash, tuple(values))
+                continue
+
+            class_hash, old_values = snapshot[net_id]
+            fields = self.classes[class_hash][1]
+            values = []
+            bit = 2
+            for field, old_field_values in zip(fields, old_values):
+                if not mask & (((1 << field.size) - 1) * bit):
+                    values.append(old_field_values)
+                    bit <<= field.size
+                    continue
+                field_values = []
+                for old_v in old_field_values:
+                    if mask & bit:
+                        v, position = _read_signed(data, position)
+                        v += old_v
+                        if field.wrap:
+                            v %= field.wrap
+                        field_values.append(v)
+                    else:
+                        field_values.append(old_v)
+                    bit <<= 1
+                values.append(tuple(field_values))
+            snapshot[net_id] = (class_hash, tuple(values))
+
+        if position != len(data):
+            raise ValueError('snapshot has data left over')
+        return snapshot
+
+
+    def replication_snapshot(self, connection, time_received, tick: Annotated[int, 'u32'], baseline: Annotated[int, 'u32'],
+            part: Annotated[int, 'u16'], part_count: Annotated[int, 'u16'], data: bytes):
+        if tick <= self.latest_received_tick:  # old or duplicate
+            return
+        if baseline and baseline not in self.received_snapshots:   # can't decode it, the host will use an older baseline
+            return
+
+        parts = [data]
+        if part_count > 1:  # wait for the rest of the parts
+            parts = self.partial_snapshots.setdefault(tick, [None] * part_count)
+            if len(parts) != part_count or part >= part_count:
+                print('WARNING: Received invalid snapshot part')
+                return
+            parts[part] = data
+            for old_tick in [t for t in self.partial_snapshots if t <= tick - Replication.history_size]:
+                del self.partial_snapshots[old_tick]
+            if None in parts:
+                return
+
+        try:
+            snapshot = self.received_snapshots[baseline] if baseline else dict()
+            for data in parts:
+                snapshot = self.decode_delta(data, snapshot)
+        except Exception as e:
+            print('WARNING: Received invalid snapshot:', e)
+            return
+
+        self.received_snapshots[tick] = snapshot
+        for old_tick in [t for t in self.received_snapshots if t <= tick - Replication.history_size]:
+            del self.received_snapshots[old_tick]
+        for old_tick in [t for t in self.partial_snapshots if t <= tick]:
+            del self.partial_snapshots[old_tick]
+        self.latest_received_tick = tick
+        self.rpc_peer.replication_ack(connection, tick)
+
+        offset = time_received - tick / self.tick_rate
+        if self.clock_offset is None or offset < self.clock_offset:     # the least delayed snapshot is the best estimate
+            self.clock_offset = offset
+        else:
+            self.clock_offset += (offset - self.clock_offset) * .05
+
+    def replication_snapshot_reliable(self, connection, time_received, tick: Annotated[int, 'u32'], baseline: Annotated[int, 'u32'],
+            part: Annotated[int, 'u16'], part_count: Annotated[int, 'u16'], data: bytes):
+        self.replication_snapshot(connection, time_received, tick, baseline, part, part_count, data)
+
+
+    def replication_ack(self, connection, time_received, tick: Annotated[int, 'u32']):
+        state = self.connection_states.get(connection)
+        if state is not None and state[0] < tick <= self.tick:
+            state[0] = tick
+
+
+    def apply_snapshots(self):
+        if not self.received_snapshots:
+            return
+
+        render_tick = (time.time() - self.clock_offset - self.interpolation_delay) * self.tick_rate
+        ticks = sorted(self.received_snapshots)
+        older = max((t for t in ticks if t <= render_tick), default=ticks[0])
+        newer = min((t for t in ticks if t > older), default=older)
+        t = 0
+        if newer != older:
+            t = min(max((render_tick - older) / (newer - older), 0), 1)
+
+        snapshot = self.received_snapshots[older]
+        next_snapshot = self.received_snapshots[newer]
+        for net_id in [net_id for net_id in self.replicated_entities if net_id not in snapshot]:
+            from ursina import destroy
+            destroy(self.replicated_entities.pop(net_id))
+
+        for net_id, (class_hash, values) in snapshot.items():
+            cls, fields, spawn = self.classes[class_hash]
+            entity = self.replicated_entities.get(net_id)
+            if entity is None:
+                entity = spawn()
+                entity.net_id = net_id
+                self.replicated_entities[net_id] = entity
+
+            next_values = next_snapshot.get(net_id, (class_hash, values))[1]
+            for i, field in enumerate(fields):
+                if values[i] == next_values[i]:
+                    value = field.dequantize(values[i])
+                else:
+                    value = field.interpolate(values[i], next_values[i], t)
+                setattr(entity, field.name, value)
+
+
+
+class InterestManager(Entity):
+    ''' Keeps track of which entities each connection is interested in, so the host doesn't have to send everything to everyone.
+    Entities are kept in a uniform grid and only move to another cell when they cross a cell boundary. Each connection has a viewer entity,
+    usually its player, and watches the cells within cell_range of the viewer's cell, or within radius of it if radius is set,
+    in which case the entities also get checked against the radius. Entities in always_visible are visible to everyone.
+
+    Pass a Replication to track its entities and only replicate the visible ones to each connection.
+    get_interested(entity) returns the connections interested in an entity, to use with RPCPeer.multicast().
+    '''
+    def __init__(self, replication=None, cell_size=32, radius=None, cell_range=1, **kwargs):
+        super().__init__(eternal=True)
+        self.cell_size = cell_size
+        self.radius = radius
+        self.cell_range = cell_range
+        self.always_visible = set()
+
+        self.cells = dict()         # cell -> set of entities
+        self.entity_cells = dict()  # entity -> cell
+        self.viewers = dict()       # connection -> [viewer entity, radius, center cell, watched cells, entities in the watched cells]
+        self.watchers = dict()      # cell -> set of connections watching it
+
+        self.replication = replication
+        if replication is not None:
+            replication.filter = self.get_visible
+
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+    def get_cell(self, position):
+        return (floor(position[0] / self.cell_size), floor(position[1] / self.cell_size), floor(position[2] / self.cell_size))
+
+
+    def add(self, entity):
+        if entity in self.entity_cells:
+            return
+        cell = self.get_cell(entity.world_position)
+        self.entity_cells[entity] = cell
+        self.cells.setdefault(cell, set()).add(entity)
+        for connection in self.watchers.get(cell, ()):
+            self.viewers[connection][4].add(entity)
+
+
+    def remove(self, entity):
+        cell = self.entity_cells.pop(entity, None)
+        if cell is None:
+            return
+        self._remove_from_cell(entity, cell)
+        for connection in self.watchers.get(cell, ()):
+            self.viewers[connection][4].discard(entity)
+
+
+    def _remove_from_cell(self, entity, cell):
+        cell_entities = self.cells.get(cell)
+        if cell_entities is None:
+            return
+        cell_entities.discard(entity)
+        if not cell_entities:
+            del self.cells[cell]
+
+
+    def set_viewer(self, connection, entity, radius=None):
+        ''' connection will be interested in what's around entity. radius overrides the InterestManager's radius for this connection. '''
+        self.remove_viewer(connection)
+        self.viewers[connection] = [entity, radius if radius is not None else self.radius, None, set(), set()]
+        self._watch(connection)
+
+
+    def remove_viewer(self, connection):
+        viewer = self.viewers.pop(connection, None)
+        if viewer is None:
+            return
+        for cell in viewer[3]:
+            self._unwatch_cell(connection, cell)
+
+
+    def _unwatch_cell(self, connection, cell):
+        cell_watchers = self.watchers.get(cell)
+        if cell_watchers is None:
+            return
+        cell_watchers.discard(connection)
+        if not cell_watchers:
+            del self.watchers[cell]
+
+
+    def _watch(self, connection):   # watches the cells around the viewer, only changing the ones that differ from before
+        viewer = self.viewers[connection]
+        center = self.get_cell(viewer[0].world_position)
+        if center == viewer[2]:
+            return
+        viewer[2] = center
+
+        r = self.cell_range if viewer[1] is None else ceil(viewer[1] / self.cell_size)
+        cells = {(x, y, z) for x in range(center[0]-r, center[0]+r+1) for y in range(center[1]-r, center[1]+r+1) for z in range(center[2]-r, center[2]+r+1)}
+        old_cells, candidates = viewer[3], viewer[4]
+        for cell in old_cells - cells:
+            self._unwatch_cell(connection, cell)
+            candidates.difference_update(self.cells.get(cell, ()))
+        for cell in cells - old_cells:
+            self.watchers.setdefault(cell, set()).add(connection)
+            candidates.update(self.cells.get(cell, ()))
+        viewer[3] = cells
+
+
+    def update(self):
+        if self.replication is not None:
+            replicated = self.replication.net_ids.keys()
+            for entity in replicated - self.entity_cells.keys():
+                self.add(entity)
+            for entity in self.entity_cells.keys() - replicated:
+                self.remove(entity)
+
+        for entity, cell in list(self.entity_cells.items()):
+            if entity.is_empty():   # destroyed
+                self.remove(entity)
+                continue
+
+            new_cell = self.get_cell(entity.world_position)
+            if new_cell == cell:
+                continue
+            self._remove_from_cell(entity, cell)
+            self.cells.setdefault(new_cell, set()).add(entity)
+            self.entity_cells[entity] = new_cell
+            old_watchers, new_watchers = self.watchers.get(cell, set()), self.watchers.get(new_cell, set())
+            for connection in old_watchers - new_watchers:
+                self.viewers[connection][4].discard(entity)
+            for connection in new_watchers - old_watchers:
+                self.viewers[connection][4].add(entity)
+
+        for connection, viewer in list(self.viewers.items()):
+            if not connection.connected or viewer[0].is_empty():
+                self.remove_viewer(connection)
+            else:
+                self._watch(connection)
+
+
+    def get_visible(self, connection):
+        ''' Returns the set of entities connection is interested in. Connections without a viewer only get always_visible. '''
+        viewer = self.viewers.get(connection)
+        if viewer is None:
+            return set(self.always_visible)
+        if viewer[1] is None:
+            return viewer[4] | self.always_visible
+
+        position = viewer[0].world_position
+        radius_squared = viewer[1] ** 2
+        visible = {e for e in viewer[4] if not e.is_empty() and (e.world_position - position).length_squared() <= radius_squared}
+        return visible | self.always_visible
+
+
+    def get_interested(self, entity):
+        ''' Returns the connections interested in entity. '''
+        if entity in self.always_visible:
+            return list(self.viewers)
+        cell = self.entity_cells.get(entity)
+        if cell is None:
+            cell = self.get_cell(entity.world_position)
+
+        connections = []
+        for connection in self.watchers.get(cell, ()):
+            viewer = self.viewers[connection]
+            if viewer[1] is None or (entity.world_position - viewer[0].world_position).length_squared() <= viewer[1] ** 2:
+                connections.append(connection)
+        return connections
+
+
+
+if __name__ == '__main__':
+    from ursina import *
+    from ursina.networking import RPCPeer
+    app = Ursina(borderless=False)
+
+    '''
+    Press H to host or C to connect. The host moves a few hundred cubes around, and the clients get them
+    through delta compressed snapshots instead of an RPC per cube per update.
+    '''
+    peer = RPCPeer()
+
+    class Cube(Entity):
+        replicated_fields = {'position': 'vec3', 'rotation_y': 'angle', 'color': 'color'}
+
+        def __init__(self, **kwargs):
+            super().__init__(model='cube', scale=.5, **kwargs)
+
+    replication = Replication(peer)
+    replication.register_class(Cube)
+    status_text = Text('Press H to host or C to connect.', origin=(0,0), y=.45)
+
+    def update():
+        peer.update()
+        if peer.is_hosting():
+            for e in replication.entities.values():
+                e.rotation_y += 90 * time.dt
+                e.x = e.start_x + math.sin(time.time() + e.start_x) * 2
+
+    def input(key):
+        if peer.is_running():
+            return
+        if key == 'h':
+            peer.start('localhost', 8080, is_host=True)
+            status_text.text = 'Hosting on localhost, port 8080.'
+            for i in range(300):
+                e = Cube(position=(random.uniform(-20,20), 0, random.uniform(-20,20)), color=color.random_color())
+                e.start_x = e.x
+                replication.add(e)
+        elif key == 'c':
+            peer.start('localhost', 8080, is_host=False)
+            status_text.text = 'Connected to localhost, port 8080.'
+
+    EditorCamera(rotation_x=40)
+    app.run()
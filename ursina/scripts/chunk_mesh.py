@@ -1,73 +1,202 @@
 from ursina import *
-from math import floor
-
-app = Ursina()
-t = time.time()
-
-application.asset_folder = application.asset_folder.parent.parent
-terrain = Entity(model=Terrain('heightmap_1', skip=8), texture='grass', texture_scale=(3,3), scale=256)
-
-
-# grid = [[[None for z in range(8)] for y in range(1)] for x in range(8)] # make 2d array of entities
-grid = [[None for z in range(8)] for x in range(8)] # make 2d array of entities
-
-x_slices = 8
-# y = 1
-z_slices = 8
-
-for z in range(z_slices):
-    for x in range(x_slices):
-        part = Entity(
-            parent=terrain,
-            x=(x/x_slices) - .5 + (1/x_slices/2),
-            z=(z/z_slices) - .5 + (1/z_slices/2),
-            color=color.random_color(),
-            model=Mesh(),
-            always_on_top=True
-            )
-        grid[x][z] = part
-
-terrain.model.generated_vertices = [v+Vec3(.5,0.5) for v in terrain.model.generated_vertices]
-for i in range(0, len(terrain.model.generated_vertices), 3):
-    v = terrain.model.generated_vertices[i]
-    x = floor(v.x * x_slices)
-    z = floor(v.z * z_slices)
-    x = min(x, x_slices-1)
-    z = min(z, z_slices-1)
-
-    offset = Vec3(- (x/x_slices) - (1/x_slices/2), -.5, -(z/z_slices) - (1/x_slices/2))
-    grid[x][z].model.vertices.extend([
-        terrain.model.generated_vertices[i]   + offset,
-        terrain.model.generated_vertices[i+1] + offset,
-        terrain.model.generated_vertices[i+2] + offset,
-        ])
-
-
-for z in range(z_slices):
-    for x in range(x_slices):
-        grid[x][z].model.generate()
-        # Entity(parent=grid[x][z], model='cube', scale=.01, color=color.red, always_on_top=True)
-        # grid[x][z].enabled = False
-
-        grid[x][z].collider = 'mesh'
-        # grid[x][z].model = None
-
-
-from ursina.prefabs.first_person_controller import FirstPersonController
-# player = FirstPersonController(position=(0,200,0))
-# player.add_script(NoclipMode())
-# player = EditorCamera(rotation_x=90, y=128)
-EditorCamera()
-
-
-# def update():
-#     for part in terrain.children:
-#         part.enabled = distance_xz(part.world_position, player.world_position) < 256/8
-        # print(distance_xz(part.world_position, camera.world_position), 256/4)
-
-
-
-
-
-
-app.run()
+from ursina.scripts.combine import combine
+
+
+class ChunkedBatcher(Entity):
+    ''' Groups static entities into spatial chunks and combines each chunk into as few Geoms as possible.
+    Only chunks whose members changed get rebuilt, and chunks further away from the camera than view_distance get disabled.
+    Call mark_dirty(entity) after moving or changing a member, and remove(entity) before destroying it.
+    With chunk_collider set, the members' own colliders get disabled while they're batched, so only the chunk gets hit.
+    '''
+    def __init__(self, chunk_size=16, view_distance=inf, only_xz=True, max_rebuilds_per_frame=4, chunk_collider=None, entities=None, **kwargs):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.view_distance = view_distance      # chunks further away than this from the camera gets disabled
+        self.only_xz = only_xz                  # if True, chunks will be columns, which is what you want for most terrains and voxel worlds
+        self.max_rebuilds_per_frame = max_rebuilds_per_frame
+        self.chunk_collider = chunk_collider    # set to 'mesh' to give each combined chunk a MeshCollider
+
+        self.chunks = dict()        # chunk coordinate -> chunk Entity
+        self.members = dict()       # member entity -> chunk coordinate
+        self.original_parents = dict()  # member entity -> parent before add(), to put it back on remove()
+        self.dirty_chunks = set()
+        self.disabled_collisions = set()    # members whose collision got turned off because the chunk has a collider
+
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        if entities:
+            for e in entities:
+                self.add(e)
+
+
+    def get_chunk_coordinate(self, position): # position relative to the batcher
+        x, y, z = (floor(e / self.chunk_size) for e in position)
+        if self.only_xz:
+            y = 0
+        return (x, y, z)
+
+
+    def _get_chunk(self, coordinate):
+        if coordinate not in self.chunks:
+            center = (Vec3(*coordinate) + Vec3(.5,.5,.5)) * self.chunk_size
+            if self.only_xz:
+                center.y = 0
+            self.chunks[coordinate] = Entity(parent=self, name=f'chunk_{coordinate}', position=center)
+
+        return self.chunks[coordinate]
+
+
+    def add(self, entity, coordinate=None): # uses the entity's position to find the chunk, unless coordinate is given
+        if coordinate is None:
+            coordinate = self.get_chunk_coordinate(entity.get_position(relative_to=self))
+        if entity not in self.members:
+            self.original_parents[entity] = entity.parent
+        entity.world_parent = self._get_chunk(coordinate)
+        self.members[entity] = coordinate
+        self.dirty_chunks.add(coordinate)
+
+
+    def remove(self, entity):
+        if entity not in self.members:
+            return
+
+        self.dirty_chunks.add(self.members.pop(entity))
+        parent = self.original_parents.pop(entity, scene)
+        entity.world_parent = parent if parent and not parent.is_empty() else scene
+        entity.visible_self = True
+        if entity in self.disabled_collisions:
+            self.disabled_collisions.remove(entity)
+            entity.collision = True
+
+
+    def mark_dirty(self, entity): # call this after moving or changing a member. moves it to another chunk if needed.
+        if entity not in self.members:
+            return
+
+        old_coordinate = self.members[entity]
+        self.dirty_chunks.add(old_coordinate)
+        coordinate = self.get_chunk_coordinate(entity.get_position(relative_to=self))
+        if coordinate != old_coordinate:
+            entity.world_parent = self._get_chunk(coordinate)
+            self.members[entity] = coordinate
+            self.dirty_chunks.add(coordinate)
+
+
+    def add_mesh(self, mesh, **kwargs): # split a large mesh, like a Terrain, into one Entity per chunk and add them. kwargs are passed to each part.
+        import numpy as np
+
+        vertices = np.asarray(mesh.vertices, dtype=np.float64).reshape(-1, 3)
+        triangles = np.asarray(mesh.indices, dtype=np.int64)
+        triangles = triangles[:len(triangles) - (len(triangles) % 3)].reshape(-1, 3)
+
+        # transform the triangle centers to batcher space with a temporary entity to find which chunk they belong to
+        helper = Entity(parent=self, add_to_scene_entities=False, **kwargs)
+        mat = helper.getMat(self)
+        destroy(helper)
+        matrix = np.array([[mat.getCell(row, column) for column in range(4)] for row in range(4)])
+        centers = vertices[triangles].mean(axis=1) @ matrix[:3,:3] + matrix[3,:3]
+        coordinates = np.floor(centers / self.chunk_size).astype(np.int64)
+        if self.only_xz:
+            coordinates[:,1] = 0
+
+        attributes = {name: np.asarray(getattr(mesh, name), dtype=np.float64).reshape(len(vertices), -1)
+            for name in ('normals', 'uvs', 'colors') if len(getattr(mesh, name)) == len(vertices)}
+
+        unique_coordinates, chunk_indices = np.unique(coordinates, axis=0, return_inverse=True)
+        chunk_indices = chunk_indices.ravel()
+        parts = []
+        for i, coordinate in enumerate(unique_coordinates):
+            chunk_triangles = triangles[chunk_indices == i]
+            used_vertices, new_triangles = np.unique(chunk_triangles, return_inverse=True) # only keep the vertices this chunk uses
+            part_mesh = Mesh(
+                vertices=vertices[used_vertices].tolist(),
+                triangles=new_triangles.ravel().tolist(),
+                **{name: value[used_vertices].tolist() for name, value in attributes.items()}
+                )
+            part = Entity(parent=self, model=part_mesh, **kwargs)
+            self.add(part, coordinate=tuple(int(e) for e in coordinate))
+            parts.append(part)
+
+        return parts
+
+
+    def rebuild_chunk(self, coordinate):
+        self.dirty_chunks.discard(coordinate)
+        chunk = self.chunks.get(coordinate)
+        if not chunk:
+            return
+
+        members = [e for e in chunk.children if self.members.get(e) == coordinate]
+        if not members:
+            del self.chunks[coordinate]
+            destroy(chunk)
+            return
+
+        chunk.collider = None
+        chunk.model = None
+        # only combine the members themselves. their children aren't hidden, so they'd get drawn twice otherwise.
+        ignore = set()
+        stack = [e for e in chunk.children if e not in members] + [child for e in members for child in e.children]
+        while stack:
+            e = stack.pop()
+            ignore.add(e)
+            stack.extend(e.children)
+        combine(chunk, auto_destroy=False, ignore=ignore)
+        for e in members:
+            e.visible_self = False  # the chunk renders them now
+
+        if self.chunk_collider:     # a MeshCollider includes the submeshes with other textures as well
+            chunk.collider = self.chunk_collider
+            for e in members:
+                if e.collider and e.collision:
+                    e.collision = False
+                    self.disabled_collisions.add(e)
+
+
+    def rebuild(self): # rebuild all dirty chunks right away
+        for coordinate in list(self.dirty_chunks):
+            self.rebuild_chunk(coordinate)
+
+
+    def update(self):
+        for coordinate in list(self.dirty_chunks)[:self.max_rebuilds_per_frame]:
+            self.rebuild_chunk(coordinate)
+
+        if self.view_distance == inf:
+            return
+
+        camera_position = camera.world_position
+        for chunk in self.chunks.values():
+            if self.only_xz:
+                dist = distance_xz(chunk.world_position, camera_position)
+            else:
+                dist = distance(chunk.world_position, camera_position)
+
+            enabled = dist <= self.view_distance
+            if chunk.enabled != enabled:
+                chunk.enabled = enabled
+
+
+
+if __name__ == '__main__':
+    app = Ursina()
+
+    '''split a large terrain into chunks and give each chunk a MeshCollider'''
+    batcher = ChunkedBatcher(chunk_size=32, view_distance=96, chunk_collider='mesh')
+    batcher.add_mesh(Terrain('heightmap_1', skip=8), texture='grass', texture_scale=(3,3), scale=256, y=-20)
+    batcher.rebuild()
+
+    '''voxels are combined per chunk, so editing one block only rebuilds the chunk it's in'''
+    voxels = ChunkedBatcher(chunk_size=8, view_distance=64, chunk_collider='mesh')
+    for z in range(32):
+        for x in range(32):
+            voxels.add(Entity(model='cube', texture='white_cube', position=(x,0,z), color=color.hsv(0, 0, random.uniform(.9, 1))))
+
+    def input(key):
+        if key == 'left mouse down' and mouse.hovered_entity and mouse.hovered_entity.parent == voxels:
+            block = Entity(model='cube', texture='white_cube', position=round(mouse.world_point + mouse.world_normal*.5, 0))
+            voxels.add(block)
+
+    EditorCamera()
+    app.run()
@@ -1,84 +1,175 @@
 from ursina import *
+from ursina.scripts.generate_normals import generate_normals
 
 
-def combine(combine_parent, analyze=False, auto_destroy=True, ignore=[], ignore_disabled=True):
-    verts = []
-    tris = []
-    norms = []
-    uvs = []
-    cols = []
-    to_destroy = []
-    o = 0
-    original_texture = combine_parent.texture
-
-    for e in scene.entities:
+def _get_descendants(entity, ignore, ignore_disabled):
+    # walk the subtree of entity instead of every entity in the scene
+    descendants = []
+    stack = [entity, ]
+    while stack:
+        e = stack.pop()
+        stack.extend(reversed(e.children))
         if e in ignore:
             continue
-
         if ignore_disabled and not e.enabled:
             continue
 
-        if e.has_ancestor(combine_parent) or e == combine_parent:
-            if not hasattr(e, 'model') or e.model == None or e.scripts or e.eternal:
-                continue
-            if not hasattr(e.model, 'vertices') or not e.model.vertices:
-                e.model = load_model(e.model.name, use_deepcopy=True)
-                e.origin = e.origin
-            if not e.model:
-                continue
+        descendants.append(e)
+
+    return descendants
+
+
+def _mat_to_array(mat):
+    import numpy as np
+    return np.array([[mat.getCell(row, column) for column in range(4)] for row in range(4)], dtype=np.float64)
+
+
+def _get_material_key(e):
+    texture = e.texture
+    if texture is not None and hasattr(texture, '_texture'):
+        texture = texture._texture
+
+    shader = getattr(e, '_shader', None)
+    return (texture, shader)
+
+
+def _get_mesh_arrays(model, cache):
+    # convert each distinct mesh to arrays only once, since large scenes usually reuse a few models many times
+    import numpy as np
+
+    key = id(model) if isinstance(model, Mesh) else model.name
+    if key in cache:
+        return cache[key]
+
+    mesh = model
+    if not isinstance(model, Mesh) or not model.vertices:
+        mesh = load_model(model.name, use_deepcopy=True)
+    if not isinstance(mesh, Mesh) or not mesh.vertices or mesh.mode != 'triangle':
+        cache[key] = None
+        return None
 
-            if analyze:
-                print('combining:', e)
+    vertices = np.asarray(mesh.vertices, dtype=np.float64).reshape(-1, 3)
+    vertex_count = len(vertices)
+    indices = np.asarray(mesh.indices, dtype=np.uint32)
+    indices = indices[:len(indices) - (len(indices) % 3)]
 
-            vertex_to_world_matrix = e.model.getTransform(combine_parent).getMat()
-            verts += [Vec3(*vertex_to_world_matrix.xformPoint(v)) for v in e.model.vertices]
+    if mesh.normals and len(mesh.normals) == vertex_count:
+        normals = np.asarray(mesh.normals, dtype=np.float64).reshape(-1, 3)
+    else:
+        normals = np.asarray(generate_normals(vertices, indices.tolist(), smooth=False), dtype=np.float64)
+
+    uvs = None
+    if mesh.uvs and len(mesh.uvs) == vertex_count:
+        uvs = np.asarray(mesh.uvs, dtype=np.float64).reshape(-1, 2)
+
+    colors = None
+    if mesh.colors and len(mesh.colors) == vertex_count:
+        colors = np.asarray(mesh.colors, dtype=np.float64).reshape(-1, 4)
+
+    cache[key] = (vertices, indices, normals, uvs, colors)
+    return cache[key]
+
+
+def combine(combine_parent, analyze=False, auto_destroy=True, ignore=[], ignore_disabled=True, include_normals=True):
+    ''' Combines the models of combine_parent and its descendants into a single Mesh.
+    Entities with a different texture or shader than combine_parent get their own Geom, parented to the returned Mesh and listed in .submeshes.
+    If combine_parent has no texture, it will adopt the texture of the largest group.
+    Entity color, texture_scale and texture_offset get baked into vertex colors and uvs.
+    '''
+    import numpy as np
+
+    groups = dict()     # (texture, shader) -> {'verts':[], 'tris':[], 'norms':[], 'uvs':[], 'cols':[], 'vertex_count':0, 'texture':Texture}
+    to_destroy = []
+    original_texture = combine_parent.texture
+    main_key = _get_material_key(combine_parent)
+
+    mesh_arrays_cache = dict()
+
+    for e in _get_descendants(combine_parent, ignore, ignore_disabled):
+        if not hasattr(e, 'model') or e.model == None or e.scripts or e.eternal:
+            continue
+
+        arrays = _get_mesh_arrays(e.model, mesh_arrays_cache)
+        if arrays is None:
+            continue
 
-            if not e.model.triangles:
-                new_tris = [i for i in range(len(e.model.vertices))]
+        if analyze:
+            print('combining:', e)
 
-            else:
-                new_tris = list()
-                for t in e.model.triangles:
-                    if isinstance(t, int):
-                        new_tris.append(t)
-                    elif len(t) == 3:
-                        new_tris.extend(t)
-                    elif len(t) == 4: # turn quad into tris
-                        new_tris.extend([t[0], t[1], t[2], t[2], t[3], t[0]])
+        vertices, indices, normals, uvs, colors = arrays
+        vertex_count = len(vertices)
 
-            new_tris = [t+o for t in new_tris]
-            new_tris = [(new_tris[i], new_tris[i+1], new_tris[i+2]) for i in range(0, len(new_tris)-1, 3)]
+        texture, shader = _get_material_key(e)
+        key = (texture if texture is not None else main_key[0], shader if shader is not None else main_key[1])  # inherit combine_parent's texture and shader if not set
+        if key not in groups:
+            groups[key] = {'verts':[], 'tris':[], 'norms':[], 'uvs':[], 'cols':[], 'vertex_count':0, 'texture':e.texture if e.texture is not None else original_texture}
+        group = groups[key]
 
-            o += len(e.model.vertices)
-            tris += new_tris
+        # transform all vertices with a single matrix multiply. panda3d uses row vectors, so v' = v @ M
+        matrix = _mat_to_array(e.model.getTransform(combine_parent).getMat())
+        group['verts'].append(vertices @ matrix[:3,:3] + matrix[3,:3])
+        group['tris'].append(indices + group['vertex_count'])
 
-            # if e.model.normals:
-            #     norms += e.model.normals
+        if include_normals:
+            normals = normals @ np.linalg.inv(matrix[:3,:3]).T     # inverse transpose keeps normals correct on non-uniformly scaled entities
+            lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+            lengths[lengths == 0] = 1
+            group['norms'].append(normals / lengths)
 
-            if e.model.uvs:
-                uvs.extend([(uv * e.texture_scale) + e.texture_offset for uv in e.model.uvs])
-            else:
-                uvs.extend([(0,0) for e in e.model.vertices])
+        if uvs is not None:
+            group['uvs'].append((uvs * tuple(e.texture_scale)) + tuple(e.texture_offset))
+        else:
+            group['uvs'].append(np.zeros((vertex_count, 2)))
 
-            if e.model.colors: # if has vertex colors
-                cols.extend([Color(*vcol) * e.color for vcol in e.model.colors])
-            else:
-                cols.extend((e.color, ) * len(e.model.vertices))
+        entity_color = np.asarray(tuple(e.color), dtype=np.float64)
+        if colors is not None: # if has vertex colors
+            group['cols'].append(colors * entity_color)
+        else:
+            group['cols'].append(np.tile(entity_color, (vertex_count, 1)))
 
+        group['vertex_count'] += vertex_count
 
-            if auto_destroy and e != combine_parent:
-                to_destroy.append(e)
+        if auto_destroy and e != combine_parent:
+            to_destroy.append(e)
 
     if auto_destroy:
         from ursina import destroy
         [destroy(e) for e in to_destroy]
 
-    combine_parent.model = Mesh(vertices=verts, triangles=tris, normals=norms, uvs=uvs, colors=cols, mode='triangle')
+    def group_to_mesh(group):
+        if not group['verts']:
+            return Mesh(mode='triangle')
+
+        return Mesh(
+            vertices=np.concatenate(group['verts']).tolist(),
+            triangles=np.concatenate(group['tris']).tolist(),
+            normals=np.concatenate(group['norms']).tolist() if include_normals else None,
+            uvs=np.concatenate(group['uvs']).tolist(),
+            colors=np.concatenate(group['cols']).tolist(),
+            mode='triangle'
+            )
+
+    if main_key not in groups and original_texture is None:   # combine_parent has no texture, so let it adopt the texture of the largest group instead of ending up empty
+        candidates = [key for key in groups if key[1] == main_key[1]]
+        if candidates:
+            main_key = max(candidates, key=lambda key: groups[key]['vertex_count'])
+            original_texture = groups[main_key]['texture']
+
+    combined_model = group_to_mesh(groups.pop(main_key, {'verts':[]}))
+    combined_model.submeshes = []
+    for (texture, shader), group in groups.items():
+        submesh = group_to_mesh(group)
+        submesh.reparentTo(combined_model)
+        if texture is not None:
+            submesh.setTexture(texture, 1)
+        if shader is not None:
+            submesh.setShader(shader._shader if isinstance(shader, Shader) else shader, 1)
+        combined_model.submeshes.append(submesh)
+
+    combine_parent.model = combined_model
     combine_parent.texture = original_texture
-    # print('combined')
-    # entity.model = Mesh(vertices=verts,  mode='triangle')
-    # entity.flatten_strong()
     if analyze:
+        print('combined into', 1 + len(combined_model.submeshes), 'geoms')
         render.analyze()
     return combine_parent.model
 
@@ -95,6 +186,7 @@ if __name__ == '__main__':
     e1 = Entity(parent=p, model='sphere', y=1.5, color=color.pink)
     e2 = Entity(parent=p, model='cube', color=color.yellow, x=1, origin_y=-.5, texture='brick')
     e3 = Entity(parent=e2, model='cube', color=color.yellow, y=2, scale=.5, texture='brick', texture_scale=Vec2(3,3), texture_offset=(.1,.1))
+    e4 = Entity(parent=p, model='cube', x=-1.5, texture='shore')    # different texture, so it gets its own Geom
 
     def input(key):
         if key == 'space':
@@ -108,7 +200,7 @@ if __name__ == '__main__':
     # p.y=2
     # p.model.save()
     # ursinamesh_to_obj(p.model, name='combined_model_test', out_path=application.asset_folder)
-    print(p.model.vertices[0].__class__)
+    print(p.model.vertices[0].__class__, 'submeshes:', p.model.submeshes)
 
     EditorCamera()
     app.run()
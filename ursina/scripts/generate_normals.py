@@ -8,65 +8,89 @@ def normalize_v3(arr):
     import numpy
 
     lens = numpy.sqrt( arr[:,0]**2 + arr[:,1]**2 + arr[:,2]**2 )
+    lens[lens == 0] = 1     # leave zero length vectors as they are instead of turning them into nan
     arr[:,0] /= lens
     arr[:,1] /= lens
     arr[:,2] /= lens
     return arr
 
 
-def generate_normals(vertices, triangles=None, smooth=True):
+def generate_normals(vertices, triangles=None, smooth=True, smooth_angle=None, weighting=None):
+    ''' smooth: average the normals of vertices at the same position.
+    smooth_angle: if set, only faces with less than this many degrees between them get smoothed together, which keeps hard edges hard.
+    weighting: None to weight each face equally, 'area' to weight by face area or 'angle' to weight by the angle of the corner.
+    '''
     import numpy
 
-    if not triangles:
-        new_tris = [(i, i+1, i+2) for i in range(0, len(vertices), 3)]
-    else:
-        new_tris = [(triangles[i], triangles[i+1], triangles[i+2]) for i in range(0, len(triangles), 3)]
-
+    vertices = numpy.asarray(vertices, dtype=numpy.float64).reshape(-1, 3)
 
-    vertices = numpy.array(vertices)
-    triangles = numpy.array(new_tris)
+    if triangles is None or len(triangles) == 0:
+        triangles = numpy.arange(len(vertices) - (len(vertices) % 3))
+    triangles = numpy.asarray(triangles, dtype=numpy.int64).reshape(-1, 3)
 
     normals = numpy.zeros(vertices.shape, dtype=vertices.dtype)
     #Create an indexed view into the vertex array using the array of three indices for triangles
     tris = vertices[triangles]
     #Calculate the normal for all the triangles, by taking the cross product of the vectors v1-v0, and v2-v0 in each triangle
     n = numpy.cross(tris[::,1] - tris[::,0] ,tris[::,2] - tris[::,0])
-    # n is now an array of normals per triangle. The length of each normal is dependent the vertices,
-    # we need to normalize these, so that our next step weights each normal equally.
-    normalize_v3(n)
-
     # inverse it, dunno why
-    n = [-e for e in n]
-
-    # now we have a normalized array of normals, one per triangle, i.e., per triangle normals.
-    # But instead of one per triangle (i.e., flat shading), we add to each vertex in that triangle,
-    # the triangles' normal. Multiple triangles would then contribute to every vertex, so we need to normalize again afterwards.
-    # The cool part, we can actually add the normals through an indexed view of our (zeroed) per vertex normal array
-    normals[triangles[:,0]] += n
-    normals[triangles[:,1]] += n
-    normals[triangles[:,2]] += n
-    normalize_v3(normals)
-
-    # smooth
-    if smooth:
-        vertices = vertices.tolist()
-        bucket = set()
-        visited = set()
-
-        for i, v in enumerate(vertices):
-            if i in visited:
-                continue
-
-            overlapping_verts_indices = [j for j, w in enumerate(vertices) if w == v and j not in visited]
-            visited.update(overlapping_verts_indices)
-
-            if overlapping_verts_indices:
-                average_normal = sum(normals[e] for e in overlapping_verts_indices) / 3
-                for index in overlapping_verts_indices:
-                    normals[index] = average_normal
-
-
-    return normals
+    n = -n
+
+    # weight of each face's normal for each of its three corners, shape=(n,3)
+    if weighting == 'area':
+        # the length of the cross product is twice the area of the triangle, so just don't normalize it
+        weights = numpy.ones(triangles.shape)
+    elif weighting == 'angle':
+        normalize_v3(n)
+        weights = numpy.empty(triangles.shape)
+        for corner in range(3):
+            a = tris[:, (corner+1) % 3] - tris[:, corner]
+            b = tris[:, (corner+2) % 3] - tris[:, corner]
+            cos_angle = numpy.einsum('ij,ij->i', a, b) / numpy.maximum(numpy.linalg.norm(a, axis=1) * numpy.linalg.norm(b, axis=1), 1e-12)
+            weights[:, corner] = numpy.arccos(numpy.clip(cos_angle, -1, 1))
+    elif weighting is None:
+        normalize_v3(n)
+        weights = numpy.ones(triangles.shape)
+    else:
+        raise ValueError(f"Incorrect value for weighting: {weighting}. Choose one of: None, 'area', 'angle'")
+
+    corner_vertices = triangles.ravel()
+    corner_faces = numpy.repeat(numpy.arange(len(triangles)), 3)
+    corner_normals = n[corner_faces] * weights.reshape(-1, 1)
+
+    if not smooth:
+        # add each triangle's normal to its vertices. vertices shared between triangles through the indices get averaged.
+        numpy.add.at(normals, corner_vertices, corner_normals)
+        return normalize_v3(normals)
+
+    # group vertices at the same position, so they can be averaged without comparing every vertex with every other vertex
+    _, position_ids = numpy.unique(vertices, axis=0, return_inverse=True)
+    position_ids = position_ids.ravel()
+    corner_positions = position_ids[corner_vertices]
+
+    if smooth_angle is None:
+        position_normals = numpy.zeros((position_ids.max() + 1, 3))
+        numpy.add.at(position_normals, corner_positions, corner_normals)
+        normals = position_normals[position_ids]
+        return normalize_v3(normals)
+
+    # with a smooth angle, each corner only gets the normals of faces close enough to its own face's normal.
+    # sort the corners by position and pair up every corner with every other corner at the same position.
+    face_normals = normalize_v3(n.copy())
+    order = numpy.argsort(corner_positions, kind='stable')
+    _, group_starts, group_counts = numpy.unique(corner_positions[order], return_index=True, return_counts=True)
+    counts = numpy.repeat(group_counts, group_counts)
+    starts = numpy.repeat(group_starts, group_counts)
+    left = numpy.repeat(numpy.arange(len(order)), counts)
+    right = numpy.repeat(starts, counts) + numpy.arange(len(left)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    left, right = order[left], order[right]
+
+    similar = numpy.einsum('ij,ij->i', face_normals[corner_faces[left]], face_normals[corner_faces[right]]) >= numpy.cos(numpy.radians(smooth_angle)) - 1e-6
+    smoothed_corner_normals = numpy.zeros(corner_normals.shape)
+    numpy.add.at(smoothed_corner_normals, left[similar], corner_normals[right[similar]])
+
+    numpy.add.at(normals, corner_vertices, smoothed_corner_normals)
+    return normalize_v3(normals)
 
 if __name__ == '__main__':
     vertices = (
@@ -78,6 +102,7 @@ if __name__ == '__main__':
     t = perf_counter()
     norms = generate_normals(vertices, smooth=True)
     print('------', perf_counter() - t)
+    norms = generate_normals(vertices, smooth=True, smooth_angle=30, weighting='angle')
     # print(norms)
     # from ursina import *
     # app = Ursina()
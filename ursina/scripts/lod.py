@@ -0,0 +1,149 @@
+from panda3d.core import LODNode, NodePath
+from ursina import application
+from ursina.mesh import Mesh
+from ursina.string_utilities import print_warning
+
+
+def simplify_mesh(mesh, resolution=32):
+    ''' Simplifies a Mesh with vertex clustering. Vertices within the same cell of a grid with
+    resolution cells along the longest side of the mesh get merged into their average,
+    and triangles that collapse get removed. Returns a new Mesh.
+    '''
+    import numpy as np
+    from ursina.scripts.merge_vertices import get_vertex_clusters
+
+    vertices = np.asarray(mesh.vertices, dtype=np.float64).reshape(-1, 3)
+    triangles = np.asarray(mesh.indices, dtype=np.int64)
+    triangles = triangles[:len(triangles) - (len(triangles) % 3)].reshape(-1, 3)
+    if len(vertices) == 0 or len(triangles) == 0:
+        return Mesh()
+
+    size = vertices.max(axis=0) - vertices.min(axis=0)
+    cell_size = max(size.max() / max(resolution, 1), 1e-6)
+    _, cluster_indices = get_vertex_clusters(vertices, cell_size)
+    counts = np.bincount(cluster_indices)
+
+    def average(values):
+        return np.stack([np.bincount(cluster_indices, weights=values[:,i], minlength=len(counts)) for i in range(values.shape[1])], axis=1) / counts[:,None]
+
+    new_triangles = cluster_indices[triangles]
+    keep = (new_triangles[:,0] != new_triangles[:,1]) & (new_triangles[:,1] != new_triangles[:,2]) & (new_triangles[:,2] != new_triangles[:,0])
+    new_triangles = new_triangles[keep]
+    used, new_triangles = np.unique(new_triangles, return_inverse=True)   # drop the clusters no triangle uses anymore
+
+    attributes = dict()
+    for name, width in (('normals', 3), ('uvs', 2), ('colors', 4)):
+        values = getattr(mesh, name)
+        if values is None or len(values) != len(vertices):
+            continue
+        values = average(np.asarray(values, dtype=np.float64).reshape(-1, width))[used]
+        if name == 'normals':
+            lengths = np.linalg.norm(values, axis=1, keepdims=True)
+            lengths[lengths == 0] = 1
+            values /= lengths
+        attributes[name] = values.tolist()
+
+    return Mesh(vertices=average(vertices)[used].tolist(), triangles=new_triangles.ravel().tolist(), mode='triangle', **attributes)
+
+
+def _get_cache_name(mesh, level, resolution):
+    import numpy as np
+    import hashlib
+
+    name = str(mesh.name).replace('.', '_') if mesh.name else 'mesh'
+    content_hash = hashlib.md5(np.asarray(mesh.vertices, dtype=np.float32).tobytes() + np.asarray(mesh.indices, dtype=np.uint32).tobytes()).hexdigest()[:12]
+    return f'{name}_{content_hash}_lod{level}_{resolution}'
+
+
+def generate_lods(mesh, levels=3, resolution=64, cache=True):
+    ''' Returns a list of levels simplified versions of mesh, each with half the resolution of the previous.
+    If cache is True, they're saved to and loaded from application.compressed_models_folder.
+    '''
+    from ursina.mesh_importer import load_model
+
+    if not isinstance(mesh, Mesh) and isinstance(mesh, NodePath) and mesh.name:
+        mesh = load_model(mesh.name, use_deepcopy=True)
+
+    if not isinstance(mesh, Mesh) or mesh.mode != 'triangle':
+        print_warning('generate_lods() only supports triangle Meshes, not', mesh)
+        return []
+
+    lods = []
+    for level in range(1, levels+1):
+        level_resolution = max(resolution // 2**(level-1), 2)
+        cache_name = _get_cache_name(mesh, level, level_resolution)
+
+        lod = None
+        if cache and application.compressed_models_folder.exists():
+            lod = load_model(cache_name, application.compressed_models_folder, file_types=('.ursinamesh',))
+
+        if lod is None:
+            lod = simplify_mesh(mesh, level_resolution)
+            if cache:
+                lod.save(f'{cache_name}.ursinamesh', folder=application.compressed_models_folder)
+
+        lods.append(lod)
+
+    return lods
+
+
+def remove_lods(model):
+    lod_node_path = model.find('lod_node')
+    if lod_node_path.isEmpty():
+        return
+
+    level_0 = lod_node_path.find('lod_0')
+    if not level_0.isEmpty():
+        for child in level_0.getChildren():
+            child.reparentTo(model)
+    for child in lod_node_path.getChildren():
+        child.detachNode()
+    lod_node_path.removeNode()
+
+
+def apply_lods(model, lods, distances):
+    ''' Inserts a LODNode in model, so everything already in model gets used for close range
+    and each of the lods in turn after its distance. Since it goes inside the model,
+    the lods will get the same color and texture as the model.
+    '''
+    remove_lods(model)
+    if not lods:
+        return
+
+    if len(distances) != len(lods):
+        raise ValueError(f'lod_distances needs one distance per lod, got {len(distances)} distances and {len(lods)} lods')
+
+    lod_node = LODNode('lod_node')
+    lod_node_path = model.attachNewNode(lod_node)
+    level_0 = lod_node_path.attachNewNode('lod_0')
+    for child in model.getChildren():
+        if child != lod_node_path:
+            child.reparentTo(level_0)
+    lod_node.addSwitch(distances[0], 0)
+
+    for i, lod in enumerate(lods):
+        if not isinstance(lod, NodePath):
+            raise TypeError(f'lods must be models, not {type(lod)}')
+        far = distances[i+1] if i+1 < len(distances) else 1e9
+        lod.instanceTo(lod_node_path)   # instance, so entities can share the same lod models
+        lod_node.addSwitch(far, distances[i])
+
+    return lod_node_path
+
+
+
+if __name__ == '__main__':
+    from ursina import *
+    app = Ursina()
+
+    '''
+    Set lods to a number to generate that many levels of detail from the model, or give it a list of models.
+    lod_distances is the distance from the camera where each lod starts.
+    '''
+    for i in range(16):
+        Entity(model=Terrain('heightmap_1', skip=4), scale=(20,4,20), x=i*22, texture='heightmap_1', lods=3, lod_distances=(40, 80, 160))
+
+    e = Entity(model='sphere', y=8, lods=[Cube(), ], lod_distances=[30, ], color=color.orange)
+
+    EditorCamera()
+    app.run()
@@ -1,31 +1,50 @@
-from math import sqrt
-
-
-def distance(a, b):
-    return sqrt((b[0] - a[0])**2 + (b[1] - a[1])**2 + (b[2] - a[2])**2)
+def get_vertex_clusters(vertices, max_distance=.1):
+    ''' Quantizes vertices (numpy array of shape (n,3)) to max_distance sized grid cells.
+    Returns the index of the first vertex in each cluster and the cluster index of each vertex,
+    with the clusters in the order they first appeared.
+    '''
+    import numpy as np
+
+    # quantize the positions and sort them, so overlapping vertices end up with the same key. O(n log n) instead of comparing every pair.
+    keys = np.floor(vertices / max_distance + .5).astype(np.int64)
+    keys -= keys.min(axis=0)
+    size = keys.max(axis=0) + 1
+    if np.prod(size.astype(np.float64)) < 2**62:   # pack the three cell coordinates into a single int, since sorting that is a lot faster
+        keys = (keys[:,0] * size[1] + keys[:,1]) * size[2] + keys[:,2]
+        _, first_indices, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    else:
+        _, first_indices, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # np.unique sorts the keys, so reorder to keep the vertices in the order they first appeared
+    order = np.argsort(first_indices)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+
+    return first_indices[order], remap[inverse]
 
 
 def merge_overlapping_vertices(vertices, triangles=None, max_distance=.1):
+    ''' Welds vertices that fall within the same max_distance sized grid cell.
+    Returns the compacted vertices as a numpy array and the remapped triangles,
+    flat if triangles were given flat, as (n,3) if given as triplets.
+    '''
+    import numpy as np
 
-    if triangles == None:
-        triangles = [(i, i+1, i+2) for i in range(0, len(vertices), 3)]
-
-    if triangles[0] is int:
-        triangles = [(triangles[i], triangles[i+1], triangles[i+2]) for i in range(0, len(triangles), 3)]
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
 
-    unique = list()
-    triangles = list(triangles)
+    if triangles is None or len(triangles) == 0:
+        triangles = np.arange(len(vertices) - (len(vertices) % 3))
+    triangles = np.asarray(triangles, dtype=np.int64)
+    is_flat = triangles.ndim == 1
+    triangles = triangles.reshape(-1, 3)
 
-    for i, v in enumerate(vertices):
-        for j, u in enumerate(unique):
-            if distance(v, u) <= max_distance:
-                # print('found overlapping vertices!', i, 'could be', j)
-                for k, t in enumerate(triangles):
-                    if t == i:
-                        triangles[k] = j
-                        # for v in verts
+    first_indices, cluster_indices = get_vertex_clusters(vertices, max_distance)
+    unique = vertices[first_indices]
+    triangles = cluster_indices[triangles]
 
-        unique.append(v)
+    if is_flat:
+        triangles = triangles.ravel()
 
     return unique, triangles
 
@@ -41,9 +60,7 @@ if __name__ == '__main__':
     from ursina import *
     app = Ursina()
 
-    e = Entity(model=Mesh(new_verts, new_tris, mode='triangle'))
+    e = Entity(model=Mesh(new_verts.tolist(), new_tris.tolist(), mode='triangle'))
     EditorCamera()
 
     app.run()
-    # m = Cylinder(8)
-    # calculate_normals(m.vertices)
@@ -0,0 +1,255 @@
+from math import floor, inf
+from panda3d.core import BoundingSphere, BoundingBox
+from ursina.scene import instance as scene
+from ursina.vec3 import Vec3
+from ursina.collider import get_collide_mask
+
+
+class SpatialGrid:
+    ''' Uniform grid over the world space bounds of scene.collidables, used by overlap_sphere(), overlap_box() and nearest().
+    It only starts tracking once it's first used. After that, Entity's position, rotation, scale, parent, collider, collision
+    and layers setters mark entities as dirty, and only those get updated before the next query.
+    Moving an entity with panda3d's own methods, like setPos(), won't be noticed, so call mark_dirty(entity) after that.
+    '''
+    def __init__(self, cell_size=8, max_cells_per_entity=64):
+        self.cell_size = cell_size
+        self.max_cells_per_entity = max_cells_per_entity  # entities covering more cells than this get checked in every query instead
+        self.active = False
+        self.dirty = set()
+        self.entries = dict()   # entity -> (min corner, max corner, collide mask, cells)
+        self.cells = dict()     # cell -> set of entities
+        self.large_entities = set()
+
+
+    def mark_dirty(self, entity):
+        if self.active:
+            self.dirty.add(entity)
+
+
+    def get_cell(self, position):
+        return (floor(position[0] / self.cell_size), floor(position[1] / self.cell_size), floor(position[2] / self.cell_size))
+
+
+    def get_cells(self, min_corner, max_corner):
+        start = self.get_cell(min_corner)
+        end = self.get_cell(max_corner)
+        return [(x, y, z) for x in range(start[0], end[0]+1) for y in range(start[1], end[1]+1) for z in range(start[2], end[2]+1)]
+
+
+    def _remove(self, entity):
+        self.dirty.discard(entity)
+        entry = self.entries.pop(entity, None)
+        if entry is None:
+            return
+
+        self.large_entities.discard(entity)
+        for cell in entry[3]:
+            cell_entities = self.cells.get(cell)
+            if cell_entities is not None:
+                cell_entities.discard(entity)
+                if not cell_entities:
+                    del self.cells[cell]
+
+
+    def _insert(self, entity):
+        self._remove(entity)
+        if entity not in scene.collidables or entity.is_empty():
+            return
+
+        node_path = entity.collider.node_path
+        bounds = node_path.getBounds()
+        if bounds.isEmpty() or bounds.isInfinite():
+            return
+        bounds.xform(node_path.getMat(scene))
+
+        if isinstance(bounds, BoundingSphere):
+            center, radius = bounds.getCenter(), bounds.getRadius()
+            min_corner = Vec3(center[0]-radius, center[1]-radius, center[2]-radius)
+            max_corner = Vec3(center[0]+radius, center[1]+radius, center[2]+radius)
+        elif isinstance(bounds, BoundingBox):
+            min_corner, max_corner = Vec3(*bounds.getMin()), Vec3(*bounds.getMax())
+        else:
+            return
+
+        start, end = self.get_cell(min_corner), self.get_cell(max_corner)
+        cell_count = (end[0] - start[0] + 1) * (end[1] - start[1] + 1) * (end[2] - start[2] + 1)
+        if cell_count > self.max_cells_per_entity:
+            cells = ()
+            self.large_entities.add(entity)
+        else:
+            cells = self.get_cells(min_corner, max_corner)
+            for cell in cells:
+                self.cells.setdefault(cell, set()).add(entity)
+
+        self.entries[entity] = (min_corner, max_corner, entity.collider.node_path.node().getIntoCollideMask(), cells)
+
+
+    def refresh(self):
+        if not self.active:
+            self.active = True
+            self.dirty.update(scene.collidables)
+
+        while self.dirty:
+            stack = [self.dirty.pop()]
+            while stack:    # moving an entity moves its descendants as well
+                entity = stack.pop()
+                self.dirty.discard(entity)
+                if entity in scene.collidables or entity in self.entries:
+                    self._insert(entity)
+                stack.extend(getattr(entity, 'children', ()))
+
+
+    def query(self, min_corner, max_corner, layers=None, ignore=None):
+        ''' Returns (entity, min corner, max corner) for the entities whose bounds overlap the box from min_corner to max_corner. '''
+        self.refresh()
+        candidates = set(self.large_entities)
+        start, end = self.get_cell(min_corner), self.get_cell(max_corner)
+        if (end[0] - start[0] + 1) * (end[1] - start[1] + 1) * (end[2] - start[2] + 1) > len(self.cells):   # large area, so go through the occupied cells instead
+            cells = [cell for cell in self.cells if all(start[i] <= cell[i] <= end[i] for i in range(3))]
+        else:
+            cells = self.get_cells(min_corner, max_corner)
+
+        for cell in cells:
+            cell_entities = self.cells.get(cell)
+            if cell_entities:
+                candidates.update(cell_entities)
+
+        mask = get_collide_mask(layers) if layers is not None else None
+        results = []
+        for entity in candidates:
+            if entity not in scene.collidables or (ignore and entity in ignore) or not entity.enabled or entity.has_disabled_ancestor():  # raycasts can't hit disabled ones either
+                continue
+            entry_min, entry_max, entry_mask, _ = self.entries[entity]
+            if mask is not None and (entry_mask & mask).isZero():
+                continue
+            if all(entry_min[i] <= max_corner[i] and entry_max[i] >= min_corner[i] for i in range(3)):
+                results.append((entity, entry_min, entry_max))
+
+        return results
+
+
+spatial_grid = SpatialGrid()
+
+
+def _distance_to_box(point, min_corner, max_corner):
+    return sum(max(min_corner[i] - point[i], 0, point[i] - max_corner[i]) ** 2 for i in range(3)) ** .5
+
+
+def overlap_sphere(center, radius, layers=None, ignore:list=None):
+    ''' Returns the collidable entities whose collider bounds overlap the sphere, sorted by distance from center. '''
+    center = Vec3(*center)
+    half_size = Vec3(radius, radius, radius)
+    hits = []
+    for entity, min_corner, max_corner in spatial_grid.query(center - half_size, center + half_size, layers, ignore):
+        dist = _distance_to_box(center, min_corner, max_corner)
+        if dist <= radius:
+            hits.append((dist, entity))
+
+    return [entity for dist, entity in sorted(hits, key=lambda e: e[0])]
+
+
+def overlap_box(center, size=(1,1,1), layers=None, ignore:list=None):
+    ''' Returns the collidable entities whose collider bounds overlap the axis aligned box. '''
+    center = Vec3(*center)
+    half_size = Vec3(*size) / 2
+    return [entity for entity, min_corner, max_corner in spatial_grid.query(center - half_size, center + half_size, layers, ignore)]
+
+
+def _ring_cells(center_cell, ring):     # the cells on the surface of the cube ring cells out from center_cell
+    cx, cy, cz = center_cell
+    if ring == 0:
+        return [center_cell]
+    full, inner = range(-ring, ring+1), range(-ring+1, ring)
+    cells = [(cx+side, cy+y, cz+z) for side in (-ring, ring) for y in full for z in full]
+    cells.extend((cx+x, cy+side, cz+z) for side in (-ring, ring) for x in inner for z in full)
+    cells.extend((cx+x, cy+y, cz+side) for side in (-ring, ring) for x in inner for y in inner)
+    return cells
+
+
+def nearest(point, k=1, filter=None, max_distance=inf, layers=None, ignore:list=None):
+    ''' Returns up to k collidable entities closest to point, measured to their collider bounds, closest first.
+    filter is an optional function that takes an entity and returns False to skip it.
+    Searches the grid ring by ring outwards from point, so it only looks at the cells it needs to.
+    '''
+    point = Vec3(*point)
+    spatial_grid.refresh()
+    center_cell = spatial_grid.get_cell(point)
+    mask = get_collide_mask(layers) if layers is not None else None
+    found = dict()
+    seen = set()
+    cells_by_ring = None    # once the rings get bigger than the number of occupied cells, go through those instead
+
+    def consider(entity):
+        if entity in seen:
+            return
+        seen.add(entity)
+        if entity not in scene.collidables or (ignore and entity in ignore) or not entity.enabled or entity.has_disabled_ancestor():
+            return
+        min_corner, max_corner, entity_mask, _ = spatial_grid.entries[entity]
+        if mask is not None and (entity_mask & mask).isZero():
+            return
+        if filter and not filter(entity):
+            return
+        dist = _distance_to_box(point, min_corner, max_corner)
+        if dist <= max_distance:
+            found[entity] = dist
+
+    for entity in list(spatial_grid.large_entities):
+        consider(entity)
+
+    ring = 0
+    while len(seen) < len(spatial_grid.entries):
+        # everything in the rings further out is at least this far away, so stop when we already have k closer ones
+        if len(found) >= k and sorted(found.values())[k-1] <= (ring - 1) * spatial_grid.cell_size:
+            break
+        if (ring - 1) * spatial_grid.cell_size > max_distance:
+            break
+
+        if cells_by_ring is None and (2*ring+1)**3 - max(2*ring-1, 0)**3 > len(spatial_grid.cells):
+            cells_by_ring = dict()
+            for cell in spatial_grid.cells:
+                cells_by_ring.setdefault(max(abs(cell[i] - center_cell[i]) for i in range(3)), []).append(cell)
+            last_ring = max(cells_by_ring, default=-1)
+
+        if cells_by_ring is not None:
+            if ring > last_ring:
+                break
+            cells = cells_by_ring.get(ring, ())
+        else:
+            cells = _ring_cells(center_cell, ring)
+
+        for cell in cells:
+            for entity in spatial_grid.cells.get(cell, ()):
+                consider(entity)
+        ring += 1
+
+    return [entity for entity, dist in sorted(found.items(), key=lambda e: e[1])[:k]]
+
+
+if __name__ == '__main__':
+    from ursina import *
+    app = Ursina()
+
+    '''
+    Find collidable entities near a point without looping over all of them.
+    These test against the bounds of the colliders, not the exact shape.
+    '''
+    for i in range(400):
+        Entity(model='cube', collider='box', position=(random.uniform(-50,50), 0, random.uniform(-50,50)), color=color.gray)
+
+    player = Entity(model='sphere', color=color.orange, y=1)
+    marker = Entity(model='wireframe_cube', color=color.yellow, scale=1.2)
+
+    def update():
+        player.x += (held_keys['d'] - held_keys['a']) * time.dt * 10
+        player.z += (held_keys['w'] - held_keys['s']) * time.dt * 10
+
+        for e in overlap_sphere(player.world_position, 5):
+            e.color = color.red
+
+        closest = nearest(player.world_position)
+        if closest:
+            marker.world_position = closest[0].world_position
+
+    EditorCamera(rotation_x=60)
+    app.run()
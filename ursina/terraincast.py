@@ -61,6 +61,63 @@ def terraincast(world_position, terrain_entity, height_values=None, return_norma
     return None, None
 
 
+
+def terrain_heights(xz_points, terrain_entity, height_values=None, return_normals=False):
+    ''' Batched version of terraincast(). xz_points is a numpy array (or list) of shape (n,2) with world x and z,
+    or (n,3) world positions. Transforms all the points into the terrain's space at once and interpolates between
+    the height values. Returns the world y of the terrain at each point as a numpy array of shape (n,), with nan for
+    points outside the terrain. With return_normals, also returns the world space normals as an array of shape (n,3).
+    '''
+    import numpy as np
+
+    points = np.asarray(xz_points, dtype=np.float64)
+    points = points.reshape(-1, points.shape[-1] if points.ndim > 1 else 2)
+    n = len(points)
+    world_points = np.ones((n, 4))
+    if points.shape[1] == 2:
+        world_points[:,0], world_points[:,1], world_points[:,2] = points[:,0], 0, points[:,1]
+    else:
+        world_points[:,:3] = points[:,:3]
+
+    if height_values is None:
+        height_values = terrain_entity.model.height_values
+    height_values = np.asarray(height_values, dtype=np.float64)
+    w, d = height_values.shape
+
+    # panda3d matrices are row major and multiply points from the left
+    model_matrix = np.array(terrain_entity.model.getMat(scene), dtype=np.float64)
+    local_points = world_points @ np.linalg.inv(model_matrix)
+
+    x = (local_points[:,0] + .5) * (w-1)
+    z = (local_points[:,2] + .5) * (d-1)
+    inside = (x >= 0) & (x <= w-1) & (z >= 0) & (z <= d-1)
+    x0 = np.clip(np.floor(x), 0, max(w-2, 0)).astype(np.int64)
+    z0 = np.clip(np.floor(z), 0, max(d-2, 0)).astype(np.int64)
+    x1, z1 = np.minimum(x0+1, w-1), np.minimum(z0+1, d-1)
+    fx, fz = np.clip(x - x0, 0, 1), np.clip(z - z0, 0, 1)
+
+    h00, h10 = height_values[x0, z0], height_values[x1, z0]
+    h01, h11 = height_values[x0, z1], height_values[x1, z1]
+    heights = (h00 * (1-fx) * (1-fz) + h10 * fx * (1-fz) + h01 * (1-fx) * fz + h11 * fx * fz) / 255
+
+    local_points[:,1] = heights
+    world_y = (local_points @ model_matrix)[:,1]
+    world_y[~inside] = np.nan
+    if not return_normals:
+        return world_y
+
+    # slope of the interpolated surface in the terrain's space, turned into a normal with the inverse transpose of the matrix
+    slope_x = ((h10 - h00) * (1-fz) + (h11 - h01) * fz) / 255 * (w-1)
+    slope_z = ((h01 - h00) * (1-fx) + (h11 - h10) * fx) / 255 * (d-1)
+    local_normals = np.stack((-slope_x, np.ones(n), -slope_z), axis=1)
+    normals = local_normals @ np.linalg.inv(model_matrix[:3,:3]).T
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    lengths[lengths == 0] = 1
+    normals /= lengths
+    normals[~inside] = np.nan
+    return world_y, normals
+
+
 if __name__ == '__main__':
     app = Ursina()
 
@@ -79,6 +136,13 @@ if __name__ == '__main__':
         # test.world_position = player.world_position
         # test.look_at(test.world_position + normal)
 
+    '''terrain_heights() snaps many points at once'''
+    import numpy as np
+    trees = [Entity(model='cube', color=color.green, scale=(.2,1,.2), origin_y=-.5, x=random.uniform(-20,20), z=random.uniform(-10,10)) for i in range(500)]
+    heights = terrain_heights([(e.x, e.z) for e in trees], terrain_entity)
+    for e, y in zip(trees, heights.tolist()):
+        e.y = y
+
     EditorCamera()
     from ursina.shaders import ssao_shader
     camera.shader = ssao_shader
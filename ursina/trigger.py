@@ -1,55 +1,188 @@
 from ursina.entity import Entity
-from ursina.ursinamath import distance
-import time
+from ursina.vec3 import Vec3
+from ursina.scripts.property_generator import generate_properties_for_class
+from math import floor
 
-# TODO:
-# circle
-# AArectangle
-# AAbox
-# box
 
-# sphere
+class TriggerBroadphase(Entity):
+    ''' Uniform grid shared by all the Triggers. Targets only move to another cell when they cross a cell boundary,
+    and each Trigger only checks the targets in the cells it overlaps, instead of every target every time.
+    The enter/stay/exit events get sent after all the triggers have been checked.
+    '''
+    def __init__(self, cell_size=4, **kwargs):
+        super().__init__(eternal=True, **kwargs)
+        self.cell_size = cell_size
+        self.triggers = set()
+        self.targets = dict()   # entity -> [cell, number of triggers targeting it]
+        self.cells = dict()     # cell -> set of entities
+        self._frame = 0
 
+
+    def get_cell(self, position):
+        return (floor(position[0] / self.cell_size), floor(position[1] / self.cell_size), floor(position[2] / self.cell_size))
+
+
+    def add_target(self, entity):
+        if entity in self.targets:
+            self.targets[entity][1] += 1
+            return
+
+        cell = self.get_cell(entity.world_position)
+        self.targets[entity] = [cell, 1]
+        self.cells.setdefault(cell, set()).add(entity)
+
+
+    def remove_target(self, entity):
+        if entity not in self.targets:
+            return
+
+        self.targets[entity][1] -= 1
+        if self.targets[entity][1] <= 0:
+            self._remove_from_cell(entity, self.targets.pop(entity)[0])
+
+
+    def _remove_from_cell(self, entity, cell):
+        cell_entities = self.cells.get(cell)
+        if cell_entities is None:
+            return
+
+        cell_entities.discard(entity)
+        if not cell_entities:
+            del self.cells[cell]
+
+
+    def update_cells(self):
+        for entity, target in list(self.targets.items()):
+            if entity.is_empty():   # destroyed
+                self._remove_from_cell(entity, target[0])
+                del self.targets[entity]
+                continue
+
+            cell = self.get_cell(entity.world_position)
+            if cell != target[0]:
+                self._remove_from_cell(entity, target[0])
+                self.cells.setdefault(cell, set()).add(entity)
+                target[0] = cell
+
+
+    def query(self, min_corner, max_corner): # returns the targets in the cells overlapping the box from min_corner to max_corner
+        start = self.get_cell(min_corner)
+        end = self.get_cell(max_corner)
+        result = set()
+
+        cell_count = (end[0] - start[0] + 1) * (end[1] - start[1] + 1) * (end[2] - start[2] + 1)
+        if cell_count > len(self.cells):    # large area, so it's faster to go through the occupied cells instead
+            for (x, y, z), cell_entities in self.cells.items():
+                if start[0] <= x <= end[0] and start[1] <= y <= end[1] and start[2] <= z <= end[2]:
+                    result.update(cell_entities)
+            return result
+
+        for x in range(start[0], end[0]+1):
+            for y in range(start[1], end[1]+1):
+                for z in range(start[2], end[2]+1):
+                    cell_entities = self.cells.get((x, y, z))
+                    if cell_entities:
+                        result.update(cell_entities)
+        return result
+
+
+    def update(self):
+        self._frame += 1
+        due_triggers = [e for e in self.triggers if e.enabled and self._frame % max(e.update_rate, 1) == 0]
+        if not due_triggers:
+            return
+
+        self.update_cells()
+        events = []
+        for trigger in due_triggers:
+            events.extend(trigger.check(self))
+
+        for event in events:
+            event()
+
+
+
+@generate_properties_for_class()
 class Trigger(Entity):
+    broadphase = None
+
     def __init__(self, **kwargs):
         super().__init__()
 
-        self.trigger_targets = None
+        if not Trigger.broadphase or Trigger.broadphase.is_empty():
+            Trigger.broadphase = TriggerBroadphase()
+        Trigger.broadphase.triggers.add(self)
+
+        self.trigger_targets = None     # assign a new list to change the targets, since changes to the list itself won't be noticed.
+        self.shape = 'sphere'           # 'sphere' or 'box'. both are in world space and not rotated.
         self.radius = .5
+        self.size = Vec3(1,1,1)         # size of the box, if shape is 'box'
         self.triggerers = []
         self.update_rate = 4
-        self._i = 0
 
         for key, value in kwargs.items():
             setattr(self, key, value)
 
 
-    def update(self):
-        self._i += 1
-        if self._i < self.update_rate:
-            return
+    def trigger_targets_getter(self):
+        return getattr(self, '_trigger_targets', None)
 
-        self._i = 0
+    def trigger_targets_setter(self, value):
+        for e in getattr(self, '_target_set', ()):
+            Trigger.broadphase.remove_target(e)
 
-        for other in self.trigger_targets:
-            if other == self:
-                continue
+        self._trigger_targets = value
+        self._target_set = set(value) if value else set()
+        for e in self._target_set:
+            Trigger.broadphase.add_target(e)
+
+
+    def get_bounds(self):   # the world space box to look for targets in
+        position = self.world_position
+        if self.shape == 'box':
+            half_size = Vec3(*self.size) / 2
+        else:
+            half_size = Vec3(self.radius, self.radius, self.radius)
+        return position - half_size, position + half_size
 
-            dist = distance(other, self)
-            if not other in self.triggerers and dist <= self.radius:
+
+    def contains(self, point):
+        position = self.world_position
+        if self.shape == 'box':
+            return all(abs(point[i] - position[i]) <= self.size[i] / 2 for i in range(3))
+
+        return (point[0]-position[0])**2 + (point[1]-position[1])**2 + (point[2]-position[2])**2 <= self.radius**2
+
+
+    def check(self, broadphase): # returns the enter/stay/exit events instead of calling them, so they can be sent after all triggers are checked
+        inside = set()
+        for other in broadphase.query(*self.get_bounds()):
+            if other is not self and other in self._target_set and self.contains(other.world_position):
+                inside.add(other)
+
+        events = []
+        for other in [e for e in self.triggerers if e not in inside]:
+            self.triggerers.remove(other)
+            if hasattr(self, 'on_trigger_exit'):
+                events.append(self.on_trigger_exit)
+
+        if hasattr(self, 'on_trigger_stay'):
+            events.extend(self.on_trigger_stay for e in self.triggerers)
+
+        triggerer_set = set(self.triggerers)
+        for other in inside:
+            if other not in triggerer_set:
                 self.triggerers.append(other)
                 if hasattr(self, 'on_trigger_enter'):
-                    self.on_trigger_enter()
-                continue
+                    events.append(self.on_trigger_enter)
 
-            if other in self.triggerers and dist > self.radius:
-                self.triggerers.remove(other)
-                if hasattr(self, 'on_trigger_exit'):
-                    self.on_trigger_exit()
-                continue
+        return events
 
-            if other in self.triggerers and hasattr(self, 'on_trigger_stay'):
-                self.on_trigger_stay()
+
+    def on_destroy(self):
+        self.trigger_targets = None
+        if Trigger.broadphase:
+            Trigger.broadphase.triggers.discard(self)
 
 
 
@@ -68,4 +201,9 @@ if __name__ == '__main__':
     t.on_trigger_exit =  Func(print, 'exit')
     t.on_trigger_stay =  Func(print, 'stay')
 
+    '''box triggers are axis aligned and use size instead of radius'''
+    b = Trigger(trigger_targets=(player,), x=-1, shape='box', size=(1,2,1), model='cube', scale=(1,2,1), color=color.hsv(.6,1,1,.5))
+    b.on_trigger_enter = Func(print, 'enter box')
+    b.on_trigger_exit =  Func(print, 'exit box')
+
     app.run()
@@ -96,6 +96,8 @@ def _destroy(entity, force_destroy=False):
 
     if entity in scene.collidables:
         scene.collidables.remove(entity)
+    from ursina.spatial_query import spatial_grid
+    spatial_grid._remove(entity)
 
     if hasattr(entity, '_parent') and entity._parent and hasattr(entity._parent, '_children') and entity in entity._parent._children:
         entity._parent._children.remove(entity)